@@ -0,0 +1,334 @@
+"""ASGI serving mode for the marketplace API.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Every route still runs the Flask code in server.py through asgiref's
+WSGI adapter, on a bounded thread pool (ASGI_WSGI_THREADS). The chat
+stream and chat long-poll are the exception: they are handled natively on
+the event loop, so a parked client costs a coroutine instead of a worker
+thread. Their database work runs on a second executor sized to the
+connection pool. Skipping Flask also skips its hooks, so they log and
+record metrics themselves, through RequestRecord.
+"""
+import asyncio
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_cookie
+
+try:
+    from asgiref.sync import SyncToAsync
+    from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+except ImportError:  # pragma: no cover
+    raise ImportError('The ASGI mode needs asgiref: pip install asgiref uvicorn')
+
+import db
+import pubsub
+import ratelimit
+import requestlog
+import server
+from db import get_read_db
+
+app = server.app
+app.config.setdefault('ASGI_WSGI_THREADS', 32)
+
+wsgi_executor = ThreadPoolExecutor(
+    max_workers=app.config['ASGI_WSGI_THREADS'],
+    thread_name_prefix='asgi-wsgi',
+)
+db_executor = ThreadPoolExecutor(
+    max_workers=app.config['DB_POOL_SIZE'] or 8,
+    thread_name_prefix='asgi-db',
+)
+
+
+class PooledWsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs every WSGI call on one shared thread by default, which
+    # would serialize the whole API; Flask is thread-safe, so use the pool.
+    run_wsgi_app = SyncToAsync(
+        WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+        thread_sensitive=False,
+        executor=wsgi_executor,
+    )
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(
+            scope, receive, send
+        )
+
+
+wsgi_application = PooledWsgiToAsgi(app)
+
+STREAM_PATH = re.compile(r'^/api/chat/stream/(\d+)$')
+MESSAGES_PATH = re.compile(r'^/api/chat/messages/(\d+)$')
+ACCESS_ERROR = 'Not authorized to view messages for this trade'
+
+
+async def run_db(fn, *args):
+    """Run ``fn`` on the database executor inside a Flask app context."""
+    def call():
+        with app.app_context():
+            return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(db_executor, call)
+
+
+def load_messages(token, trade_id, after_id, limit, fetch=True):
+    """Authorize the session ``token`` for ``trade_id`` and fetch messages after ``after_id``.
+
+    Returns (status, body) where body is the error dict or the message list.
+    """
+    user = server.auth_sessions.user(token)
+    if not user:
+        return 401, {'error': 'Unauthorized'}
+    cursor = get_read_db().cursor()
+    error = server.trade_access_error(cursor, trade_id, user, ACCESS_ERROR)
+    if error:
+        return error[1], error[0]
+    if not fetch:
+        return 200, []
+    return 200, server.fetch_messages(cursor, trade_id, after_id, limit)
+
+
+class RequestRecord:
+    """Access log line and HTTP metrics for a natively served request.
+
+    Wraps the ASGI ``send`` and records when the response starts, as
+    server.log_request and server.record_request_metrics do after a Flask
+    view: a stream's duration is its time to first byte. ``user`` is filled
+    in once the session has been looked up.
+    """
+
+    def __init__(self, scope, send, endpoint):
+        self.scope = scope
+        self.endpoint = endpoint
+        self.user = None
+        self.started = time.perf_counter()
+        self.status = None
+        self._send = send
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            length = dict(message.get('headers', ())).get(b'content-length')
+            self.finish(message['status'], int(length) if length else None)
+        await self._send(message)
+
+    def finish(self, status, size=None):
+        self.status = status
+        seconds = time.perf_counter() - self.started
+        level = requestlog.status_level(status)
+        if server.request_log.wants(self.endpoint, level):
+            client = self.scope.get('client')
+            server.request_log.emit(level, {
+                'method': self.scope['method'],
+                'path': self.scope['path'],
+                'endpoint': self.endpoint,
+                'status': status,
+                'ms': round(seconds * 1000, 2),
+                'bytes': size,
+                'user_id': self.user['id'] if self.user else None,
+                'ip': client[0] if client else None,
+            })
+        if server.http_metrics is not None:
+            server.http_metrics.observe(self.endpoint, self.scope['method'], status, seconds, size)
+
+
+def query_int(query, name):
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return None
+
+
+def query_float(query, name, default):
+    try:
+        return float(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+
+def header(scope, name):
+    name = name.lower().encode()
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def session_token(scope):
+    # Same lookup as server.request_token
+    return server.auth_sessions.token_from(header(scope, 'Authorization'), parse_cookie(header(scope, 'Cookie')))
+
+
+def check_rate_limit(endpoint, token, scope, record):
+    # Same rule and key as server.enforce_rate_limit
+    user = record.user = server.auth_sessions.user(token)
+    client = scope.get('client')
+    return server.rate_limiter.hit(
+        endpoint, ratelimit.client_key(user['id'] if user else None, client[0] if client else None)
+    )
+
+
+async def send_json(send, status, body, headers=None):
+    payload = app.json.dumps(body).encode() + b'\n'
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode()),
+            (b'access-control-allow-origin', b'*'),
+        ] + [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def send_rate_limited(record, token, scope):
+    """Answer 429 and return True if the client is over the limit of ``record``'s endpoint."""
+    decision = await run_db(check_rate_limit, record.endpoint, token, scope, record)
+    if decision is None or decision.allowed:
+        return False
+    await send_json(record.send, 429, {'message': server.RATE_LIMIT_MESSAGE}, decision.headers())
+    return True
+
+
+async def chat_long_poll(scope, receive, record, trade_id, query):
+    # Same contract as server.get_messages with ?wait=
+    send = record.send
+    after_id = query_int(query, 'after_id')
+    limit = query_int(query, 'limit')
+    if limit is not None:
+        limit = max(1, min(limit, app.config['CHAT_MAX_BATCH']))
+    wait = max(0.0, min(query_float(query, 'wait', 0.0), app.config['CHAT_LONG_POLL_TIMEOUT']))
+
+    token = session_token(scope)
+    if await send_rate_limited(record, token, scope):
+        return
+
+    loop = asyncio.get_running_loop()
+    subscription = server.chat_hub.subscribe(pubsub.trade_topic(trade_id), loop=loop)
+    try:
+        status, body = await run_db(load_messages, token, trade_id, after_id, limit)
+        if status == 200 and not body and wait:
+            if await subscription.get(timeout=wait) is not None:
+                status, body = await run_db(load_messages, token, trade_id, after_id, limit)
+    finally:
+        subscription.close()
+    await send_json(send, status, body)
+
+
+async def chat_stream(scope, receive, record, trade_id, query):
+    # Same contract as server.stream_messages
+    send = record.send
+    after_id = header(scope, 'Last-Event-ID')
+    after_id = int(after_id) if after_id and after_id.isdigit() else query_int(query, 'after_id')
+    if await send_rate_limited(record, session_token(scope), scope):
+        return
+
+    loop = asyncio.get_running_loop()
+    subscription = server.chat_hub.subscribe(pubsub.trade_topic(trade_id), loop=loop)
+    try:
+        # Replay what the client missed, if it told us where it left off
+        status, body = await run_db(load_messages, session_token(scope), trade_id, after_id, None, after_id is not None)
+        if status != 200:
+            await send_json(send, status, body)
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                (b'access-control-allow-origin', b'*'),
+            ],
+        })
+
+        async def pump():
+            heartbeat = app.config['CHAT_STREAM_HEARTBEAT']
+            await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+            last_id = after_id or 0
+            for msg in body:
+                last_id = msg['id']
+                chunk = server.sse_event({'type': 'message', 'data': msg})
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+            while True:
+                event = await subscription.get(timeout=heartbeat)
+                if subscription.dropped:
+                    # Fell behind; the client reconnects and replays, as in server.stream_messages
+                    chunk = server.sse_event(server.resync_event(last_id))
+                    await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                if event is None:
+                    chunk = ': keep-alive\n\n'
+                elif event['type'] == 'message' and event['data']['id'] <= last_id:
+                    continue
+                else:
+                    if event['type'] == 'message':
+                        last_id = event['data']['id']
+                    chunk = server.sse_event(event)
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(wait_for_disconnect())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+    finally:
+        subscription.close()
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.get_running_loop().run_in_executor(db_executor, server.init_db)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            db_executor.shutdown(wait=True)
+            wsgi_executor.shutdown(wait=True)
+            db.reset_pool(app)
+            server.chat_hub.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def serve_native(handler, endpoint, scope, receive, send, match, query):
+    # ``endpoint`` is the Flask route's name, so both modes log and count alike
+    record = RequestRecord(scope, send, endpoint)
+    try:
+        await handler(scope, receive, record, int(match.group(1)), query)
+    except Exception:
+        # The server answers 500 for us; Flask would have logged it
+        if record.status is None:
+            record.finish(500)
+        raise
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(scope, receive, send)
+
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        match = STREAM_PATH.match(scope['path'])
+        if match:
+            return await serve_native(chat_stream, 'stream_messages', scope, receive, send, match, query)
+        match = MESSAGES_PATH.match(scope['path'])
+        if match and 'wait' in query:
+            return await serve_native(chat_long_poll, 'get_messages', scope, receive, send, match, query)
+
+    await wsgi_application(scope, receive, send)
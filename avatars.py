@@ -0,0 +1,169 @@
+"""The catalog of selectable avatars behind GET /avatars.
+
+The folder is scanned once, on first use, and again by a background watcher
+when its contents change. The response body is serialized once per scan,
+so serving it costs the same for 5 avatars or 5,000.
+
+Ids are stored in the avatars table (migration 11), keyed by file name, so
+an avatar keeps its id across scans, restarts and workers. The table also
+caches each file's SHA-256 and PNG dimensions, keyed by mtime and size, so
+only new or changed files are read again.
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+
+class Catalog:
+    """One serialized avatar list and its validator."""
+
+    def __init__(self, payload, dumps=json.dumps):
+        self.avatars = payload['avatars']
+        self.body = dumps(payload).encode()
+        self.etag = hashlib.sha1(self.body).hexdigest()[:24]
+
+
+def png_size(head):
+    """``(width, height)`` from a PNG's IHDR chunk, or None if ``head`` is not a PNG."""
+    if len(head) < 24 or not head.startswith(PNG_SIGNATURE) or head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def describe(path):
+    """SHA-256 and PNG dimensions of the file at ``path``."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        digest.update(head)
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest(), png_size(head)
+
+
+class AvatarRegistry:
+    """Keeps the avatar catalog for ``folder``.
+
+    ``connect`` is a context manager yielding a database connection; it is
+    used from request threads and from the watcher thread. ``fallback`` is
+    the list served when the folder does not exist. With a ``watch_interval``
+    (seconds), a daemon thread rescans when the folder's entries change.
+    ``dumps`` serializes the response body.
+    """
+
+    def __init__(self, folder, url_path, connect, fallback=(), watch_interval=None, dumps=json.dumps):
+        self.folder = folder
+        self.url_path = url_path
+        self.connect = connect
+        self.fallback = list(fallback)
+        self.watch_interval = watch_interval
+        self.dumps = dumps
+        self._catalog = None
+        self._signature = None
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def catalog(self):
+        catalog = self._catalog
+        if catalog is None:
+            with self._lock:
+                if self._catalog is None:
+                    self._refresh()
+                    self._start_watcher()
+                catalog = self._catalog
+        return catalog
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _entries(self):
+        # (name, size, mtime_ns) of every PNG, which is also what the watcher compares
+        with os.scandir(self.folder) as entries:
+            return sorted(
+                (entry.name, st.st_size, st.st_mtime_ns)
+                for entry in entries
+                if entry.name.lower().endswith('.png') and entry.is_file()
+                for st in (entry.stat(),)
+            )
+
+    def _refresh(self):
+        if not os.path.isdir(self.folder):
+            self._signature = None
+            self._catalog = Catalog({
+                'success': True,
+                'avatars': self.fallback,
+                'message': 'Using default avatars (folder not found)',
+            }, self.dumps)
+            return
+
+        entries = self._entries()
+        with self.connect() as conn:
+            known = {
+                row[1]: row
+                for row in conn.execute('SELECT id, name, bytes, mtime_ns, sha256, width, height FROM avatars')
+            }
+            changed = []
+            for name, size, mtime_ns in entries:
+                row = known.get(name)
+                if row is None or (row[2], row[3]) != (size, mtime_ns):
+                    sha256, dimensions = describe(os.path.join(self.folder, name))
+                    width, height = dimensions or (None, None)
+                    changed.append((name, size, mtime_ns, sha256, width, height))
+            if changed:
+                # Upsert, so a row and its id survive the file being replaced
+                conn.executemany('''
+                    INSERT INTO avatars (name, bytes, mtime_ns, sha256, width, height)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET
+                        bytes = excluded.bytes, mtime_ns = excluded.mtime_ns, sha256 = excluded.sha256,
+                        width = excluded.width, height = excluded.height
+                ''', changed)
+                conn.commit()
+                known = {
+                    row[1]: row
+                    for row in conn.execute('SELECT id, name, bytes, mtime_ns, sha256, width, height FROM avatars')
+                }
+
+        present = [known[name] for name, _, _ in entries]
+        present.sort(key=lambda row: row[0])
+        self._signature = entries
+        self._catalog = Catalog({
+            'success': True,
+            'avatars': [
+                {
+                    'id': avatar_id,
+                    'name': name,
+                    'path': self.url_path + name,
+                    'width': width,
+                    'height': height,
+                    'sha256': sha256,
+                }
+                for avatar_id, name, _, _, sha256, width, height in present
+            ],
+        }, self.dumps)
+
+    def _start_watcher(self):
+        if not self.watch_interval or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, name='avatar-watcher', daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.watch_interval)
+            try:
+                exists = os.path.isdir(self.folder)
+                if exists != (self._signature is not None) or (exists and self._entries() != self._signature):
+                    self.refresh()
+            except Exception as e:
+                log.warning('Avatar rescan failed: %s', e)
@@ -0,0 +1,146 @@
+"""Shared helpers for the benchmark scripts.
+
+Each benchmark points the Flask app at a throwaway database, seeds it and
+drives the routes through the test client, so the numbers measure the app
+itself rather than the network stack.
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# server.py resolves assets/ relative to the working directory
+os.chdir(ROOT)
+
+import db  # noqa: E402
+import server  # noqa: E402
+
+# Every benchmark client comes from one address; bench_ratelimit turns it back on
+server.rate_limiter.enabled = False
+# Access records would go to stdout; bench_logging measures them
+server.request_log.enabled = False
+
+CATEGORIES = ['Electronics', 'Books', 'Clothing', 'Furniture', 'Sports', 'Toys']
+
+
+def make_database(n_users=50, n_items=5000, n_trades=200, n_messages=2000, seed=1):
+    """Create and seed a temporary users.db, returning its path."""
+    fd, path = tempfile.mkstemp(suffix='.db', prefix='bench_')
+    os.close(fd)
+    os.unlink(path)
+    use_database(path)
+    server.init_db()
+
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        'INSERT INTO users (firstname, lastname, email, password) VALUES (?, ?, ?, ?)',
+        [(f'User{i}', 'Bench', f'user{i}@example.com', 'secret123') for i in range(1, n_users + 1)],
+    )
+    conn.executemany(
+        '''INSERT INTO items (user_id, title, category, price, description, image_url, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, datetime('now', ?))''',
+        (
+            (
+                rng.randint(1, n_users),
+                f'Item {i}',
+                rng.choice(CATEGORIES),
+                round(rng.uniform(1, 2000), 2),
+                f'Description for item {i}',
+                f'assets/images/item{i}.jpg',
+                f'-{n_items - i} seconds',
+            )
+            for i in range(1, n_items + 1)
+        ),
+    )
+    # User 1 sends the odd trades and receives the even ones; trade 1 is
+    # always between users 1 and 2.
+    trades = []
+    for i in range(1, n_trades + 1):
+        other = 2 + (i // 2) % (n_users - 1)
+        sender, receiver = (1, other) if i % 2 else (other, 1)
+        trades.append((rng.randint(1, n_items), rng.randint(1, n_items), sender, receiver))
+    conn.executemany(
+        'INSERT INTO trades (item1_id, item2_id, sender_id, receiver_id) VALUES (?, ?, ?, ?)',
+        trades,
+    )
+    conn.executemany(
+        'INSERT INTO chat_messages (trade_id, sender_id, receiver_id, message) VALUES (?, ?, ?, ?)',
+        [(rng.randint(1, n_trades), 1, 2, f'message {i}') for i in range(1, n_messages + 1)],
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def use_database(path, **config):
+    server.app.config['DATABASE'] = path
+    server.app.config.update(config)
+    db.reset_pool(server.app)
+
+
+_session = {}
+
+
+def _send_session_token(wsgi_app):
+    def app(environ, start_response):
+        token = _session.get('token')
+        if token:
+            environ.setdefault('HTTP_AUTHORIZATION', f'Bearer {token}')
+        return wsgi_app(environ, start_response)
+    return app
+
+
+def login_as(user_id=1):
+    """Log in as ``user_id`` for every later request that carries no token of its own.
+
+    Covers test clients and servers started on server.app alike. Call it
+    after use_database(), since the session lives in the database.
+    """
+    with server.app.app_context():
+        _session['token'] = server.auth_sessions.issue(user_id)
+    if not _session.get('installed'):
+        server.app.wsgi_app = _send_session_token(server.app.wsgi_app)
+        _session['installed'] = True
+
+
+def run_load(paths, threads=8, duration=3.0):
+    """Hammer ``paths`` from ``threads`` threads and return requests/sec."""
+    stop = time.monotonic() + duration
+    counts = [0] * threads
+    errors = []
+
+    def worker(idx):
+        client = server.app.test_client()
+        n = 0
+        while time.monotonic() < stop:
+            resp = client.get(paths[n % len(paths)], buffered=True)
+            if resp.status_code >= 400:
+                errors.append(resp.status_code)
+            n += 1
+        counts[idx] = n
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.monotonic()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.monotonic() - start
+    if errors:
+        print(f'  warning: {len(errors)} error responses (first: {errors[0]})')
+    return sum(counts) / elapsed
+
+
+def cleanup(path):
+    db.reset_pool(server.app)
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.unlink(path + suffix)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,153 @@
+"""Threaded dev server vs. the ASGI mode under many concurrent connections.
+
+Each mode runs in a subprocess. The benchmark parks N chat long-polls
+(?wait=) on the server, then measures throughput and p50/p99 latency of
+/api/items requests issued by concurrent clients while those connections
+are held open.
+
+    python benchmarks/bench_asgi.py [--parked 1000] [--clients 50] [--duration 5]
+
+The ASGI mode needs `pip install asgiref uvicorn`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from _common import ROOT, cleanup, make_database
+
+SERVERS = {
+    'threaded': (
+        "from werkzeug.serving import run_simple\n"
+        "run_simple('127.0.0.1', {port}, server.app, threaded=True)\n"
+    ),
+    'asgi': (
+        "import asgi, uvicorn\n"
+        "uvicorn.run(asgi.application, host='127.0.0.1', port={port}, log_level='warning', backlog=4096)\n"
+    ),
+}
+
+BOOT = (
+    "import logging, sys\n"
+    "sys.path.insert(0, {root!r})\n"
+    "import server\n"
+    "server.app.config['DATABASE'] = {db!r}\n"
+    "server.rate_limiter.enabled = False\n"
+    "server.request_log.enabled = False\n"
+    "logging.getLogger('werkzeug').setLevel(logging.ERROR)\n"
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    payload = json.dumps(body).encode() if body is not None else b''
+    head = (f'{method} {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n'
+            f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n')
+    writer.write(head.encode() + payload)
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    head, _, body = data.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), body
+
+
+async def park(port, count, token):
+    """Open ``count`` long-polls that will not be answered during the run."""
+    writers = []
+    path = '/api/chat/messages/1?after_id=2147483647&wait=60'
+    for _ in range(count):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: bench\r\nAuthorization: Bearer {token}\r\n\r\n'.encode())
+        writers.append(writer)
+    await asyncio.gather(*(w.drain() for w in writers))
+    return writers
+
+
+async def measure(port, parked, clients, duration):
+    status, body = await request(port, 'POST', '/api/login',
+                                 {'email': 'user1@example.com', 'password': 'secret123'})
+    assert status == 200
+    writers = await park(port, parked, json.loads(body)['token'])
+    await asyncio.sleep(1)  # let the server accept and park everything
+
+    latencies, errors = [], 0
+    stop = time.monotonic() + duration
+
+    async def client():
+        nonlocal errors
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            try:
+                status, _ = await request(port, 'GET', '/api/items?limit=20')
+            except OSError:
+                status = 0
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    await asyncio.gather(*(client() for _ in range(clients)))
+    for writer in writers:
+        writer.close()
+    return latencies, errors
+
+
+def run_mode(mode, db_path, args):
+    port = free_port()
+    code = BOOT.format(root=ROOT, db=db_path) + SERVERS[mode].format(port=port)
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError(f'{mode} server did not start: {proc.stderr.read().decode()[-500:]}')
+        latencies, errors = asyncio.run(measure(port, args.parked, args.clients, args.duration))
+        with open(f'/proc/{proc.pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        rss = int(status['VmRSS'].split()[0]) / 1024
+        threads = int(status['Threads'])
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000  # noqa: E731
+    print(f'{mode}: {args.parked} parked long-polls + {args.clients} active clients')
+    print(f'  {len(latencies) / args.duration:8.1f} req/s   p50 {pct(0.50):7.1f}ms   p99 {pct(0.99):7.1f}ms'
+          f'   errors {errors}')
+    print(f'  server RSS {rss:.0f} MiB, {threads} threads')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parked', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--modes', default='threaded,asgi')
+    args = parser.parse_args()
+
+    db_path = make_database(n_items=2000)
+    try:
+        for mode in args.modes.split(','):
+            run_mode(mode, db_path, args)
+    finally:
+        cleanup(db_path)
+        os.environ.pop('DATABASE', None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Per-request cost of resolving the session token to a user.
+
+Times a bare route that only reads current_user() against the same route
+without authentication, through the test client, for each session store
+with the user cache on and off. Also times the lookup on its own, and the
+rejection of a tampered token, which never reaches the store.
+
+    python benchmarks/bench_auth.py [--rounds N] [--users N]
+"""
+import argparse
+import contextlib
+import io
+import statistics
+import time
+
+from flask import jsonify
+
+from _common import cleanup, make_database, server, use_database
+import sessions
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=3000)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    def whoami():
+        user = server.current_user()
+        if not user:
+            return jsonify({'error': 'Unauthorized'}), 401
+        return jsonify({'id': user['id']})
+
+    server.app.add_url_rule('/bench/anonymous', 'bench_anonymous', lambda: jsonify({'id': None}))
+    server.app.add_url_rule('/bench/whoami', 'bench_whoami', whoami)
+    auth = server.auth_sessions
+    saved_store = auth.store
+
+    path = make_database(n_users=args.users, n_items=10, n_trades=2, n_messages=2)
+    use_database(path)
+    client = server.app.test_client()
+
+    def get(url, token=None, expect=200):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            resp = client.get(url, headers=headers)
+        assert resp.status_code == expect, resp.status_code
+        return resp
+
+    try:
+        baseline = timed(lambda: get('/bench/anonymous'), args.rounds)
+        print(f'unauthenticated route: {baseline:7.1f}us per request')
+        print(f"{'store':8} {'user cache':>10} {'per request':>12} {'overhead':>10} {'lookup':>9}")
+        for store_name in ('memory', 'sqlite'):
+            auth.store = sessions.create_store(store_name, server.get_db, server.get_read_db)
+            with server.app.app_context():
+                # Sessions for every user, so the lookup runs against a realistic table
+                tokens = [auth.issue(user_id) for user_id in range(1, args.users + 1)]
+            for cached in (True, False):
+                auth.users.enabled = cached
+                auth.users.invalidate()
+                token = tokens[len(tokens) // 2]
+                per_request = timed(lambda: get('/bench/whoami', token), args.rounds)
+                with server.app.app_context():
+                    lookup = timed(lambda: auth.user(token), args.rounds)
+                print(f"{store_name:8} {'on' if cached else 'off':>10} {per_request:10.1f}us "
+                      f'{per_request - baseline:8.1f}us {lookup:7.1f}us')
+
+        tampered = token[:-4] + ('AAAA' if not token.endswith('AAAA') else 'BBBB')
+        rejected = timed(lambda: get('/bench/whoami', tampered, expect=401), args.rounds)
+        print(f'tampered token, 401: {rejected:7.1f}us per request ({rejected - baseline:.1f}us overhead)')
+    finally:
+        auth.store = saved_store
+        auth.users.enabled = True
+        auth.users.invalidate()
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""GET /avatars from the registry against the old per-request os.listdir.
+
+Fills a folder with N small PNGs for each N in --counts, registers the
+previous implementation under /bench/legacy-avatars, and reports the
+median time per request for both, for a revalidation (304), and for the
+registry's first scan and an unchanged rescan.
+
+    python benchmarks/bench_avatars.py [--counts 5,5000] [--rounds N]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import struct
+import tempfile
+import time
+import zlib
+
+from flask import jsonify
+
+from _common import cleanup, make_database, server
+
+
+def tiny_png(width, height):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + b'\x80' * (width * 3) for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows))
+            + chunk(b'IEND', b''))
+
+
+def legacy_avatars(folder):
+    # The route as it was: list and stat the folder on every request
+    files = os.listdir(folder)
+    png_files = [f for f in files if f.lower().endswith('.png')]
+    avatars = [
+        {'id': idx + 1, 'name': filename, 'path': os.path.join(folder, filename).replace('\\', '/')}
+        for idx, filename in enumerate(png_files)
+        if os.path.isfile(os.path.join(folder, filename))
+    ]
+    return jsonify({'success': True, 'avatars': avatars})
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', default='5,5000')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    current = {}
+    server.app.add_url_rule('/bench/legacy-avatars', 'bench_legacy_avatars',
+                            lambda: legacy_avatars(current['folder']))
+    registry = server.avatar_registry
+    saved = registry.folder, registry.watch_interval
+    registry.watch_interval = None
+    path = make_database(n_items=10, n_trades=2, n_messages=2)
+    client = server.app.test_client()
+
+    def get(url, **headers):
+        with contextlib.redirect_stdout(io.StringIO()):
+            resp = client.get(url, headers=headers)
+        assert resp.status_code in (200, 304), resp.status_code
+        return resp
+
+    print(f"{'avatars':>8} {'before':>9} {'after':>9} {'304':>9} {'first scan':>11} {'rescan':>9}")
+    try:
+        for count in map(int, args.counts.split(',')):
+            folder = tempfile.mkdtemp(prefix='bench_avatars_')
+            png = tiny_png(64, 64)
+            for i in range(count):
+                with open(os.path.join(folder, f'avatar_{i}.png'), 'wb') as f:
+                    f.write(png)
+            current['folder'] = folder
+            registry.folder = folder
+            with server.app.app_context():
+                server.get_db().execute('DELETE FROM avatars')
+                server.get_db().commit()
+
+            start = time.perf_counter()
+            registry.refresh()
+            first_scan = (time.perf_counter() - start) * 1000
+            rescan = timed(registry.refresh, 5)
+
+            etag = get('/avatars').headers['ETag']
+            before = timed(lambda: get('/bench/legacy-avatars'), args.rounds)
+            after = timed(lambda: get('/avatars'), args.rounds)
+            revalidated = timed(lambda: get('/avatars', **{'If-None-Match': etag}), args.rounds)
+            print(f'{count:8} {before:7.3f}ms {after:7.3f}ms {revalidated:7.3f}ms '
+                  f'{first_scan:9.1f}ms {rescan:7.1f}ms')
+            shutil.rmtree(folder)
+    finally:
+        registry.folder, registry.watch_interval = saved
+        registry._catalog = None
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Latency of filtered, sorted and faceted /api/items pages.
+
+Seeds a large catalog (500k items by default), disables the feed cache so
+every request runs its queries, and times each scenario through the route.
+Exits 1 if any scenario's p95 exceeds --target-ms.
+
+    python benchmarks/bench_catalog.py [--items N] [--rounds N] [--target-ms MS]
+"""
+import argparse
+import contextlib
+import io
+import sqlite3
+import statistics
+import sys
+import time
+
+from _common import cleanup, login_as, make_database, server, use_database
+
+SCENARIOS = [
+    ('newest', '/api/items'),
+    ('category', '/api/items?category=Books'),
+    ('two categories', '/api/items?category=Books&category=Toys'),
+    ('narrow price', '/api/items?min_price=100&max_price=105'),
+    ('wide price', '/api/items?min_price=10&max_price=1900'),
+    # About PRICE_PROBE_LIMIT matches: the slowest case for either plan
+    ('price near probe cap', '/api/items?min_price=500&max_price=520'),
+    ('sparse category+price', '/api/items?category=Books&min_price=1999&max_price=2000'),
+    ('price_asc', '/api/items?sort=price_asc'),
+    ('price_desc', '/api/items?sort=price_desc'),
+    ('category+price+sort', '/api/items?category=Books&min_price=200&max_price=400&sort=price_desc'),
+    ('rare category newest', '/api/items?category=Rare'),
+    ('exclude_self', '/api/items?exclude_self=1'),
+    ('facets', '/api/items?facets=1'),
+    ('facets+exclude_self', '/api/items?facets=1&exclude_self=1'),
+    ('facets+category', '/api/items?facets=1&category=Books&category=Toys'),
+    ('page 10 via cursor', None),
+]
+
+
+def get(client, url):
+    with contextlib.redirect_stdout(io.StringIO()):
+        resp = client.get(url, buffered=True)
+    if resp.status_code != 200:
+        raise RuntimeError(f'{url}: {resp.status_code} {resp.data[:200]}')
+    return resp
+
+
+def page_ten(client):
+    cursor = None
+    for _ in range(10):
+        url = '/api/items?sort=price_asc&category=Books' + (f'&cursor={cursor}' if cursor else '')
+        cursor = get(client, url).get_json()['next_cursor']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=500_000)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--target-ms', type=float, default=25.0, help='p95 budget per request')
+    args = parser.parse_args()
+
+    print(f'seeding {args.items} items...')
+    path = make_database(n_items=args.items, n_trades=10, n_messages=10)
+    over = []
+    try:
+        conn = sqlite3.connect(path)
+        # A handful of listings in a category of their own
+        conn.execute("UPDATE items SET category = 'Rare' WHERE id % 50000 = 0")
+        conn.commit()
+        conn.close()
+
+        use_database(path)
+        server.feed_cache.enabled = False
+        login_as(1)
+        client = server.app.test_client()
+        print(f"{'scenario':22} {'p50':>8} {'p95':>8}")
+        for label, url in SCENARIOS:
+            run = (lambda: page_ten(client)) if url is None else (lambda: get(client, url))
+            run()  # warm the page cache
+            samples = []
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                run()
+                samples.append((time.perf_counter() - start) * 1000)
+            samples.sort()
+            p50 = statistics.median(samples)
+            p95 = samples[int(len(samples) * 0.95) - 1]
+            # The cursor walk is ten requests
+            budget = args.target_ms * (10 if url is None else 1)
+            flag = '' if p95 <= budget else f'  over {budget:.0f}ms budget'
+            if flag:
+                over.append(label)
+            print(f'{label:22} {p50:6.2f}ms {p95:6.2f}ms{flag}')
+    finally:
+        server.feed_cache.enabled = server.app.config['FEED_CACHE_ENABLED']
+        cleanup(path)
+
+    if over:
+        print(f'{len(over)} scenario(s) over budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Idle SSE subscribers: memory per connection and fan-out latency.
+
+Starts the app on a local threaded server, opens N idle
+/api/chat/stream/<trade_id> connections spread over a few trades, and reports
+resident memory and Python heap per connection. It then publishes one
+message per trade and times until every subscriber has received it.
+
+    python benchmarks/bench_chat_stream.py [--subscribers 2000] [--backend memory]
+"""
+import argparse
+import contextlib
+import io
+import logging
+import selectors
+import socket
+import threading
+import time
+import tracemalloc
+
+from werkzeug.serving import make_server
+
+from _common import cleanup, login_as, make_database, server, use_database
+
+
+def rss_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def open_stream(port, trade_id):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(f'GET /api/chat/stream/{trade_id} HTTP/1.1\r\nHost: bench\r\n'
+                 f'Accept: text/event-stream\r\n\r\n'.encode())
+    header = b''
+    while b'\r\n\r\n' not in header:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise RuntimeError('stream closed during handshake')
+        header += chunk
+    if not header.startswith(b'HTTP/1.1 200'):
+        raise RuntimeError(header.split(b'\r\n', 1)[0].decode())
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscribers', type=int, default=2000)
+    parser.add_argument('--trades', type=int, default=20)
+    parser.add_argument('--backend', default='memory')
+    args = parser.parse_args()
+
+    path = make_database(n_items=100, n_trades=args.trades * 2, n_messages=0)
+    # Trades are between users 1 and 2..n; log in as user 1 for all of them
+    trade_ids = list(range(1, args.trades * 2 + 1))
+    use_database(path)
+    login_as(1)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server.chat_hub.close()
+    server.chat_hub = server.pubsub.create_hub(args.backend)
+
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+    port = httpd.server_port
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    sockets = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Warm up one connection so lazy imports and pools are not counted
+            open_stream(port, trade_ids[0]).close()
+            time.sleep(0.2)
+            tracemalloc.start()
+            heap_before = tracemalloc.get_traced_memory()[0]
+            rss_before = rss_bytes()
+            for i in range(args.subscribers):
+                sockets.append(open_stream(port, trade_ids[i % len(trade_ids)]))
+            deadline = time.monotonic() + 10
+            while server.chat_hub.subscriber_count() < args.subscribers and time.monotonic() < deadline:
+                time.sleep(0.05)
+            rss_after = rss_bytes()
+            heap_after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+        n = server.chat_hub.subscriber_count()
+        print(f'backend {args.backend}: {n} idle subscribers, {threading.active_count()} threads')
+        print(f'  RSS    {(rss_after - rss_before) / n / 1024:8.1f} KiB per connection')
+        print(f'  heap   {(heap_after - heap_before) / n / 1024:8.1f} KiB per connection (Python objects)')
+
+        selector = selectors.DefaultSelector()
+        for sock in sockets:
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+        start = time.perf_counter()
+        client = server.app.test_client()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for trade_id in trade_ids:
+                if trade_id % 2:
+                    client.post('/api/chat/send', json={'trade_id': trade_id, 'receiver_id': 2 + (trade_id // 2) % 49,
+                                                        'message': 'fan-out'})
+        pending = {sock for i, sock in enumerate(sockets) if trade_ids[i % len(trade_ids)] % 2}
+        expected = len(pending)
+        while pending and time.perf_counter() - start < 30:
+            for key, _ in selector.select(timeout=1):
+                if key.fileobj in pending and key.fileobj.recv(65536):
+                    pending.discard(key.fileobj)
+        elapsed = time.perf_counter() - start
+        print(f'  fan-out to {expected - len(pending)}/{expected} subscribers in {elapsed * 1000:.1f}ms')
+    finally:
+        for sock in sockets:
+            sock.close()
+        httpd.shutdown()
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
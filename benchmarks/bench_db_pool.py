@@ -0,0 +1,41 @@
+"""Requests/sec on /api/items and /api/chat/messages with and without pooling.
+
+    python benchmarks/bench_db_pool.py [--threads 8] [--duration 3]
+"""
+import argparse
+
+from _common import cleanup, login_as, make_database, run_load, server, use_database
+
+ROUTES = {
+    '/api/items': ['/api/items'],
+    '/api/chat/messages': ['/api/chat/messages/1'],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--items', type=int, default=500)
+    args = parser.parse_args()
+
+    # Measure the database path, not the feed cache
+    server.feed_cache.enabled = False
+    path = make_database(n_items=args.items)
+    try:
+        for name, paths in ROUTES.items():
+            results = {}
+            for label, pool_size in (('per-request connect', 0), ('pooled', args.threads)):
+                use_database(path, DB_POOL_SIZE=pool_size)
+                login_as(1)
+                results[label] = run_load(paths, threads=args.threads, duration=args.duration)
+            base = results['per-request connect']
+            print(f'{name}')
+            for label, rps in results.items():
+                print(f'  {label:<20} {rps:10.1f} req/s  ({rps / base:.2f}x)')
+    finally:
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Throughput of the upload image pipeline and what it does to upload latency.
+
+Generates synthetic camera-sized JPEGs (a gradient with noise, so they
+compress like photos rather than flat colour), then
+
+  * processes them with 1..N worker threads and reports images/sec, and
+    images/sec per worker where the workers fit on the available cores,
+  * times POST /api/upload with the variants generated in the background
+    (the default) against generating them inline before responding, and
+  * compares the original's size with each variant's.
+
+    python benchmarks/bench_images.py [--images N] [--width PX] [--height PX] [--max-workers N]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from _common import cleanup, login_as, make_database, server
+
+import images
+
+if not images.AVAILABLE:
+    sys.exit('Pillow is not installed (pip install Pillow)')
+
+from PIL import Image  # noqa: E402
+
+
+def photo(width, height, seed):
+    """A photo-like JPEG as bytes."""
+    base = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + seed % 20)
+    image = Image.merge('RGB', (base, noise, Image.blend(base, noise, 0.5)))
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=92)
+    return buf.getvalue()
+
+
+def throughput(sources, folder, workers):
+    pipeline = images.ImagePipeline(folder, lambda url, variants: None, workers=workers)
+    start = time.perf_counter()
+    futures = [pipeline.submit(name, name) for name in sources]
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+    pipeline.shutdown()
+    return len(sources) / elapsed
+
+
+def upload_latency(client, data, rounds):
+    samples = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            resp = client.post('/api/upload', data={'image': (io.BytesIO(data), f'photo{i}.jpg')},
+                               content_type='multipart/form-data')
+        samples.append((time.perf_counter() - start) * 1000)
+        assert resp.status_code == 200, resp.data
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=24)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--max-workers', type=int, default=max(2, os.cpu_count() or 1))
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='bench_images_')
+    path = None
+    try:
+        print(f'generating {args.images} {args.width}x{args.height} JPEGs...')
+        sources = []
+        for i in range(args.images):
+            name = f'source{i}.jpg'
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(photo(args.width, args.height, i))
+            sources.append(name)
+
+        cores = os.cpu_count() or 1
+        print(f"\n{'workers':>7} {'images/s':>9} {'per worker':>11}   ({cores} core(s))")
+        for workers in range(1, args.max_workers + 1):
+            rate = throughput(sources, folder, workers)
+            print(f'{workers:7} {rate:9.2f} {rate / min(workers, cores):11.2f}')
+
+        original = os.path.getsize(os.path.join(folder, sources[0]))
+        pipeline = images.ImagePipeline(folder, lambda url, v: None, workers=1)
+        variants = pipeline.submit(sources[0], sources[0]).result()
+        pipeline.shutdown()
+        print(f'\noriginal {args.width}x{args.height}: {original / 1024:8.1f} KiB')
+        for v in variants:
+            print(f"{v['name']:>6} {v['format']:5} {v['width']:>5}x{v['height']:<5} "
+                  f"{v['bytes'] / 1024:8.1f} KiB  ({v['bytes'] / original:6.1%})")
+
+        path = make_database(n_items=10, n_trades=2, n_messages=2)
+        login_as(1)
+        client = server.app.test_client()
+        upload_folder = server.app.config['UPLOAD_FOLDER']
+        server.app.config['UPLOAD_FOLDER'] = folder
+        real_pipeline = server.image_pipeline
+        with open(os.path.join(folder, sources[0]), 'rb') as f:
+            data = f.read()
+        try:
+            server.image_pipeline = images.ImagePipeline(folder, server.record_image_variants, workers=1)
+            background = upload_latency(client, data, args.rounds)
+            server.image_pipeline.shutdown()
+
+            # Inline: the request waits for its variants
+            pipeline = images.ImagePipeline(folder, server.record_image_variants, workers=1)
+
+            class Inline:
+                def submit(self, filename, image_url):
+                    return pipeline.submit(filename, image_url).result()
+
+            server.image_pipeline = Inline()
+            inline = upload_latency(client, data, args.rounds)
+            pipeline.shutdown()
+        finally:
+            server.image_pipeline = real_pipeline
+            server.app.config['UPLOAD_FOLDER'] = upload_folder
+        print(f'\nPOST /api/upload p50: {background:7.2f}ms in the background, {inline:7.2f}ms inline')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        if path:
+            cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Per-request cost of request logging.
+
+Times a bare route through the test client with logging off, with the old
+three print() calls per request and with the queued JSON access log, each
+writing to a file so the terminal's speed does not count. Then runs the
+same comparison with --threads threads and reports requests/sec, and how
+many records the queued log dropped.
+
+    python benchmarks/bench_logging.py [--rounds N] [--threads N] [--duration S]
+"""
+import argparse
+import contextlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from flask import jsonify, request
+
+from _common import cleanup, make_database, run_load, server, use_database
+import requestlog
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def legacy_prints():
+    # What log_request_info did before
+    print(f"Request from: {request.remote_addr}")
+    print(f"Method: {request.method}")
+    print(f"Path: {request.path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=3.0)
+    args = parser.parse_args()
+
+    server.app.add_url_rule('/bench/ping', 'bench_ping', lambda: jsonify({'ok': True}))
+    server.app.before_request_funcs.setdefault(None, []).append(
+        lambda: legacy_prints() if server.app.config.get('BENCH_PRINTS') else None
+    )
+    path = make_database(n_users=10, n_items=10, n_trades=2, n_messages=2)
+    use_database(path)
+    client = server.app.test_client()
+    fd, sink_path = tempfile.mkstemp(suffix='.log', prefix='bench_logging_')
+    os.close(fd)
+
+    modes = {
+        'off': (False, False),
+        'print() x3': (True, False),
+        'queued JSON': (False, True),
+    }
+    stdout = sys.stdout
+    try:
+        with open(sink_path, 'w') as sink, contextlib.redirect_stdout(sink):
+            requestlog.configure(stream=sink)
+            handler = server.log_handler
+            results = {}
+            for name, (prints, queued) in modes.items():
+                server.app.config['BENCH_PRINTS'] = prints
+                server.request_log.enabled = queued
+                dropped = handler.dropped
+                per_request = timed(lambda: client.get('/bench/ping'), args.rounds)
+                rate = run_load(['/bench/ping'], threads=args.threads, duration=args.duration)
+                results[name] = (per_request, rate, handler.dropped - dropped)
+            # Let the writer catch up before the file closes
+            handler.queue.join()
+            requestlog.configure(stream=stdout)
+        base = results['off'][0]
+        print(f"{'logging':12} {'per request':>12} {'overhead':>10} {f'{args.threads} threads':>14} {'dropped':>8}")
+        for name, (per_request, rate, dropped) in results.items():
+            print(f'{name:12} {per_request:10.1f}us {per_request - base:8.1f}us {rate:8.0f} req/s {dropped:8}')
+        print(f'\n{os.path.getsize(sink_path) / 1024:.0f} KiB written')
+    finally:
+        server.app.config.pop('BENCH_PRINTS', None)
+        server.request_log.enabled = False
+        os.unlink(sink_path)
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Cost of the metrics layer, and what /metrics shows under load.
+
+Times the chat history, sent-trades and item feed routes through the test
+client, logged in as user 1, with metrics off and on. "On" means route
+timing plus a timed subclass for every pooled connection. The feed cache
+is off so every request reaches the database. Then drives the same routes
+from --threads threads and prints, from /metrics, each route's estimated
+p50/p95/p99 and the statements that took the most total time.
+
+    python benchmarks/bench_metrics.py [--rounds N] [--threads N] [--duration S]
+"""
+import argparse
+import contextlib
+import io
+import re
+import statistics
+import time
+
+from _common import cleanup, login_as, make_database, run_load, server, use_database
+import db
+
+ROUTES = ['/api/chat/messages/1', '/api/trades/sent', '/api/items?limit=20']
+SAMPLE = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def parse(text):
+    # name -> [(labels dict, value)]
+    series = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2)))
+            series.setdefault(match.group(1), []).append((labels, float(match.group(3))))
+    return series
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=3.0)
+    args = parser.parse_args()
+
+    path = make_database(n_users=50, n_items=5000, n_trades=200, n_messages=2000)
+    use_database(path)
+    login_as(1)
+    server.feed_cache.enabled = False
+    client = server.app.test_client()
+    timed_factory = db._connection_factory
+    saved_http = server.http_metrics
+
+    def get(url):
+        with contextlib.redirect_stdout(io.StringIO()):
+            resp = client.get(url)
+        assert resp.status_code == 200, (url, resp.status_code)
+
+    try:
+        print(f"{'route':24} {'metrics off':>12} {'on':>10} {'overhead':>10}")
+        for url in ROUTES:
+            results = []
+            for enabled in (False, True):
+                db.set_connection_factory(timed_factory if enabled else None)
+                db.reset_pool(server.app)
+                server.http_metrics = saved_http if enabled else None
+                get(url)
+                results.append(timed(lambda: get(url), args.rounds))
+            off, on = results
+            print(f'{url:24} {off:10.1f}us {on:8.1f}us {on - off:8.1f}us')
+
+        rate = run_load(ROUTES, threads=args.threads, duration=args.duration)
+        print(f'\n{args.threads} threads: {rate:.0f} req/s over {", ".join(ROUTES)}')
+        series = parse(client.get('/metrics').get_data(as_text=True))
+
+        quantiles = {}
+        for labels, value in series.get('http_request_duration_seconds_quantile', []):
+            quantiles.setdefault(labels['route'], {})[labels['quantile']] = value * 1000
+        print(f"\n{'route':24} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for route, qs in sorted(quantiles.items(), key=lambda kv: -kv[1].get('0.99', 0)):
+            print(f"{route:24} {qs['0.5']:6.2f}ms {qs['0.95']:6.2f}ms {qs['0.99']:6.2f}ms")
+
+        counts = {labels['statement']: value for labels, value in series.get('db_statement_duration_seconds_count', [])}
+        sums = series.get('db_statement_duration_seconds_sum', [])
+        print(f"\n{'total':>9} {'calls':>7} {'mean':>9}  statement")
+        for labels, total in sorted(sums, key=lambda item: -item[1])[:8]:
+            statement = labels['statement']
+            calls = counts[statement]
+            print(f'{total * 1000:7.1f}ms {calls:7.0f} {total / calls * 1e6:7.1f}us  {statement[:90]}')
+    finally:
+        db.set_connection_factory(timed_factory)
+        server.http_metrics = saved_http
+        server.feed_cache.enabled = True
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
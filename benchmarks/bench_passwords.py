@@ -0,0 +1,129 @@
+"""Size the password hashing pool for a target login rate.
+
+First times one scrypt hash at a few cost settings and derives how many
+pool workers (cores) a target of --target logins/sec needs. Then it drives
+/api/login from --login-threads threads while --browse-threads threads
+read /api/items?limit=20, for each pool size in --workers. Size 0 hashes
+inline on the request thread with no bound, as an unpooled KDF would. It
+reports logins/sec, logins turned away with 503, and browse throughput and
+p99 next to a browse-only baseline.
+
+    python benchmarks/bench_passwords.py [--target 50] [--workers 0,1,2] [--duration 3]
+"""
+import argparse
+import contextlib
+import io
+import math
+import os
+import statistics
+import threading
+import time
+
+from _common import cleanup, make_database, server
+import passwords
+
+
+def hash_ms(log_n, rounds=5):
+    hasher = passwords.ScryptHasher(log_n=log_n)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hasher.hash('correct horse battery staple')
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def run(duration, login_threads, browse_threads, users):
+    stop = time.monotonic() + duration
+    logins, rejected, failed = [0] * login_threads, [0] * login_threads, []
+    latencies = [[] for _ in range(browse_threads)]
+
+    def login(idx):
+        client = server.app.test_client()
+        n = 0
+        while time.monotonic() < stop:
+            user_id = 1 + (idx + n * login_threads) % users
+            resp = client.post('/api/login', json={'email': f'user{user_id}@example.com', 'password': 'secret123'},
+                               buffered=True)
+            if resp.status_code == 200:
+                logins[idx] += 1
+            elif resp.status_code == 503:
+                rejected[idx] += 1
+                time.sleep(float(resp.headers.get('Retry-After', 1)) / 10)
+            else:
+                failed.append(resp.status_code)
+            n += 1
+
+    def browse(idx):
+        client = server.app.test_client()
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            resp = client.get('/api/items?limit=20', buffered=True)
+            latencies[idx].append((time.perf_counter() - start) * 1000)
+            if resp.status_code != 200:
+                failed.append(resp.status_code)
+
+    threads = ([threading.Thread(target=login, args=(i,)) for i in range(login_threads)]
+               + [threading.Thread(target=browse, args=(i,)) for i in range(browse_threads)])
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.monotonic() - start
+    samples = sorted(ms for per_thread in latencies for ms in per_thread)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] if samples else float('nan')
+    if failed:
+        print(f'  warning: {len(failed)} failed requests (first: {failed[0]})')
+    return sum(logins) / elapsed, sum(rejected), len(samples) / elapsed, p99
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', type=float, default=50, help='logins/sec to size the pool for')
+    parser.add_argument('--log-n', type=int, default=server.app.config['PASSWORD_SCRYPT_LOG_N'])
+    parser.add_argument('--workers', default=f'0,1,2,{os.cpu_count() or 1}')
+    parser.add_argument('--queue', type=int, default=server.app.config['PASSWORD_HASH_QUEUE'])
+    parser.add_argument('--login-threads', type=int, default=16)
+    parser.add_argument('--browse-threads', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=3.0)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f'{cores} CPU core(s); scrypt r=8 p=1')
+    print(f"{'log_n':>5} {'memory':>8} {'per hash':>10} {'per core':>13} {f'cores for {args.target:g}/s':>15}")
+    for log_n in sorted({args.log_n - 1, args.log_n, args.log_n + 1}):
+        ms = hash_ms(log_n)
+        print(f'{log_n:5} {128 * 8 * 2 ** log_n / 2 ** 20:6.0f}MiB {ms:8.1f}ms {1000 / ms:8.1f} logins/s '
+              f'{math.ceil(args.target * ms / 1000):15}')
+
+    saved = server.password_pool
+    hasher = passwords.ScryptHasher(log_n=args.log_n)
+    users = 50
+    path = make_database(n_users=users, n_items=2000, n_trades=10, n_messages=10)
+    try:
+        # Log everyone in once, so the plaintext seed passwords are hashed
+        server.password_pool = passwords.PasswordPool(hasher, workers=0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            client = server.app.test_client()
+            for user_id in range(1, users + 1):
+                client.post('/api/login', json={'email': f'user{user_id}@example.com', 'password': 'secret123'})
+
+        _, _, base_rps, base_p99 = run(args.duration, 0, args.browse_threads, users)
+        print(f'\n{args.login_threads} login threads, {args.browse_threads} browse threads, queue {args.queue}')
+        print(f"{'workers':>7} {'logins/s':>9} {'503s':>6} {'browse req/s':>13} {'browse p99':>11}")
+        print(f"{'-':>7} {'-':>9} {'-':>6} {base_rps:13.0f} {base_p99:9.1f}ms  (no logins)")
+        for workers in map(int, args.workers.split(',')):
+            server.password_pool = passwords.PasswordPool(hasher, workers=workers, queue_size=args.queue)
+            rate, rejected, rps, p99 = run(args.duration, args.login_threads, args.browse_threads, users)
+            server.password_pool.shutdown()
+            label = f'{workers}' if workers else 'inline'
+            print(f'{label:>7} {rate:9.1f} {rejected:6} {rps:13.0f} {p99:9.1f}ms')
+    finally:
+        server.password_pool = saved
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Cost of the rate limiter on the request path.
+
+Times RateLimiter.hit() on its own for each store, with one hot client and
+with --clients distinct ones, from one thread and from --threads threads.
+Then times a bare route through the test client with the limiter off, on
+for an anonymous client and on for a logged-in one, and checks that a
+client over its limit gets 429 with Retry-After.
+
+    python benchmarks/bench_ratelimit.py [--rounds N] [--clients N] [--threads N]
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from flask import jsonify
+
+from _common import cleanup, make_database, server, use_database
+import ratelimit
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def threaded_rate(limiter, threads, rounds, clients):
+    # Checks per second with ``threads`` threads hitting the limiter at once
+    def work(idx):
+        for n in range(rounds):
+            limiter.hit('bench', f'ip:{(idx * rounds + n) % clients}')
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return threads * rounds / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=20000)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    fd, rl_path = tempfile.mkstemp(suffix='.db', prefix='bench_ratelimit_')
+    os.close(fd)
+    # High enough that nothing is refused, so every check does the full work
+    unlimited = '1000000/second'
+    print(f"{'store':8} {'1 client':>10} {f'{args.clients} clients':>15} {f'{args.threads} threads':>18}")
+    try:
+        for name in ('memory', 'sqlite'):
+            store = ratelimit.create_store(name, rl_path)
+            limiter = ratelimit.RateLimiter(store, default=unlimited)
+            hot = timed(lambda: limiter.hit('bench', 'ip:127.0.0.1'), args.rounds)
+            counter = iter(range(10 ** 9))
+            spread = timed(lambda: limiter.hit('bench', f'ip:{next(counter) % args.clients}'), args.rounds)
+            rate = threaded_rate(limiter, args.threads, args.rounds // args.threads, args.clients)
+            print(f'{name:8} {hot:8.2f}us {spread:13.2f}us {rate:11.0f} checks/s')
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(rl_path + suffix)
+
+    server.app.add_url_rule('/bench/ping', 'bench_ping', lambda: jsonify({'ok': True}))
+    saved = server.rate_limiter
+    path = make_database(n_users=10, n_items=10, n_trades=2, n_messages=2)
+    use_database(path)
+    client = server.app.test_client()
+
+    def get(url, token=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            return client.get(url, headers=headers)
+
+    try:
+        with server.app.app_context():
+            token = server.auth_sessions.issue(1)
+        rounds = args.rounds // 4
+        print(f"\n{'limiter':24} {'per request':>12} {'overhead':>10}")
+        server.rate_limiter = ratelimit.RateLimiter(ratelimit.MemoryStore(), enabled=False)
+        off = timed(lambda: get('/bench/ping'), rounds)
+        off_auth = timed(lambda: get('/bench/ping', token), rounds)
+        print(f"{'off':24} {off:10.1f}us")
+        server.rate_limiter = ratelimit.RateLimiter(ratelimit.MemoryStore(), default=unlimited)
+        anon = timed(lambda: get('/bench/ping'), rounds)
+        print(f"{'memory, anonymous':24} {anon:10.1f}us {anon - off:8.1f}us")
+        # The session lookup is shared with the route, so compare against an authenticated request
+        auth = timed(lambda: get('/bench/ping', token), rounds)
+        print(f"{'memory, logged in':24} {auth:10.1f}us {auth - off_auth:8.1f}us")
+
+        server.rate_limiter = ratelimit.RateLimiter(ratelimit.MemoryStore(), {'bench_ping': '5/minute'})
+        statuses = [get('/bench/ping').status_code for _ in range(6)]
+        resp = get('/bench/ping')
+        ok = statuses == [200] * 5 + [429] and resp.status_code == 429 and int(resp.headers['Retry-After']) >= 1
+        other = get('/bench/ping', token).status_code
+        print(f"\n5/minute rule: {statuses}, Retry-After {resp.headers.get('Retry-After')}s, "
+              f"logged-in client {other}: {'ok' if ok and other == 200 else 'FAIL'}")
+    finally:
+        server.rate_limiter = saved
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
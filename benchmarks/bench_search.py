@@ -0,0 +1,156 @@
+"""/api/items/search (FTS5) against a LIKE scan over the same columns.
+
+Seeds a catalog whose titles and descriptions are drawn from a Zipf-like
+vocabulary, trades away 10% of it, then for each query
+
+  * checks the FTS5 result set against a brute-force token match in Python
+    (exit 1 on a mismatch), and
+  * times the first page through the route, the FTS5 query alone and the
+    equivalent LIKE query.
+
+    python benchmarks/bench_search.py [--items N] [--rounds N]
+"""
+import argparse
+import contextlib
+import io
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import time
+
+from _common import cleanup, make_database, server
+
+import search
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vo', 'zen', 'pra', 'sol', 'tri', 'dex', 'nor', 'bel']
+
+# (label, q) from very common to rare; the words are picked from the vocabulary
+QUERIES = [
+    ('common word', lambda v: v[0]),
+    ('mid word', lambda v: v[50]),
+    ('rare word', lambda v: v[2000]),
+    ('two words', lambda v: f'{v[1]} {v[40]}'),
+    ('prefix', lambda v: v[7][:3] + '*'),
+]
+
+# The query behind the route's first page
+FTS_SQL = '''
+    SELECT items.id, hits.rank
+    FROM (SELECT rowid, rank FROM items_fts WHERE items_fts MATCH ? ORDER BY rank, rowid LIMIT 21) AS hits
+    JOIN items ON items.id = hits.rowid
+    JOIN users ON items.user_id = users.id
+    ORDER BY hits.rank, hits.rowid
+'''
+
+
+def vocabulary(rng, size=5000):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda w: rng.random())
+
+
+def seed_text(path, n_items, rng):
+    words = vocabulary(rng)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        'UPDATE items SET title = ?, description = ? WHERE id = ?',
+        (
+            (' '.join(rng.choices(words, weights, k=3)).title(),
+             ' '.join(rng.choices(words, weights, k=20)),
+             item_id)
+            for item_id in range(1, n_items + 1)
+        ),
+    )
+    conn.execute("UPDATE items SET status = 'traded' WHERE id % 10 = 0")
+    conn.commit()
+    conn.close()
+    return words
+
+
+def like_query(q):
+    # Every word must appear in some column, newest first: the best a search
+    # without an index can do. It stops at 21 hits, so common words are
+    # cheap; it cannot rank, and rare words scan the whole table.
+    clauses, params = [], []
+    for word, star in re.findall(r'(\w+)(\*?)', q):
+        clauses.append('(title LIKE ? OR description LIKE ? OR category LIKE ?)')
+        params.extend([f'%{word}%'] * 3)
+    sql = (
+        "SELECT id FROM items WHERE status = 'available' AND " + ' AND '.join(clauses)
+        + ' ORDER BY created_at DESC, id DESC LIMIT 21'
+    )
+    return sql, params
+
+
+def brute_force(conn, q):
+    terms = re.findall(r'(\w+)(\*?)', q.lower())
+    matches = set()
+    for item_id, *columns in conn.execute(
+            "SELECT id, title, description, category FROM items WHERE status = 'available'"):
+        tokens = set(re.findall(r'\w+', ' '.join(columns).lower()))
+        if all(any(t == word or (star and t.startswith(word)) for t in tokens) for word, star in terms):
+            matches.add(item_id)
+    return matches
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    path = make_database(n_items=args.items, n_trades=10, n_messages=10)
+    failures = 0
+    try:
+        start = time.perf_counter()
+        words = seed_text(path, args.items, rng)
+        print(f'{args.items} items re-titled through the FTS triggers in {time.perf_counter() - start:.1f}s')
+
+        conn = sqlite3.connect(path)
+        client = server.app.test_client()
+        print(f"{'query':12} {'q':22} {'hits':>6}   {'route':>9} {'fts5':>9} {'LIKE':>9}")
+        for label, make in QUERIES:
+            q = make(words)
+            match = search.match_expression(q)
+            expected = brute_force(conn, q)
+            found = {row[0] for row in conn.execute(
+                "SELECT rowid FROM items_fts WHERE items_fts MATCH ?", (match,))}
+            if found != expected:
+                failures += 1
+                print(f'  MISMATCH for {q!r}: {len(found)} indexed vs {len(expected)} expected')
+
+            def route():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    resp = client.get('/api/items/search', query_string={'q': q}, buffered=True)
+                assert resp.status_code == 200, resp.data
+
+            sql, params = like_query(q)
+            print(f'{label:12} {q:22} {len(expected):6}   '
+                  f'{timed(route, args.rounds):7.2f}ms '
+                  f'{timed(lambda: conn.execute(FTS_SQL, (match,)).fetchall(), args.rounds):7.2f}ms '
+                  f'{timed(lambda: conn.execute(sql, params).fetchall(), args.rounds):7.2f}ms')
+        conn.close()
+    finally:
+        cleanup(path)
+
+    if failures:
+        print(f'{failures} result set(s) differ from the brute-force match')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
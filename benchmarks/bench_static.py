@@ -0,0 +1,100 @@
+"""/assets/images through StaticFiles against the old send_from_directory route.
+
+Writes files of a few sizes (legacy names and content-addressed names),
+registers the previous implementation under /bench/legacy/ and, for each
+case, reports requests/sec, MB/sec of body and CPU time per request
+(process time, so waiting on the disk is not counted).
+
+Measured through the test client, which has no wsgi.file_wrapper, so both
+sides read the file in Python; under gunicorn or uWSGI the full-file case
+goes through sendfile(2) instead. The offload rows show the cost of a
+response whose bytes a proxy sends.
+
+    python benchmarks/bench_static.py [--seconds S]
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from flask import send_from_directory
+
+from _common import server
+
+SIZES = [('10 KiB', 10 * 1024), ('200 KiB', 200 * 1024), ('5 MiB', 5 * 1024 * 1024)]
+
+
+def measure(client, url, headers, seconds):
+    count = body = 0
+    cpu = time.process_time()
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        resp = client.get(url, headers=headers, buffered=True)
+        assert resp.status_code in (200, 206, 304), (url, resp.status_code)
+        body += len(resp.data)
+        count += 1
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    return count / elapsed, body / elapsed / 1e6, cpu / count * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=1.0, help='per case')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='bench_static_')
+    server.app.add_url_rule(
+        '/bench/legacy/<filename>', 'bench_legacy',
+        lambda filename: send_from_directory(folder, filename),
+    )
+    files = server.image_files
+    saved = files.folder, files.offload
+    files.folder = folder
+    client = server.app.test_client()
+    try:
+        cases = []
+        for label, size in SIZES:
+            data = os.urandom(size)
+            digest = hashlib.sha256(data).hexdigest()
+            for name in (f'legacy_{size}.jpg', f'{digest}.jpg'):
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(data)
+            cases.append((label, size, f'legacy_{size}.jpg', f'{digest}.jpg'))
+
+        print(f"{'case':28} {'before req/s':>13} {'MB/s':>7} {'cpu/req':>8}   "
+              f"{'after req/s':>12} {'MB/s':>7} {'cpu/req':>8}")
+        for label, size, legacy, addressed in cases:
+            etag = client.get(f'/assets/images/{addressed}', buffered=True).headers['ETag']
+            old_etag = client.get(f'/bench/legacy/{addressed}', buffered=True).headers['ETag']
+            rows = [
+                ('full GET', {}, {}),
+                ('revalidation (304)', {'If-None-Match': old_etag}, {'If-None-Match': etag}),
+            ]
+            if size >= 1024 * 1024:
+                one_mib = {'Range': 'bytes=0-1048575'}
+                rows.append(('Range 1 MiB', one_mib, one_mib))
+            for row, old_headers, new_headers in rows:
+                before = measure(client, f'/bench/legacy/{addressed}', old_headers, args.seconds)
+                after = measure(client, f'/assets/images/{addressed}', new_headers, args.seconds)
+                print(f'{label + " " + row:28} {before[0]:13.0f} {before[1]:7.1f} {before[2]:6.3f}ms   '
+                      f'{after[0]:12.0f} {after[1]:7.1f} {after[2]:6.3f}ms')
+            # A legacy name is hashed once, then served from the digest cache
+            legacy_rate = measure(client, f'/assets/images/{legacy}', {}, args.seconds)
+            print(f'{label + " legacy name":28} {"":13} {"":7} {"":8}   '
+                  f'{legacy_rate[0]:12.0f} {legacy_rate[1]:7.1f} {legacy_rate[2]:6.3f}ms')
+
+        for mode in ('x-accel-redirect', 'x-sendfile'):
+            files.offload = mode
+            label, size, _, addressed = cases[-1]
+            rate = measure(client, f'/assets/images/{addressed}', {}, args.seconds)
+            print(f'{label + " " + mode:28} {"":13} {"":7} {"":8}   {rate[0]:12.0f} {"-":>7} {rate[2]:6.3f}ms')
+    finally:
+        files.folder, files.offload = saved
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
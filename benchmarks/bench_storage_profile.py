@@ -0,0 +1,93 @@
+"""Mixed read/write concurrency under each DB_STORAGE_PROFILE.
+
+Writer threads post chat messages while reader threads page through the
+marketplace feed; reports reader throughput, latency percentiles and any
+'database is locked' failures.
+
+    python benchmarks/bench_storage_profile.py [--readers 6] [--writers 2]
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from _common import cleanup, login_as, make_database, server, use_database
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_mixed(readers, writers, duration):
+    stop = time.monotonic() + duration
+    latencies = []
+    writes = [0]
+    failures = {'read': 0, 'write': 0}
+    lock = threading.Lock()
+
+    def reader():
+        client = server.app.test_client()
+        local = []
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            resp = client.get('/api/items')
+            local.append(time.perf_counter() - start)
+            if resp.status_code != 200:
+                with lock:
+                    failures['read'] += 1
+        with lock:
+            latencies.extend(local)
+
+    def writer():
+        client = server.app.test_client()
+        while time.monotonic() < stop:
+            resp = client.post('/api/chat/send', json={'trade_id': 1, 'receiver_id': 2, 'message': 'ping'})
+            with lock:
+                if resp.status_code == 200:
+                    writes[0] += 1
+                else:
+                    failures['write'] += 1
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, writes[0], failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=6)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--items', type=int, default=300)
+    args = parser.parse_args()
+
+    # Measure the database path, not the feed cache
+    server.feed_cache.enabled = False
+    for profile, read_pool in (('default', None), ('tuned', None), ('tuned', args.readers)):
+        # Separate files: journal_mode=WAL persists in the database file
+        server.app.config['DB_STORAGE_PROFILE'] = profile
+        server.app.config['DB_READ_POOL_SIZE'] = None
+        path = make_database(n_items=args.items)
+        try:
+            use_database(path, DB_STORAGE_PROFILE=profile, DB_READ_POOL_SIZE=read_pool)
+            login_as(1)
+            latencies, writes, failures = run_mixed(args.readers, args.writers, args.duration)
+        finally:
+            cleanup(path)
+        label = f'{profile} + read pool' if read_pool else profile
+        print(f'{label}')
+        print(f'  reads/s  {len(latencies) / args.duration:10.1f}   writes/s {writes / args.duration:8.1f}')
+        print(f'  read p50 {statistics.median(latencies) * 1000:8.2f}ms  p99 {percentile(latencies, 99) * 1000:8.2f}ms'
+              f'  max {max(latencies) * 1000:8.2f}ms')
+        print(f'  failures {failures}')
+
+
+if __name__ == '__main__':
+    main()
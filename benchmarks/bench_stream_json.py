@@ -0,0 +1,111 @@
+"""Peak memory of an unbounded list response, buffered vs streamed.
+
+Seeds a catalog (1M items by default) and fetches the full list once in a
+fresh process per mode, sampling peak resident memory from a clean
+baseline. Heap and file-backed (SQLite mmap) memory are reported apart.
+
+    python benchmarks/bench_stream_json.py [--items N] [--path /api/items?legacy=1]
+"""
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import sys
+import threading
+import time
+
+from _common import cleanup, login_as, make_database, server, use_database
+
+MODES = {'buffered': False, 'streamed': True}
+
+
+def rss_kib():
+    # Anonymous (heap) and file-backed resident memory; SQLite's mmap of the
+    # database shows up as the latter and is reclaimable page cache.
+    fields = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('RssAnon:', 'RssFile:')):
+                name, value = line.split(':')
+                fields[name] = int(value.split()[0])
+    return fields['RssAnon'], fields['RssFile']
+
+
+class PeakSampler(threading.Thread):
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.baseline = rss_kib()
+        self.peak = self.baseline
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak = tuple(map(max, self.peak, rss_kib()))
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        return [(peak - base) / 1024 for peak, base in zip(self.peak, self.baseline)]
+
+
+def measure(path, url, mode):
+    use_database(path, STREAM_LARGE_LISTS=MODES[mode])
+    login_as(1)
+    client = server.app.test_client()
+    sampler = PeakSampler()
+    sampler.start()
+    size = 0
+    first_byte = None
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        resp = client.get(url, buffered=False)
+        for chunk in resp.response:
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+        resp.close()
+    elapsed = time.perf_counter() - start
+    anon, file_backed = sampler.stop()
+    return {
+        'status': resp.status_code,
+        'bytes': size,
+        'ttfb_ms': (first_byte or 0) * 1000,
+        'total_ms': elapsed * 1000,
+        'peak_anon_mib': anon,
+        'peak_file_mib': file_backed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=1_000_000)
+    parser.add_argument('--path', default='/api/items?legacy=1')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'DB'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, path = args.child
+        print(json.dumps(measure(path, args.path, mode)))
+        return
+
+    print(f'seeding {args.items} items...')
+    path = make_database(n_items=args.items, n_trades=10, n_messages=10)
+    try:
+        print(f'GET {args.path}')
+        for mode in MODES:
+            out = subprocess.run(
+                [sys.executable, __file__, '--path', args.path, '--child', mode, path],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            r = json.loads(out.splitlines()[-1])
+            print(f"  {mode:9} status {r['status']}  {r['bytes'] / 2 ** 20:7.1f} MiB body  "
+                  f"peak heap +{r['peak_anon_mib']:7.1f} MiB  mmap +{r['peak_file_mib']:5.1f} MiB  "
+                  f"first byte {r['ttfb_ms']:8.1f} ms  total {r['total_ms']:8.1f} ms")
+    finally:
+        cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""/api/trades against the /api/trades/sent + /api/trades/received pair.
+
+Seeds a user with --trades historical trades, half sent and half received,
+spread over time and statuses, with --messages chat messages addressed to
+them, about a third of them unread. Then
+
+  * walks /api/trades page by page and checks that the pages hold every
+    trade exactly once, in the order of the two old lists merged, and
+    that the unread counts match a direct count (exit 1 on a mismatch),
+  * counts the statements a page runs against trades, which should be one,
+  * times the inbox as the app opens it today (both old routes) and as
+    first pages of /api/trades with and without filters and unread counts.
+
+    python benchmarks/bench_trades.py [--trades N] [--messages N] [--rounds N]
+"""
+import argparse
+import contextlib
+import io
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+from _common import cleanup, db, login_as, make_database, server
+from pagination import encode_cursor
+
+import trades
+
+PAGES = [
+    ('first page', '/api/trades?limit=20'),
+    ('first page, unread', '/api/trades?limit=20&unread=1'),
+    ('received, unread', '/api/trades?role=received&limit=20&unread=1'),
+    ('pending, unread', '/api/trades?status=pending&limit=20&unread=1'),
+    ('page of 100', '/api/trades?limit=100&unread=1'),
+]
+
+
+def seed_history(path, n_trades, rng):
+    # One trade a minute back from now, mostly finished ones
+    statuses = rng.choices(trades.STATUSES, weights=[5, 20, 15, 50, 10], k=n_trades)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "UPDATE trades SET created_at = datetime('now', ?), status = ? WHERE id = ?",
+        ((f'-{n_trades - i} minutes', statuses[i - 1], i) for i in range(1, n_trades + 1)),
+    )
+    # Every seeded trade involves user 1; address the messages to them
+    conn.execute('UPDATE chat_messages SET receiver_id = 1, sender_id = 2, is_read = (id % 3 != 0)')
+    conn.commit()
+    conn.close()
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trades', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    path = make_database(n_items=5000, n_trades=args.trades, n_messages=args.messages)
+    seed_history(path, args.trades, random.Random(2))
+    login_as(1)
+    client = server.app.test_client()
+    failures = []
+
+    def get(url):
+        with contextlib.redirect_stdout(io.StringIO()):
+            resp = client.get(url)
+        assert resp.status_code == 200, (url, resp.status_code, resp.get_data(as_text=True)[:200])
+        return resp.get_json()
+
+    try:
+        old = get('/api/trades/sent') + get('/api/trades/received')
+        expected = [t['id'] for t in sorted(old, key=trades.sort_key, reverse=True)]
+        walked, url, pages = [], '/api/trades?limit=100&unread=1', 0
+        while url:
+            body = get(url)
+            walked.extend(body['trades'])
+            pages += 1
+            url = f"/api/trades?limit=100&unread=1&cursor={body['next_cursor']}" if body['next_cursor'] else None
+        if [t['id'] for t in walked] != expected:
+            failures.append('paged /api/trades differs from the old lists merged')
+
+        conn = sqlite3.connect(path)
+        unread = dict(conn.execute(
+            'SELECT trade_id, count(*) FROM chat_messages WHERE receiver_id = 1 AND NOT is_read GROUP BY trade_id'))
+        conn.close()
+        if any(t['unread_count'] != unread.get(t['id'], 0) for t in walked):
+            failures.append('unread counts differ from a direct count')
+        print(f'{len(walked)} trades in {pages} pages, {sum(unread.values())} unread messages: '
+              f"{'FAIL' if failures else 'ok'}")
+
+        statements = []
+
+        def trace(conn):
+            conn.set_trace_callback(statements.append)
+
+        db.add_connect_hook(trace)
+        db.reset_pool(server.app)
+        try:
+            get(PAGES[1][1])
+        finally:
+            db.remove_connect_hook(trace)
+            db.reset_pool(server.app)
+        on_trades = [sql for sql in statements if 'FROM trades' in sql]
+        print(f'statements reading trades for one page: {len(on_trades)}')
+        if len(on_trades) != 1:
+            failures.append(f'{len(on_trades)} statements for one page')
+
+        def inbox():
+            get('/api/trades/sent')
+            get('/api/trades/received')
+
+        print(f"\n{'request':34} {'median':>10}")
+        print(f"{'sent + received (old inbox)':34} {timed(inbox, max(args.rounds // 10, 5)) / 1000:8.2f}ms")
+        for label, url in PAGES:
+            print(f'{label:34} {timed(lambda: get(url), args.rounds) / 1000:8.2f}ms')
+        middle = encode_cursor(trades.sort_key(walked[len(walked) // 2]))
+        deep = f'/api/trades?limit=20&unread=1&cursor={middle}'
+        print(f"{'page from the middle, unread':34} {timed(lambda: get(deep), args.rounds) / 1000:8.2f}ms")
+    finally:
+        cleanup(path)
+
+    if failures:
+        for failure in failures:
+            print(f'FAIL {failure}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
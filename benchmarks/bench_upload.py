@@ -0,0 +1,199 @@
+"""Peak memory and disk writes of concurrent uploads, per upload mode.
+
+Starts the app in a child process (werkzeug's threaded server, image
+pipeline off), sends --concurrency uploads of --size bytes at once over
+HTTP from this process, and samples the child's resident heap (RssAnon)
+and its bytes written to disk (/proc/<pid>/io). Modes:
+
+  legacy      STREAMING_UPLOADS off: request.files spools the multipart
+              body, then the store copies it
+  multipart   the streaming multipart parser
+  raw         the file as the request body (Content-Type: image/jpeg)
+  resumable   POST /api/uploads, then PATCH in --chunk-size pieces
+
+    python benchmarks/bench_upload.py [--size MiB] [--concurrency N] [--chunk-size MiB]
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from _common import cleanup, make_database
+
+MODES = ['legacy', 'multipart', 'raw', 'resumable']
+BLOCK = 64 * 1024
+BOUNDARY = 'benchboundary7MA4YWxkTrZu0gW'
+
+
+def proc_kib(pid, field):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def written_bytes(pid):
+    with open(f'/proc/{pid}/io') as f:
+        for line in f:
+            if line.startswith('write_bytes:'):
+                return int(line.split()[1])
+
+
+def serve(mode, port, database, folder):
+    import server
+    from _common import use_database
+
+    use_database(database, STREAMING_UPLOADS=mode != 'legacy')
+    for component in (server.content_store, server.image_files):
+        component.folder = folder
+    server.app.config['UPLOAD_FOLDER'] = folder
+    server.image_pipeline.shutdown()
+    server.image_pipeline._executor = None
+    from werkzeug.serving import make_server
+    httpd = make_server('127.0.0.1', port, server.app, threaded=True)
+    print('ready', flush=True)
+    httpd.serve_forever()
+
+
+def body_blocks(size, seed):
+    # A JPEG signature, then distinct bytes per upload so nothing is deduplicated
+    block = os.urandom(BLOCK)
+    yield b'\xff\xd8\xff\xe0' + seed.to_bytes(8, 'big') + block[12:]
+    sent = BLOCK
+    while sent < size:
+        yield block[:min(BLOCK, size - sent)]
+        sent += BLOCK
+
+
+def request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        data = resp.read()
+        if resp.status >= 300:
+            raise RuntimeError(f'{method} {path}: {resp.status} {data[:200]!r}')
+        return json.loads(data)
+    finally:
+        conn.close()
+
+
+def upload(mode, port, size, chunk_size, seed):
+    if mode in ('legacy', 'multipart'):
+        head = (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="image"; filename="photo.jpg"\r\n'
+                f'Content-Type: image/jpeg\r\n\r\n').encode()
+        tail = f'\r\n--{BOUNDARY}--\r\n'.encode()
+
+        def body():
+            yield head
+            yield from body_blocks(size, seed)
+            yield tail
+
+        return request(port, 'POST', '/api/upload', body(), {
+            'Content-Type': f'multipart/form-data; boundary={BOUNDARY}',
+            'Content-Length': str(len(head) + size + len(tail)),
+        })
+    if mode == 'raw':
+        return request(port, 'POST', '/api/upload', body_blocks(size, seed),
+                       {'Content-Type': 'image/jpeg', 'Content-Length': str(size)})
+
+    session = request(port, 'POST', '/api/uploads', json.dumps({'length': size}),
+                      {'Content-Type': 'application/json'})
+    blocks = body_blocks(size, seed)
+    offset = 0
+    while offset < size:
+        piece = min(chunk_size, size - offset)
+
+        def chunk(remaining=piece):
+            while remaining > 0:
+                block = next(blocks)
+                yield block
+                remaining -= len(block)
+
+        status = request(port, 'PATCH', f"/api/uploads/{session['uploadId']}", chunk(), {
+            'Content-Type': 'application/offset+octet-stream',
+            'Content-Length': str(piece),
+            'Upload-Offset': str(offset),
+        })
+        offset = status['offset']
+    return status
+
+
+def measure(mode, args, database):
+    folder = tempfile.mkdtemp(prefix='bench_upload_')
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    child = subprocess.Popen(
+        [sys.executable, __file__, '--serve', mode, str(port), database, folder],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    )
+    try:
+        assert child.stdout.readline().strip() == 'ready'
+        # One upload first, so lazy imports and the connection pool are warm
+        upload(mode, port, 1024 * 1024, args.chunk_size, seed=0)
+        base_rss = proc_kib(child.pid, 'RssAnon')
+        base_written = written_bytes(child.pid)
+        peak = base_rss
+        errors = []
+
+        def worker(i):
+            try:
+                upload(mode, port, args.size, args.chunk_size, seed=i + 1)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads):
+            peak = max(peak, proc_kib(child.pid, 'RssAnon'))
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+        written = written_bytes(child.pid) - base_written
+        return (peak - base_rss) / 1024, written / args.concurrency / args.size, elapsed
+    finally:
+        child.terminate()
+        child.wait()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=15, help='MiB per upload')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--chunk-size', type=float, default=4, help='MiB per PATCH')
+    parser.add_argument('--serve', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        mode, port, database, folder = args.serve
+        serve(mode, int(port), database, folder)
+        return
+
+    args.size = int(args.size * 1024 * 1024)
+    args.chunk_size = int(args.chunk_size * 1024 * 1024)
+    database = make_database(n_items=10, n_trades=2, n_messages=2)
+    try:
+        print(f'{args.concurrency} concurrent uploads of {args.size / 2 ** 20:.1f} MiB')
+        print(f"{'mode':10} {'peak heap':>10} {'per upload':>11} {'disk writes':>12} {'wall':>8}")
+        for mode in MODES:
+            peak, amplification, elapsed = measure(mode, args, database)
+            print(f'{mode:10} {peak:8.1f}MiB {peak / args.concurrency:9.2f}MiB '
+                  f'{amplification:10.2f}x {elapsed:7.2f}s')
+    finally:
+        cleanup(database)
+
+
+if __name__ == '__main__':
+    main()
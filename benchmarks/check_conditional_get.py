@@ -0,0 +1,192 @@
+"""Conditional GET check for the cached JSON list routes.
+
+Revalidates /api/items, /api/user/items, /api/trades/sent,
+/api/trades/received and /api/trades?unread=1 with If-None-Match and
+checks that
+
+  * an unchanged list answers 304 without running its main query,
+  * every kind of write the list depends on (through the routes or straight
+    into the database, as another worker would) changes the ETag,
+  * validators are per user and per query string,
+  * a write from outside the process is not answered from the feed cache,
+
+then times a 200 against a 304 for each route. Exits 1 on any failure.
+
+    python benchmarks/check_conditional_get.py [--items N] [--rounds N]
+"""
+import argparse
+import contextlib
+import io
+import sqlite3
+import sys
+import time
+
+from _common import cleanup, db, login_as, make_database, server
+
+# Its unread counts also depend on chat_messages
+TRADES = '/api/trades?unread=1'
+
+ROUTES = ['/api/items', '/api/user/items', '/api/trades/sent', '/api/trades/received', TRADES]
+
+failures = []
+
+
+def check(ok, message):
+    print(f"  {'ok  ' if ok else 'FAIL'} {message}")
+    if not ok:
+        failures.append(message)
+
+
+class StatementLog:
+    """Records every statement run on pooled connections."""
+
+    def __init__(self):
+        self.statements = []
+        db.add_connect_hook(self._hook)
+
+    def _hook(self, conn):
+        conn.set_trace_callback(self.statements.append)
+
+    def close(self):
+        db.remove_connect_hook(self._hook)
+
+
+def quiet():
+    # The app prints every request
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def get(client, path, etag=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    with quiet():
+        return client.get(path, headers=headers, buffered=True)
+
+
+def etags(client):
+    return {path: get(client, path).headers.get('ETag') for path in ROUTES}
+
+
+def changed(before, after):
+    return {path for path in ROUTES if before[path] != after[path]}
+
+
+def write_directly(path, sql, params=()):
+    # A write from another process: no cache invalidation hooks run
+    conn = sqlite3.connect(path)
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def correctness(path, client):
+    print('correctness')
+    for route in ROUTES:
+        first = get(client, route)
+        etag = first.headers.get('ETag')
+        check(first.status_code == 200 and etag and first.headers.get('Last-Modified'),
+              f'{route} sends ETag and Last-Modified')
+        again = get(client, route, etag)
+        check(again.status_code == 304 and not again.data, f'{route} revalidates to 304')
+        check(get(client, route, '"stale"').status_code == 200, f'{route} ignores a stale ETag')
+
+    log = StatementLog()
+    db.reset_pool(server.app)  # new connections pick up the trace hook
+    for route in ROUTES:
+        etag = get(client, route).headers['ETag']
+        log.statements.clear()
+        get(client, route, etag)
+        # Besides the session lookup of the logged-in user
+        queries = [s for s in log.statements if s.lstrip().upper().startswith('SELECT') and 'FROM sessions' not in s]
+        check(len(queries) == 1 and 'table_versions' in queries[0],
+              f'{route} 304 only reads table_versions ({len(queries)} SELECTs)')
+    log.close()
+    db.reset_pool(server.app)
+
+    check(get(client, '/api/items?limit=5').headers['ETag'] != get(client, '/api/items').headers['ETag'],
+          'query string is part of the ETag')
+    mine = get(client, '/api/user/items').headers['ETag']
+    login_as(2)
+    check(get(client, '/api/user/items').headers['ETag'] != mine, 'ETag is per user')
+    login_as(1)
+
+    writes = [
+        ('POST /api/items', lambda: client.post('/api/items', json={
+            'title': 'new', 'category': 'Books', 'price': 1, 'description': 'd',
+            'imageUrl': 'assets/images/new.jpg'}), set(ROUTES)),
+        ('POST /api/trade/1/status', lambda: client.post('/api/trade/1/status', json={'status': 'cancelled'}),
+         {'/api/trades/sent', '/api/trades/received', TRADES}),
+        ('POST /update-avatar', lambda: client.post('/update-avatar', json={
+            'avatar_url': 'assets/avatars/png/3d_2.png'}),
+         {'/api/items', '/api/trades/sent', '/api/trades/received', TRADES}),
+        ('direct UPDATE items', lambda: write_directly(
+            path, "UPDATE items SET price = price + 1 WHERE id = 1"), set(ROUTES)),
+        ('direct INSERT trades', lambda: write_directly(
+            path, 'INSERT INTO trades (item1_id, item2_id, sender_id, receiver_id) VALUES (1, 2, 3, 4)'),
+         {'/api/trades/sent', '/api/trades/received', TRADES}),
+        ('direct DELETE users', lambda: write_directly(path, 'DELETE FROM users WHERE id = 50'),
+         {'/api/items', '/api/trades/sent', '/api/trades/received', TRADES}),
+        ('chat message', lambda: client.post('/api/chat/send', json={
+            'trade_id': 1, 'receiver_id': 2, 'message': 'hi'}), {TRADES}),
+    ]
+    # Another worker's write: the feed cache of this process must not answer
+    # the new ETag with the body it cached under the old one
+    listed = get(client, '/api/items').get_json()['items'][0]['id']
+    get(client, f'/api/items/{listed}')
+    write_directly(path, "UPDATE items SET status = 'traded' WHERE id = ?", (listed,))
+    page = get(client, '/api/items').get_json()['items']
+    check(listed not in [item['id'] for item in page], 'item traded elsewhere leaves the cached feed page')
+    check(get(client, f'/api/items/{listed}').get_json()['status'] == 'traded',
+          'item traded elsewhere is not served from the cached detail')
+
+    for name, write, expected in writes:
+        before = etags(client)
+        with quiet():
+            write()
+        after = etags(client)
+        check(changed(before, after) == expected,
+              f'{name} changes {sorted(expected) or "nothing"}')
+        # A changed validator means the old one no longer yields a 304
+        for route in expected:
+            if get(client, route, before[route]).status_code != 200:
+                check(False, f'{name}: stale ETag still 304 on {route}')
+
+
+def timing(client, rounds):
+    print(f'timing ({rounds} requests each)')
+    server.feed_cache.enabled = False
+    for route in ROUTES:
+        etag = get(client, route).headers['ETag']
+        results = []
+        for header in (None, etag):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                resp = get(client, route, header)
+            results.append(((time.perf_counter() - start) / rounds * 1000, len(resp.data)))
+        (full_ms, full_bytes), (cond_ms, _) = results
+        print(f'  {route:22} 200: {full_ms:6.2f} ms {full_bytes:7} B   304: {cond_ms:6.2f} ms')
+    server.feed_cache.enabled = server.app.config['FEED_CACHE_ENABLED']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    path = make_database(n_items=args.items)
+    try:
+        login_as(1)
+        client = server.app.test_client()
+        correctness(path, client)
+        timing(client, args.rounds)
+    finally:
+        cleanup(path)
+
+    if failures:
+        print(f'{len(failures)} check(s) failed')
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
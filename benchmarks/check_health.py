@@ -0,0 +1,112 @@
+"""Health probe and load shedding check.
+
+Checks that
+
+  * /api/health/ready (and /api/health) answer 200 with every check ok on
+    a healthy node, and /api/health/live answers 200,
+  * readiness turns 503 while another connection holds the write lock,
+    when the upload folder cannot be written, and when requests in
+    progress reach READY_MAX_IN_FLIGHT, while liveness stays 200,
+  * at MAX_IN_FLIGHT other requests are refused with 503 and Retry-After,
+    and counted as shed, but the probes still answer,
+  * the in-flight count is back to zero after requests that succeed, 404
+    or are shed.
+
+Exits 1 on any failure.
+
+    python benchmarks/check_health.py
+"""
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+
+from _common import cleanup, login_as, make_database, server
+
+failures = []
+
+
+def check(ok, message):
+    print(f"  {'ok  ' if ok else 'FAIL'} {message}")
+    if not ok:
+        failures.append(message)
+
+
+def main():
+    path = make_database(n_items=200, n_trades=20, n_messages=20)
+    client = server.app.test_client()
+    in_flight = server.in_flight
+    saved_upload = server.app.config['UPLOAD_FOLDER']
+
+    def get(url):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return client.get(url)
+
+    def ready():
+        server.readiness.invalidate()
+        return get('/api/health/ready')
+
+    try:
+        login_as(1)
+        resp = ready()
+        body = resp.get_json()
+        check(resp.status_code == 200 and body['status'] == 'healthy', 'ready on a healthy node')
+        check(all(c['ok'] for c in body['checks'].values()), f"checks: {', '.join(body['checks'])}")
+        check(get('/api/health').status_code == 200, '/api/health is the readiness probe')
+        check(get('/api/health/live').status_code == 200, 'live on a healthy node')
+
+        writer = sqlite3.connect(path, isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        try:
+            resp = ready()
+            database = resp.get_json()['checks']['database']
+            check(resp.status_code == 503 and 'locked' in database.get('error', ''),
+                  f"not ready while the write lock is held ({database.get('error')})")
+            check(resp.headers.get('Retry-After') is not None, 'unavailable sets Retry-After')
+            check(get('/api/health/live').status_code == 200, 'still live while the write lock is held')
+        finally:
+            writer.execute('ROLLBACK')
+            writer.close()
+        check(ready().status_code == 200, 'ready again once the lock is released')
+
+        server.app.config['UPLOAD_FOLDER'] = os.path.join(tempfile.gettempdir(), 'check_health_missing', 'images')
+        resp = ready()
+        check(resp.status_code == 503 and not resp.get_json()['checks']['uploads']['ok'],
+              'not ready with an unwritable upload folder')
+        server.app.config['UPLOAD_FOLDER'] = saved_upload
+
+        in_flight.count = server.app.config['READY_MAX_IN_FLIGHT']
+        resp = ready()
+        check(resp.status_code == 503 and not resp.get_json()['checks']['in_flight']['ok'],
+              f'not ready at {in_flight.count} requests in progress')
+        check(get('/api/items?limit=5').status_code == 200, 'requests still served under MAX_IN_FLIGHT')
+
+        in_flight.count = server.app.config['MAX_IN_FLIGHT']
+        shed = in_flight.shed
+        resp = get('/api/items?limit=5')
+        check(resp.status_code == 503 and resp.headers.get('Retry-After') == '1',
+              f'shed with 503 at {in_flight.count} requests in progress')
+        check(in_flight.shed == shed + 1, 'shed requests are counted')
+        check(get('/api/health/live').status_code == 200, 'liveness answers at MAX_IN_FLIGHT')
+        check(ready().status_code == 503, 'readiness answers at MAX_IN_FLIGHT')
+        in_flight.count = 0
+
+        for url in ('/api/items?limit=5', '/api/trades/sent', '/api/no-such-route'):
+            get(url)
+        check(in_flight.count == 0, f'nothing left in flight (peak {in_flight.peak})')
+    finally:
+        server.app.config['UPLOAD_FOLDER'] = saved_upload
+        in_flight.count = 0
+        server.readiness.invalidate()
+        cleanup(path)
+
+    if failures:
+        print(f'{len(failures)} check(s) failed')
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Slow-query log and request profiler check.
+
+Turns the profiler on with a token, as PROFILE_ENABLED and PROFILE_TOKEN
+would, and sets the slow-query threshold to zero. Then checks that
+
+  * a request with the right X-Profile token is profiled and dumped as
+    folded stacks, while one without the header or with a wrong token is
+    not,
+  * /debug/profile needs the token, and lists /api/trades/received with
+    its hottest frames, and serves the merged stacks as text,
+  * with no PROFILE_TOKEN set, X-Profile and /debug/profile are refused
+    whatever the header says,
+  * statements slower than the threshold are recorded with their query
+    plan, and nothing is recorded above a threshold no statement reaches.
+
+Then prints where /api/trades/received spends its samples. Exits 1 on any
+failure.
+
+    python benchmarks/check_profiling.py [--requests N] [--trades N]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+from _common import cleanup, login_as, make_database, server
+import profiling
+
+ROUTE = '/api/trades/received'
+TOKEN = 'check-profiling'
+
+failures = []
+
+
+def check(ok, message):
+    print(f"  {'ok  ' if ok else 'FAIL'} {message}")
+    if not ok:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--trades', type=int, default=2000)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='bench_profiles_')
+    saved = server.request_profiler, server.app.config['PROFILE_TOKEN'], server.slow_query_log.threshold
+    server.request_profiler = profiling.SamplingProfiler(folder, interval=0.001)
+    server.app.config['PROFILE_TOKEN'] = TOKEN
+    server.feed_cache.enabled = False
+    path = make_database(n_items=5000, n_trades=args.trades)
+    try:
+        login_as(1)
+        client = server.app.test_client()
+
+        def get(url, **headers):
+            with contextlib.redirect_stdout(io.StringIO()):
+                return client.get(url, headers=headers)
+
+        get(ROUTE)
+        get(ROUTE, **{'X-Profile': 'wrong'})
+        check(not os.listdir(folder), 'requests without the token are not profiled')
+        for _ in range(args.requests):
+            get(ROUTE, **{'X-Profile': TOKEN})
+        dumps = os.listdir(folder)
+        check(len(dumps) > 0, f'{len(dumps)} folded stack file(s) for {args.requests} profiled requests')
+        with open(os.path.join(folder, dumps[0])) as f:
+            lines = f.read().splitlines()
+        check(all(line.rsplit(' ', 1)[1].isdigit() for line in lines), 'dumps are in the folded format')
+
+        check(get('/debug/profile').status_code == 401, '/debug/profile needs the token')
+        summary = get('/debug/profile', **{'X-Profile': TOKEN}).get_json()
+        endpoint = summary['profiles']['endpoints'].get('get_received_trades')
+        check(endpoint is not None and endpoint['requests'] == args.requests,
+              '/debug/profile counts every profiled request')
+        folded = get('/debug/profile?format=folded&endpoint=get_received_trades', **{'X-Profile': TOKEN})
+        check('get_received_trades' in folded.get_data(as_text=True), 'merged stacks include the route')
+
+        server.app.config['PROFILE_TOKEN'] = None
+        profiled = len(os.listdir(folder))
+        get(ROUTE, **{'X-Profile': TOKEN})
+        check(len(os.listdir(folder)) == profiled, 'X-Profile is refused with no token set')
+        check(get('/debug/profile', **{'X-Profile': TOKEN}).status_code == 401,
+              '/debug/profile is refused with no token set')
+        server.app.config['PROFILE_TOKEN'] = TOKEN
+
+        server.slow_query_log.threshold = 0.0
+        server.slow_query_log.recent.clear()
+        get(ROUTE)
+        slow = server.slow_query_log.stats()
+        check(any(entry['plan'] for entry in slow), f'{len(slow)} slow statement(s) logged with query plans')
+        server.slow_query_log.threshold = 3600.0
+        server.slow_query_log.recent.clear()
+        get(ROUTE)
+        check(not server.slow_query_log.stats(), 'nothing logged under the threshold')
+
+        if endpoint:
+            print(f"\n{ROUTE}: {endpoint['samples']} samples over {endpoint['requests']} requests")
+            print('  most samples, own time:')
+            for frame, count in endpoint['self'][:8]:
+                print(f'    {count:6}  {frame}')
+            print('  most samples, including callees (own code only):')
+            own = [(frame, count) for frame, count in endpoint['inclusive'] if 'server.py' in frame]
+            for frame, count in own[:8]:
+                print(f'    {count:6}  {frame}')
+        for entry in slow:
+            print(f"  {entry['ms']:7.2f}ms  {entry['statement'][:70]}\n             plan: {entry['plan']}")
+    finally:
+        server.request_profiler, server.app.config['PROFILE_TOKEN'], server.slow_query_log.threshold = saved
+        server.feed_cache.enabled = True
+        shutil.rmtree(folder, ignore_errors=True)
+        cleanup(path)
+
+    if failures:
+        print(f'{len(failures)} check(s) failed')
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""EXPLAIN QUERY PLAN regression check for the route queries.
+
+Drives every database-backed route through the test client against a seeded
+database, records each statement the pool executes, and fails (exit status 1)
+if any of them makes SQLite fall back to a full table SCAN.
+
+    python benchmarks/check_query_plans.py [-v]
+"""
+import argparse
+import contextlib
+import io
+import re
+import sqlite3
+import sys
+
+from _common import cleanup, db, login_as, make_database, server, use_database
+from pagination import encode_cursor
+
+# Continuation token pointing past the newest row, to plan the keyset branch
+CURSOR = encode_cursor(['9999-12-31 00:00:00', 2 ** 31])
+RANK_CURSOR = encode_cursor([-1e9, 0])
+
+# Statements that are expected to read the whole table
+ALLOWED_SCANS = [
+    re.compile(r'^SELECT id, firstname, lastname, email, created_at FROM users$'),  # /api/users
+    re.compile(r"^SELECT .* FROM 'main'\.'\w+_fts_config'"),  # FTS5 loading its settings
+    re.compile(r'^SELECT category, price_bucket, count FROM item_facet_counts '),  # categories x buckets
+]
+
+FTS_MATCH = re.compile(r' VIRTUAL TABLE INDEX \d+:M')
+
+# (method, path, json body) run as user 1, the sender of trade 1
+REQUESTS = [
+    ('GET', '/api/get-user', None),
+    ('GET', '/api/items', None),
+    ('GET', f'/api/items?cursor={CURSOR}', None),
+    ('GET', '/api/items?legacy=1', None),
+    ('GET', '/api/items?category=Books', None),
+    ('GET', '/api/items?category=Books&category=Toys&sort=price_asc', None),
+    ('GET', f'/api/items?min_price=100&max_price=200&sort=price_desc&cursor={CURSOR}', None),
+    ('GET', '/api/items?category=Books&min_price=100&max_price=200', None),
+    ('GET', '/api/items?sort=oldest&exclude_self=1&facets=1', None),
+    ('GET', '/api/items/others', None),
+    ('GET', f'/api/items/others?cursor={CURSOR}', None),
+    ('GET', '/api/items/user/2', None),
+    ('GET', f'/api/items/user/2?cursor={CURSOR}', None),
+    ('GET', '/api/items/1', None),
+    ('GET', '/api/items/search?q=item+1*', None),
+    ('GET', f'/api/items/search?q=item&cursor={RANK_CURSOR}', None),
+    ('GET', '/api/user/items', None),
+    ('GET', '/api/users', None),
+    ('GET', '/api/chat/messages/1', None),
+    ('GET', '/api/chat/messages/1?after_id=10&limit=50', None),
+    ('GET', '/api/trades/sent', None),
+    ('GET', '/api/trades/received', None),
+    ('GET', '/api/trades', None),
+    ('GET', f'/api/trades?role=all&status=pending&unread=1&cursor={CURSOR}', None),
+    ('GET', f'/api/trades?role=received&unread=1&cursor={CURSOR}', None),
+    ('GET', '/api/trades?role=sent&status=accepted', None),
+    ('POST', '/api/chat/send', {'trade_id': 1, 'receiver_id': 2, 'message': 'plan check'}),
+    ('POST', '/api/trade/check', {'requested_item_id': 2, 'receiver_id': 2}),
+    ('POST', '/api/items', {'title': 't', 'category': 'Books', 'price': 1, 'description': 'd',
+                            'imageUrl': 'assets/images/t.jpg'}),
+    ('POST', '/api/trade/1/status', {'status': 'pending'}),
+    ('POST', '/update-avatar', {'avatar_url': 'assets/avatars/png/3d_1.png'}),
+    ('POST', '/api/change-password', {'password': 'secret123'}),
+    ('POST', '/api/login', {'email': 'user1@example.com', 'password': 'secret123'}),
+    ('POST', '/api/logout', None),
+]
+
+
+def normalize(sql):
+    return ' '.join(sql.split())
+
+
+def full_scans(plan):
+    # Reading back a materialized subquery is not a table scan, and FTS5
+    # reports a MATCH lookup as "SCAN <table> VIRTUAL TABLE INDEX n:M..."
+    subqueries = {step.split(' ', 1)[1] for step in plan if step.startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+    return [
+        step for step in plan
+        if step.startswith('SCAN ') and step != 'SCAN CONSTANT ROW'
+        and step[5:] not in subqueries and not FTS_MATCH.search(step)
+    ]
+
+
+def is_allowed(sql):
+    return any(pattern.match(sql) for pattern in ALLOWED_SCANS)
+
+
+def collect_statements():
+    statements = []
+
+    def hook(conn):
+        conn.set_trace_callback(statements.append)
+
+    db.add_connect_hook(hook)
+    try:
+        db.reset_pool(server.app)
+        client = server.app.test_client()
+        # Sessions of other users too, so ANALYZE sees them spread out as in production
+        for user_id in range(2, 51):
+            login_as(user_id)
+        for method, path, body in REQUESTS:
+            login_as(1)
+            with contextlib.redirect_stdout(io.StringIO()):
+                resp = client.open(path, method=method, json=body, buffered=True)
+            if resp.status_code >= 500:
+                print(f'{method} {path} failed with {resp.status_code}: {resp.get_data(as_text=True)[:200]}')
+    finally:
+        db.remove_connect_hook(hook)
+        db.reset_pool(server.app)
+    return statements
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    path = make_database(n_items=2000, n_trades=200, n_messages=1000)
+    try:
+        use_database(path)
+        statements = collect_statements()
+        conn = sqlite3.connect(path)
+        conn.execute('ANALYZE')
+        failures = []
+        seen = set()
+        for raw in statements:
+            sql = normalize(raw)
+            if sql in seen or not sql.split(' ', 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+                continue
+            seen.add(sql)
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+            scans = full_scans(plan)
+            if args.verbose:
+                print(sql)
+                for step in plan:
+                    print(f'    {step}')
+            if scans and not is_allowed(sql):
+                failures.append((sql, scans))
+        conn.close()
+    finally:
+        cleanup(path)
+
+    print(f'checked {len(seen)} distinct statements')
+    for sql, scans in failures:
+        print(f'FULL SCAN: {sql}')
+        for step in scans:
+            print(f'    {step}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""Multi-worker session check.
+
+Starts --workers copies of the app as separate processes on one database,
+as N gunicorn workers would run, and sends requests round-robin across
+them like a load balancer. Checks that
+
+  * a token issued by one worker authenticates on every worker, as the
+    right user, with all users' requests interleaved,
+  * requests without a token or with a tampered one get 401 everywhere,
+  * logging out on one worker ends the session on all of them,
+  * a password change ends the user's other sessions on every worker, and
+    keeps the session that made it,
+  * a forgot-password token from one worker works once, on another,
+  * by default forgot-password answers the same for registered and
+    unknown emails, and the token only goes to the mailbox.
+
+The workers run with PASSWORD_RESET_TOKEN_IN_RESPONSE on, so the check
+can read the token from the response.
+
+No SECRET_KEY is set, so the workers also have to agree on the key kept in
+the database. Exits 1 on any failure. With --store memory the cross-worker
+checks fail, which is why that store is for a single worker.
+
+    python benchmarks/check_sessions.py [--workers N] [--users N] [--store sqlite|memory]
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+from _common import cleanup, make_database, server
+
+failures = []
+
+
+def check(ok, message):
+    print(f"  {'ok  ' if ok else 'FAIL'} {message}")
+    if not ok:
+        failures.append(message)
+
+
+def serve(port, database, store):
+    import logging
+
+    import server
+    import sessions
+    from _common import use_database
+
+    use_database(database, SESSION_STORE=store, PASSWORD_RESET_TOKEN_IN_RESPONSE=True)
+    server.auth_sessions.store = sessions.create_store(store, server.get_db, server.get_read_db)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    from werkzeug.serving import make_server
+    httpd = make_server('127.0.0.1', port, server.app, threaded=True)
+    print('ready', flush=True)
+    httpd.serve_forever()
+
+
+def request(port, method, path, body=None, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        return resp.status, json.loads(data) if data else None
+    finally:
+        conn.close()
+
+
+def whoami(port, token):
+    status, body = request(port, 'GET', '/api/get-user', token=token)
+    return body['id'] if status == 200 else status
+
+
+def login(port, user_id, password='secret123'):
+    status, body = request(port, 'POST', '/api/login',
+                           {'email': f'user{user_id}@example.com', 'password': password})
+    return body['token'] if status == 200 else None
+
+
+def start_workers(count, database, store):
+    workers = []
+    for _ in range(count):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        env = dict(os.environ)
+        env.pop('SECRET_KEY', None)
+        child = subprocess.Popen(
+            [sys.executable, __file__, '--serve', str(port), database, store],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=env,
+        )
+        workers.append((port, child))
+    return workers
+
+
+def run_checks(ports, users):
+    n = len(ports)
+    print(f'{n} workers, {users} users')
+
+    # Each user logs in on "their" worker, then everyone hits every worker at once
+    tokens = {user_id: login(ports[user_id % n], user_id) for user_id in range(1, users + 1)}
+    check(all(tokens.values()), 'every user can log in')
+    wrong = []
+
+    def client(user_id):
+        for i in range(3 * n):
+            got = whoami(ports[(user_id + i) % n], tokens[user_id])
+            if got != user_id:
+                wrong.append((user_id, got))
+
+    threads = [threading.Thread(target=client, args=(user_id,)) for user_id in tokens]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    check(not wrong, f'tokens resolve to their own user on every worker ({len(wrong)} wrong)')
+
+    check(all(whoami(port, None) == 401 for port in ports), 'no token: 401 on every worker')
+    token = tokens[1]
+    tampered = token[:-4] + ('AAAA' if not token.endswith('AAAA') else 'BBBB')
+    check(all(whoami(port, tampered) == 401 for port in ports), 'tampered token: 401 on every worker')
+    forged_user = token.replace(token.split('.')[0], 'x' * len(token.split('.')[0]))
+    check(all(whoami(port, forged_user) == 401 for port in ports), 'forged session id: 401 on every worker')
+
+    token = tokens[2]
+    status, _ = request(ports[1 % n], 'POST', '/api/logout', token=token)
+    check(status == 200 and all(whoami(port, token) == 401 for port in ports),
+          'logout on one worker ends the session on all of them')
+
+    phone = login(ports[0], 3)
+    laptop = login(ports[1 % n], 3)
+    status, _ = request(ports[2 % n], 'POST', '/api/change-password', {'password': 'changed123'}, token=laptop)
+    check(status == 200, 'password change accepted')
+    check(all(whoami(port, phone) == 401 for port in ports) and all(whoami(port, tokens[3]) == 401 for port in ports),
+          "password change ends the user's other sessions on every worker")
+    check(all(whoami(port, laptop) == 3 for port in ports), 'and keeps the session that made it')
+    check(login(ports[0], 3) is None and login(ports[0], 3, 'changed123') is not None,
+          'the new password is in effect everywhere')
+
+    status, body = request(ports[0], 'POST', '/api/forgot-password', {'email': 'user4@example.com'})
+    reset = (body or {}).get('resetToken')
+    status, _ = request(ports[1 % n], 'POST', '/api/change-password', {'password': 'reset12345', 'token': reset})
+    check(status == 200, 'a reset token from one worker works on another')
+    status, _ = request(ports[2 % n], 'POST', '/api/change-password', {'password': 'again12345', 'token': reset})
+    check(status == 400, 'but only once')
+    check(all(whoami(port, tokens[4]) == 401 for port in ports), 'a reset ends the sessions it locks out')
+
+
+class Outbox:
+    def __init__(self):
+        self.messages = []
+
+    def send(self, to, subject, body):
+        self.messages.append((to, subject, body))
+
+
+def check_reset_response():
+    # In this process, with the default config and mail captured
+    saved = server.outgoing_mail
+    server.outgoing_mail = outbox = Outbox()
+    client = server.app.test_client()
+    try:
+        known = client.post('/api/forgot-password', json={'email': 'user5@example.com'})
+        unknown = client.post('/api/forgot-password', json={'email': 'nobody@example.com'})
+        mailed = outbox.messages[0][2].split('code: ', 1)[1].split()[0] if outbox.messages else None
+        changed = client.post('/api/change-password', json={'password': 'mailed12345', 'token': mailed})
+    finally:
+        server.outgoing_mail = saved
+    check((known.status_code, known.get_json()) == (unknown.status_code, unknown.get_json())
+          and 'Set-Cookie' not in known.headers,
+          'forgot-password answers the same for known and unknown emails')
+    check([to for to, _, _ in outbox.messages] == ['user5@example.com']
+          and 'resetToken' not in known.get_json(), 'the token is mailed, not returned')
+    check(changed.status_code == 200, 'the mailed token resets the password')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--store', default='sqlite')
+    parser.add_argument('--serve', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        port, database, store = args.serve
+        serve(int(port), database, store)
+        return
+
+    database = make_database(n_users=max(args.users, 5), n_items=50, n_trades=4, n_messages=4)
+    workers = []
+    try:
+        workers = start_workers(args.workers, database, args.store)
+        for _, child in workers:
+            assert child.stdout.readline().strip() == 'ready'
+        run_checks([port for port, _ in workers], max(args.users, 4))
+        check_reset_response()
+    finally:
+        for _, child in workers:
+            child.terminate()
+            child.wait()
+        cleanup(database)
+    if failures:
+        print(f'{len(failures)} check(s) failed')
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
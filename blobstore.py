@@ -0,0 +1,176 @@
+"""Content-addressed storage for uploaded files.
+
+A file is named after the SHA-256 of its bytes, so a photo uploaded again
+for a relisted item is stored once, and a name never points at different
+content, which is what allows it to be cached forever. The hash is computed
+while the upload is copied to disk.
+
+image_blobs (migration 9) holds one row per stored file; triggers on items
+and users (migration 15) keep its refcount equal to the number of item
+images and avatars using the file. collect() deletes a file, with its
+resized variants, once nothing references it.
+Writing and collecting a file both run under SQLite's write lock, so an
+upload of the same bytes cannot race a collection, even from another
+process.
+
+An upload has refcount 0 until the item using it is created. Every
+upload, including one of bytes already stored, sets the blob's
+uploaded_at (migration 14), and collect() leaves a blob alone for
+``grace`` seconds after that. An item deleted meanwhile therefore cannot
+take a just-uploaded file with it. collect_stale() removes the uploads
+nothing took up once their grace is over.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+CHUNK_SIZE = 64 * 1024
+INCOMING = '.incoming'
+
+# <sha256>.<ext> for originals, <sha256>.<variant>.<ext> for their variants
+NAME = re.compile(r'[0-9a-f]{64}(\.[a-z]+)?\.[a-z0-9]+')
+
+
+def is_content_addressed(filename):
+    return NAME.fullmatch(filename) is not None
+
+
+class ContentStore:
+    def __init__(self, folder, url_prefix, grace=24 * 3600):
+        self.folder = folder
+        self.url_prefix = url_prefix
+        self.grace = grace  # seconds an unreferenced upload is kept for the item it was uploaded for
+
+    @property
+    def incoming(self):
+        # Uploads in progress; on the same filesystem so finished ones can be renamed into place
+        return os.path.join(self.folder, INCOMING)
+
+    def url(self, filename):
+        return self.url_prefix + filename
+
+    def writer(self):
+        """A BlobWriter for a new file, hashed as it is written."""
+        os.makedirs(self.incoming, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.incoming, suffix='.part')
+        return BlobWriter(self, os.fdopen(fd, 'wb'), path)
+
+    def save(self, conn, stream, extension):
+        """Copy ``stream`` into the store and register it in image_blobs.
+
+        Returns ``(filename, created)``; ``created`` is False when the same
+        bytes were already stored. ``conn`` must not be in a transaction.
+        """
+        writer = self.writer()
+        try:
+            while chunk := stream.read(CHUNK_SIZE):
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit(conn, extension)
+
+    def adopt(self, conn, path, extension):
+        """Like save(), for a finished file at ``path`` in the incoming folder."""
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+        return self._store(conn, path, digest.hexdigest(), size, extension)
+
+    def _store(self, conn, tmp, hexdigest, size, extension):
+        filename = hexdigest + extension.lower()
+        path = os.path.join(self.folder, filename)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                created = not os.path.exists(path)
+                if created:
+                    os.replace(tmp, path)
+                conn.execute(
+                    '''INSERT INTO image_blobs (image_url, bytes, uploaded_at) VALUES (?, ?, ?)
+                       ON CONFLICT (image_url) DO UPDATE SET uploaded_at = excluded.uploaded_at''',
+                    (self.url(filename), size, time.time()),
+                )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        return filename, created
+
+    def collect(self, conn, image_url):
+        """Delete ``image_url`` and its variants if no item references it
+        and it was not uploaded within the last ``grace`` seconds.
+
+        Returns whether anything was deleted. Both are checked under the
+        write lock, and files are removed before the commit, so a
+        concurrent save() of the same bytes, which waits for the write
+        lock, either keeps the blob or finds it gone and writes it again.
+        """
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.execute(
+                'DELETE FROM image_blobs WHERE image_url = ? AND refcount <= 0 AND uploaded_at <= ?',
+                (image_url, time.time() - self.grace),
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return False
+            urls = [image_url] + [
+                row[0] for row in conn.execute('SELECT url FROM image_variants WHERE image_url = ?', (image_url,))
+            ]
+            conn.execute('DELETE FROM image_variants WHERE image_url = ?', (image_url,))
+            for url in urls:
+                if url.startswith(self.url_prefix):
+                    try:
+                        os.unlink(os.path.join(self.folder, url[len(self.url_prefix):]))
+                    except FileNotFoundError:
+                        pass
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return True
+
+    def collect_stale(self, conn, limit=20):
+        """collect() up to ``limit`` uploads no item took up within their grace; returns how many."""
+        urls = [row[0] for row in conn.execute(
+            'SELECT image_url FROM image_blobs WHERE refcount <= 0 AND uploaded_at <= ? LIMIT ?',
+            (time.time() - self.grace, limit),
+        )]
+        return sum(self.collect(conn, url) for url in urls)
+
+
+class BlobWriter:
+    """A file being written to the store; finish with commit() or abort()."""
+
+    def __init__(self, store, file, path):
+        self.store = store
+        self.file = file
+        self.path = path
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self, conn, extension):
+        """Store the file under ``<sha256><extension>``; returns ``(filename, created)``."""
+        self.file.close()
+        return self.store._store(conn, self.path, self.digest.hexdigest(), self.size, extension)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
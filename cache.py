@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds.
+
+    ``invalidate()`` drops everything and bumps a generation counter. A
+    loader that started before an invalidation cannot store its (possibly
+    stale) result afterwards, so a write that commits while a reader is
+    rebuilding an entry is never masked.
+    """
+
+    def __init__(self, maxsize=256, ttl=30.0, enabled=True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Return ``(True, value)`` on a hit, ``(False, None)`` otherwise."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def get_or_load(self, key, loader):
+        if not self.enabled:
+            return loader()
+        hit, value = self.get(key)
+        if hit:
+            return value
+        generation = self.generation
+        value = loader()
+        self.set(key, value, generation)
+        return value
+
+    def discard(self, key):
+        """Drop ``key``; like invalidate(), a load already under way is not stored."""
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,171 @@
+from collections import namedtuple
+
+import images
+import migrations
+
+# Lower bounds of the price facet buckets; the last one is open-ended.
+# item_facet_counts is bucketed this way by the triggers from migration 7.
+PRICE_BUCKETS = migrations.PRICE_BUCKETS_V7
+
+# ?sort= value -> (items column, direction); ties are broken by id
+SORTS = {
+    'newest': ('created_at', 'DESC'),
+    'oldest': ('created_at', 'ASC'),
+    'price_asc': ('price', 'ASC'),
+    'price_desc': ('price', 'DESC'),
+}
+DEFAULT_SORT = 'newest'
+MAX_CATEGORIES = 20
+
+# A price range matching at least this many rows is paged by walking the
+# sort order instead of fetching the range and sorting it
+PRICE_PROBE_LIMIT = 5000
+
+# Hashable, so a parsed request can be part of a feed cache key
+Filters = namedtuple('Filters', ['categories', 'min_price', 'max_price', 'sort'])
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def _price(args, name):
+    value = args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise InvalidFilter(f'{name} must be a number')
+
+
+def parse_filters(args):
+    """Read ``category`` (repeatable), ``min_price``, ``max_price`` and ``sort``."""
+    categories = tuple(sorted({c for c in args.getlist('category') if c}))
+    if len(categories) > MAX_CATEGORIES:
+        raise InvalidFilter(f'At most {MAX_CATEGORIES} categories')
+    min_price = _price(args, 'min_price')
+    max_price = _price(args, 'max_price')
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise InvalidFilter('min_price must not be greater than max_price')
+    sort = args.get('sort', DEFAULT_SORT)
+    if sort not in SORTS:
+        raise InvalidFilter(f'sort must be one of: {", ".join(SORTS)}')
+    return Filters(categories, min_price, max_price, sort)
+
+
+def _where(filters, price_column='items.price'):
+    clauses, params = [], []
+    if filters.categories:
+        clauses.append(f"items.category IN ({','.join('?' * len(filters.categories))})")
+        params.extend(filters.categories)
+    if filters.min_price is not None:
+        clauses.append(f'{price_column} >= ?')
+        params.append(filters.min_price)
+    if filters.max_price is not None:
+        clauses.append(f'{price_column} <= ?')
+        params.append(filters.max_price)
+    return ''.join(f' AND {clause}' for clause in clauses), params
+
+
+def wide_price_range(cursor, filters):
+    """Whether a date-sorted page should walk the date index past the price filter.
+
+    Fetching a price range through the price index and sorting it is cheap
+    when the range is narrow and slow when it covers most of the catalog;
+    walking the date index and skipping rows outside the range is the
+    reverse. SQLite keeps no statistics on price ranges, so count the
+    matches through the index, stopping at PRICE_PROBE_LIMIT.
+    """
+    if SORTS[filters.sort][0] != 'created_at' or (filters.min_price is None and filters.max_price is None):
+        return False
+    where, params = _where(filters)
+    cursor.execute(
+        f"SELECT COUNT(*) FROM (SELECT 1 FROM items WHERE items.status = 'available'{where} LIMIT ?)",
+        params + [PRICE_PROBE_LIMIT],
+    )
+    return cursor.fetchone()[0] >= PRICE_PROBE_LIMIT
+
+
+def item_query(filters, limit=None, after=None, exclude_user_id=None, walk_sort_order=False):
+    """Return ``(sql, params)`` for a page of available items with their owners
+    and thumbnails.
+
+    ``after`` is the sort key of the previous page's last row, as produced
+    by sort_key(); ``limit + 1`` rows are fetched so the caller can tell
+    whether another page exists. ``walk_sort_order`` (see wide_price_range)
+    keeps SQLite from using a price index for the price filter.
+    """
+    column, direction = SORTS[filters.sort]
+    query = '''
+        SELECT items.*, users.firstname, users.lastname, users.avatar_url, thumb.url
+        FROM items
+        JOIN users ON items.user_id = users.id
+        LEFT JOIN image_variants thumb
+            ON thumb.image_url = items.image_url AND thumb.name = ? AND thumb.format = ?
+        WHERE items.status = 'available'
+    '''
+    params = list(images.THUMBNAIL)
+    if exclude_user_id is not None:
+        query += ' AND items.user_id != ?'
+        params.append(exclude_user_id)
+    # A unary + makes a column unusable for index lookups
+    where, where_params = _where(filters, '+items.price' if walk_sort_order else 'items.price')
+    query += where
+    params.extend(where_params)
+    if after:
+        query += f" AND (items.{column}, items.id) {'<' if direction == 'DESC' else '>'} (?, ?)"
+        params.extend(after)
+    query += f' ORDER BY items.{column} {direction}, items.id {direction}'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit + 1)
+    return query, params
+
+
+def sort_key(filters):
+    column = SORTS[filters.sort][0]
+    return lambda item: (item[column], item['id'])
+
+
+def facet_counts(cursor, filters, exclude_user_id=None):
+    """Counts of available items per category and per price bucket.
+
+    Read from item_facet_counts, minus the caller's own listings when they
+    are excluded (an indexed lookup of one user's items; +status keeps the
+    planner off the status indexes, which would visit every listing). The category facet
+    ignores the category selection so the alternatives stay visible; the
+    price facet is narrowed to the selected categories. Neither applies
+    min/max_price, which would split buckets.
+    """
+    cursor.execute('SELECT category, price_bucket, count FROM item_facet_counts WHERE count > 0')
+    counts = {(category, bucket): count for category, bucket, count in cursor.fetchall()}
+    if exclude_user_id is not None:
+        cursor.execute(f'''
+            SELECT category, {migrations.price_bucket_v7('items')} AS bucket, COUNT(*)
+            FROM items
+            WHERE user_id = ? AND +status = 'available'
+            GROUP BY category, bucket
+        ''', (exclude_user_id,))
+        for category, bucket, count in cursor.fetchall():
+            counts[category, bucket] = counts.get((category, bucket), 0) - count
+
+    by_category = {}
+    by_bucket = dict.fromkeys(PRICE_BUCKETS, 0)
+    for (category, bucket), count in counts.items():
+        by_category[category] = by_category.get(category, 0) + count
+        if not filters.categories or category in filters.categories:
+            by_bucket[bucket] += count
+
+    upper = PRICE_BUCKETS[1:] + (None,)
+    return {
+        'category': [
+            {'value': category, 'count': count}
+            for category, count in sorted(by_category.items(), key=lambda c: (-c[1], c[0]))
+            if count > 0
+        ],
+        'price': [
+            {'min': lower, 'max': upper[i], 'count': by_bucket[lower]}
+            for i, lower in enumerate(PRICE_BUCKETS)
+        ],
+    }
@@ -0,0 +1,290 @@
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+DEFAULT_DATABASE = 'users.db'
+
+# PRAGMAs applied to every new connection, selected with DB_STORAGE_PROFILE.
+# 'tuned' switches users.db to WAL so writers no longer block readers of the
+# feed; journal_mode is persistent in the file, the rest are per-connection.
+STORAGE_PROFILES = {
+    'default': {'journal_mode': 'DELETE'},
+    'tuned': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,  # KiB, i.e. ~16MB of page cache per connection
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000,  # ms
+        'temp_store': 'MEMORY',
+    },
+}
+
+# Settings that only a writable connection may change
+_WRITE_ONLY_PRAGMAS = {'journal_mode'}
+
+_pool_lock = threading.Lock()
+
+# Callables run on every new pooled connection, e.g. to install trace callbacks
+_connect_hooks = []
+
+
+def add_connect_hook(hook):
+    """Register ``hook(conn)`` to run on every connection a pool opens."""
+    _connect_hooks.append(hook)
+    return hook
+
+
+def remove_connect_hook(hook):
+    _connect_hooks.remove(hook)
+
+
+# Class of the connections pools open, e.g. one that times its statements
+_connection_factory = sqlite3.Connection
+
+# Callables told how long each checkout waited for a free connection
+_wait_hooks = []
+
+
+def set_connection_factory(factory):
+    """Open connections opened from now on as ``factory``, a sqlite3.Connection subclass."""
+    global _connection_factory
+    _connection_factory = factory or sqlite3.Connection
+
+
+def add_wait_hook(hook):
+    """Register ``hook(pool, seconds)`` to run after every checkout that had to wait for a slot."""
+    _wait_hooks.append(hook)
+    return hook
+
+
+def remove_wait_hook(hook):
+    _wait_hooks.remove(hook)
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """Raised when no pooled connection frees up within the configured timeout."""
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections shared by the request threads.
+
+    Connections are created lazily up to ``size`` and handed back to the pool
+    at the end of every request, so the per-request connect/close cost and the
+    schema parse only happen once per connection. Each connection keeps its own
+    prepared-statement cache (``cached_statements``). A size of 0 disables
+    pooling and opens a fresh connection per checkout, which is the old
+    behaviour and is mostly useful for benchmarks.
+    """
+
+    def __init__(self, database, size=8, timeout=5.0, health_check_interval=30.0,
+                 cached_statements=256, pragmas=None, readonly=False):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.cached_statements = cached_statements
+        self.pragmas = dict(pragmas or {})
+        self.readonly = readonly
+        # LIFO keeps the hottest connections (and their statement caches) in use
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size) if size > 0 else None
+        self._closed = False
+
+    def connect(self):
+        if self.readonly:
+            target = pathlib.Path(self.database).absolute().as_uri() + '?mode=ro'
+        else:
+            target = self.database
+        conn = sqlite3.connect(
+            target,
+            uri=self.readonly,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=_connection_factory,
+        )
+        for name, value in self.pragmas.items():
+            if self.readonly and name in _WRITE_ONLY_PRAGMAS:
+                continue
+            conn.execute(f'PRAGMA {name} = {value}')
+        for hook in _connect_hooks:
+            hook(conn)
+        return conn
+
+    def acquire(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError('Connection pool is closed')
+        if self._slots is None:
+            return self.connect()
+
+        if not self._slots.acquire(blocking=False):
+            start = time.perf_counter()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            for hook in _wait_hooks:
+                hook(self, time.perf_counter() - start)
+            if not acquired:
+                raise PoolTimeout(f'No database connection available after {self.timeout}s')
+        try:
+            while True:
+                try:
+                    conn, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if time.monotonic() - last_used < self.health_check_interval:
+                    return conn
+                if self.is_healthy(conn):
+                    return conn
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        if self._slots is None:
+            conn.close()
+            return
+
+        try:
+            if not discard and not self._closed:
+                # Anything a handler left uncommitted is dropped, exactly as
+                # conn.close() used to do.
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.row_factory = None
+                self._idle.put((conn, time.monotonic()))
+                return
+        except sqlite3.Error:
+            pass
+        finally:
+            self._slots.release()
+        self._discard(conn)
+
+    def is_healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def health_check(self):
+        """Ping every idle connection and drop the ones that fail."""
+        checked = []
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if self.is_healthy(conn):
+                checked.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+        for entry in checked:
+            self._idle.put(entry)
+        return len(checked)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+def init_app(app):
+    app.config.setdefault('DATABASE', DEFAULT_DATABASE)
+    app.config.setdefault('DB_POOL_SIZE', 8)
+    app.config.setdefault('DB_POOL_TIMEOUT', 5.0)
+    app.config.setdefault('DB_HEALTH_CHECK_INTERVAL', 30.0)
+    app.config.setdefault('DB_CACHED_STATEMENTS', 256)
+    app.config.setdefault('DB_STORAGE_PROFILE', 'tuned')
+    # Size of the separate read-only pool used by GET routes; None disables
+    # it and reads share the read/write pool.
+    app.config.setdefault('DB_READ_POOL_SIZE', 8)
+    app.teardown_appcontext(release_db)
+
+
+def get_pool(app=None, readonly=False):
+    app = app or current_app._get_current_object()
+    key = 'db_read_pool' if readonly else 'db_pool'
+    pool = app.extensions.get(key)
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get(key)
+            if pool is None:
+                profile = app.config['DB_STORAGE_PROFILE']
+                if profile not in STORAGE_PROFILES:
+                    raise ValueError(f'Unknown DB_STORAGE_PROFILE: {profile!r}')
+                pool = ConnectionPool(
+                    app.config['DATABASE'],
+                    size=app.config['DB_READ_POOL_SIZE' if readonly else 'DB_POOL_SIZE'],
+                    timeout=app.config['DB_POOL_TIMEOUT'],
+                    health_check_interval=app.config['DB_HEALTH_CHECK_INTERVAL'],
+                    cached_statements=app.config['DB_CACHED_STATEMENTS'],
+                    pragmas=STORAGE_PROFILES[profile],
+                    readonly=readonly,
+                )
+                app.extensions[key] = pool
+    return pool
+
+
+def reset_pool(app):
+    """Close the current pools so the next request rebuilds them from app.config."""
+    with _pool_lock:
+        pools = [app.extensions.pop(key, None) for key in ('db_pool', 'db_read_pool')]
+    for pool in pools:
+        if pool is not None:
+            pool.close()
+
+
+def configure_database(app):
+    """Apply the storage profile's persistent settings (journal mode) to the file."""
+    pragmas = STORAGE_PROFILES[app.config['DB_STORAGE_PROFILE']]
+    conn = sqlite3.connect(app.config['DATABASE'])
+    try:
+        for name in _WRITE_ONLY_PRAGMAS & pragmas.keys():
+            conn.execute(f'PRAGMA {name} = {pragmas[name]}')
+    finally:
+        conn.close()
+
+
+def get_db():
+    """Return the pooled connection bound to the current app context."""
+    conn = g.get('_db_conn')
+    if conn is None:
+        conn = g._db_conn = get_pool().acquire()
+    return conn
+
+
+def get_read_db():
+    """Return a read-only connection for GET routes.
+
+    Falls back to the read/write connection when the read pool is disabled or
+    the request has already opened one, so a request never reads around its
+    own uncommitted writes.
+    """
+    if current_app.config['DB_READ_POOL_SIZE'] is None or '_db_conn' in g:
+        return get_db()
+    conn = g.get('_db_read_conn')
+    if conn is None:
+        conn = g._db_read_conn = get_pool(readonly=True).acquire()
+    return conn
+
+
+def release_db(exc=None):
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        get_pool().release(conn)
+    conn = g.pop('_db_read_conn', None)
+    if conn is not None:
+        get_pool(readonly=True).release(conn)
@@ -0,0 +1,135 @@
+"""Liveness, readiness and load shedding.
+
+Liveness only says that the process answers. Readiness says whether this
+node should get traffic. It fails when one of the checks fails:
+
+  database   a read against users.db on a fresh connection, within
+             ``max_latency``, and the write lock taken and released
+             within ``timeout``. A long write transaction or a stuck
+             writer therefore shows up as "database is locked".
+  storage    each folder can be written to, and its disk has at least
+             ``min_free`` bytes left
+  in_flight  requests in progress are under the readiness limit
+
+Dependency checks open their own connection and write their own scratch
+file, so an exhausted connection pool or a full disk cannot block the
+probe. Their results are cached for ``ttl`` seconds, and only one thread
+runs them at a time, so many load balancers probing often cost one check
+per ``ttl``.
+
+InFlight counts requests in progress. Past its hard limit, requests are
+refused with 503 at once. The node sheds load instead of queueing work
+that would time out anyway.
+"""
+import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class InFlight:
+    """Requests in progress, with a hard limit past which enter() refuses."""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.count = 0
+        self.peak = 0
+        self.shed = 0
+
+    def enter(self):
+        """Count a request in; False, and nothing counted, if it is over the limit."""
+        with self._lock:
+            if self.limit is not None and self.count >= self.limit:
+                self.shed += 1
+                return False
+            self.count += 1
+            if self.count > self.peak:
+                self.peak = self.count
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.count -= 1
+
+
+def check_database(database, timeout=0.25, max_latency=0.25):
+    start = time.perf_counter()
+    try:
+        target = pathlib.Path(database).absolute().as_uri() + '?mode=rw'
+        conn = sqlite3.connect(target, uri=True, timeout=timeout, isolation_level=None)
+        try:
+            conn.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            read = time.perf_counter() - start
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('ROLLBACK')
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        return {'ok': False, 'error': str(e), 'ms': round((time.perf_counter() - start) * 1000, 2)}
+    result = {'ok': read <= max_latency, 'read_ms': round(read * 1000, 2),
+              'ms': round((time.perf_counter() - start) * 1000, 2)}
+    if not result['ok']:
+        result['error'] = f'read took over {max_latency * 1000:g}ms'
+    return result
+
+
+def check_storage(folder, min_free=0):
+    try:
+        with tempfile.TemporaryFile(dir=folder, prefix='.health-') as f:
+            f.write(b'ok')
+            f.flush()
+        free = shutil.disk_usage(folder).free
+    except OSError as e:
+        return {'ok': False, 'error': f'{type(e).__name__}: {e.strerror or e}'}
+    result = {'ok': free >= min_free, 'free_mb': free // (1024 * 1024)}
+    if not result['ok']:
+        result['error'] = f'under {min_free // (1024 * 1024)} MB free'
+    return result
+
+
+class Readiness:
+    """Runs ``checks`` (name -> callable returning a result dict) at most once per ``ttl`` seconds."""
+
+    def __init__(self, checks, ttl=1.0):
+        self.checks = checks
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._results = None
+        self._expires = 0.0
+
+    def results(self):
+        now = time.monotonic()
+        if self._results is not None and now < self._expires:
+            return self._results
+        with self._lock:
+            # Whoever waited for the lock uses the run that just finished
+            if self._results is not None and time.monotonic() < self._expires:
+                return self._results
+            results = {}
+            for name, check in self.checks.items():
+                try:
+                    results[name] = check()
+                except Exception as e:
+                    results[name] = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            self._results = results
+            self._expires = time.monotonic() + self.ttl
+            return results
+
+    def invalidate(self):
+        self._expires = 0.0
+
+
+def in_flight_check(in_flight, limit):
+    result = {'ok': limit is None or in_flight.count < limit, 'count': in_flight.count,
+              'limit': limit, 'peak': in_flight.peak, 'shed': in_flight.shed}
+    if not result['ok']:
+        result['error'] = 'too many requests in progress'
+    return result
+
+
+def database_folder(database):
+    return os.path.dirname(os.path.abspath(database))
@@ -0,0 +1,133 @@
+"""Background resizing and re-encoding of uploaded images.
+
+Every upload is turned into a set of variants (a few widths, each as WebP
+and JPEG) with its EXIF orientation applied and all metadata dropped.
+Needs Pillow (pip install Pillow); without it the pipeline is disabled and
+items keep pointing at the original upload.
+"""
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = ImageOps = None
+
+AVAILABLE = Image is not None
+
+log = logging.getLogger(__name__)
+
+# Variant name -> target width in pixels; images are never upscaled
+DEFAULT_WIDTHS = {'thumb': 320, 'medium': 800, 'large': 1600}
+DEFAULT_FORMATS = ('webp', 'jpeg')
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+# The variant list responses link to as thumbnail_url
+THUMBNAIL = ('thumb', 'webp')
+
+# Refuse to decode anything larger (decompression bombs)
+MAX_PIXELS = 50_000_000
+
+# EXIF orientations that swap width and height
+_TRANSPOSED = {5, 6, 7, 8}
+
+
+def _flatten(image, background=(255, 255, 255)):
+    # JPEG has no alpha channel
+    flat = Image.new('RGB', image.size, background)
+    flat.paste(image, mask=image.getchannel('A'))
+    return flat
+
+
+class ImagePipeline:
+    """Generates variants of uploaded images on a pool of worker threads.
+
+    Pillow releases the GIL while decoding, resizing and encoding, so the
+    threads run in parallel. ``on_done(image_url, variants)`` is called on
+    the worker thread once every variant of an image has been written.
+    """
+
+    def __init__(self, folder, on_done, widths=None, formats=DEFAULT_FORMATS, quality=80, workers=2):
+        self.folder = folder
+        self.on_done = on_done
+        self.widths = dict(widths or DEFAULT_WIDTHS)
+        self.formats = tuple(formats)
+        self.quality = quality
+        self._executor = None
+        if AVAILABLE and workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+
+    @property
+    def enabled(self):
+        return self._executor is not None
+
+    def submit(self, filename, image_url):
+        """Queue ``filename`` (in ``folder``) for processing; returns a Future or None."""
+        if not self.enabled:
+            return None
+        return self._executor.submit(self._run, filename, image_url)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+    def _run(self, filename, image_url):
+        try:
+            variants = self.process(filename)
+        except Exception as e:
+            log.warning('Image processing failed for %s: %s', filename, e)
+            return []
+        self.on_done(image_url, variants)
+        return variants
+
+    def process(self, filename):
+        """Write every variant of ``filename`` and return a dict describing each."""
+        stem = os.path.splitext(filename)[0]
+        with Image.open(os.path.join(self.folder, filename)) as source:
+            if source.width * source.height > MAX_PIXELS:
+                raise ValueError(f'{source.width}x{source.height} exceeds {MAX_PIXELS} pixels')
+            # Let the JPEG decoder scale down by up to 8x while decoding, as
+            # long as the result still covers the largest variant
+            transposed = source.getexif().get(0x0112) in _TRANSPOSED
+            display_width = source.height if transposed else source.width
+            scale = min(1.0, max(self.widths.values()) / display_width)
+            source.draft('RGB', (math.ceil(source.width * scale), math.ceil(source.height * scale)))
+            image = ImageOps.exif_transpose(source)
+
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+        variants = []
+        # Largest first, each one resized from the previous
+        for name, target in sorted(self.widths.items(), key=lambda item: -item[1]):
+            if image.width > target:
+                image = image.resize(
+                    (target, max(1, round(image.height * target / image.width))),
+                    Image.LANCZOS,
+                    reducing_gap=2.0,
+                )
+            for fmt in self.formats:
+                out = f'{stem}.{name}.{EXTENSIONS[fmt]}'
+                frame = _flatten(image) if fmt == 'jpeg' and image.mode == 'RGBA' else image
+                variants.append(self._save(frame, fmt, out, name))
+        return variants
+
+    def _save(self, image, fmt, filename, name):
+        path = os.path.join(self.folder, filename)
+        options = {'quality': self.quality}
+        if fmt == 'jpeg':
+            options.update(optimize=True, progressive=True)
+        # Nothing is copied over from the source, so no EXIF, XMP or ICC data
+        # is written. Readers never see a half-written file.
+        image.save(path + '.tmp', format=fmt.upper(), **options)
+        os.replace(path + '.tmp', path)
+        return {
+            'name': name,
+            'format': fmt,
+            'filename': filename,
+            'width': image.width,
+            'height': image.height,
+            'bytes': os.path.getsize(path),
+        }
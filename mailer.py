@@ -0,0 +1,69 @@
+"""Outgoing mail, sent from a background thread.
+
+send() only queues the message, so a route answers in the same time
+whether or not it sends anything, and a slow or failing SMTP server costs
+the request nothing. Failures are logged, never raised. Neither the
+recipient nor the body is logged, since a body may carry a token.
+
+Without a configured server, create_mailer() returns a NullMailer, which
+only logs that a message was not sent.
+"""
+import logging
+import smtplib
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+log = logging.getLogger(__name__)
+
+
+class SMTPMailer:
+    def __init__(self, host, port=587, sender='no-reply@localhost', username=None, password=None,
+                 starttls=True, timeout=10.0, workers=2):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mailer')
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, to, subject, body):
+        self._executor.submit(self._send, to, subject, body)
+
+    def _send(self, to, subject, body):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = to
+        message['Subject'] = subject
+        message.set_content(body)
+        try:
+            with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+                if self.starttls:
+                    smtp.starttls()
+                if self.username:
+                    smtp.login(self.username, self.password)
+                smtp.send_message(message)
+        except (OSError, smtplib.SMTPException) as e:
+            self.failed += 1
+            log.error('Mail not sent', extra={'fields': {'subject': subject, 'error': f'{type(e).__name__}: {e}'}})
+            return
+        self.sent += 1
+
+
+class NullMailer:
+    """Stands in while no mail server is configured."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, to, subject, body):
+        self.failed += 1
+        log.warning('Mail not sent, no MAIL_SERVER configured', extra={'fields': {'subject': subject}})
+
+
+def create_mailer(host, **options):
+    return SMTPMailer(host, **options) if host else NullMailer()
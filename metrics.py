@@ -0,0 +1,327 @@
+"""Request and database metrics in the Prometheus text format.
+
+Counters and histograms are kept per thread: each thread adds into its
+own dict, so recording takes no lock and threads never contend. A
+scrape sums the shards. Shards of threads that have ended are folded into
+one retired shard at that point, so totals never go backwards. This
+matters for servers that start a thread per connection.
+
+instrument_db() times every statement run on a pooled connection, keyed
+by its fingerprint: the SQL with literals replaced by ``?`` and
+whitespace collapsed. The time is that of execute(), which for SQLite
+includes planning, sorting and any wait on busy_timeout for a lock, but
+not the fetching of rows after the first. It also times the wait for a
+pooled connection, and counts "database is locked" errors.
+"""
+import bisect
+import re
+import sqlite3
+import threading
+import time
+
+import db
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; the last bucket is +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Most statements finish well under a millisecond
+DB_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, labels=(), amount=1):
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def merge(self, total, value):
+        return (total or 0) + value
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+
+
+class Histogram:
+    """Observations sorted into ``buckets`` per combination of label values.
+
+    Next to the standard _bucket/_sum/_count series, it also writes a
+    ``<name>_quantile`` gauge with p50/p95/p99 estimated from the buckets,
+    so a plain ``curl /metrics`` shows them without a Prometheus server.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=LATENCY_BUCKETS, quantiles=QUANTILES):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.quantiles = tuple(quantiles)
+
+    def observe(self, labels, value):
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        entry = shard.get(key)
+        if entry is None:
+            # One count per bucket, one for +Inf, then the sum
+            entry = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def quantile(self, entry, q):
+        """Estimate quantile ``q`` from bucket counts, interpolating within a bucket."""
+        counts = entry[:-1]
+        total = sum(counts)
+        if not total:
+            return float('nan')
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self, values):
+        for labels, entry in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(entry[-1])}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}'
+
+    def quantile_samples(self, values):
+        for labels, entry in sorted(values.items()):
+            for q in self.quantiles:
+                extra = f'quantile="{q}"'
+                value = self.quantile(entry, q)
+                yield f'{self.name}_quantile{_labels(self.labelnames, labels, extra)} {_number(value)}'
+
+
+class Registry:
+    """The metrics of one process, and their per-thread shards."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._metrics = {}
+        self._collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, help, labelnames, buckets))
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric already registered: {metric.name}')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collect):
+        """Call ``collect()`` on every scrape; it returns ``(name, kind, help, {labels: value})`` tuples.
+
+        ``labels`` is a tuple of ``(name, value)`` pairs.
+        """
+        self._collectors.append(collect)
+        return collect
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def snapshot(self):
+        """``{metric name: {label values: merged value}}`` over every thread."""
+        totals = {}
+
+        def add(key, value):
+            name, labels = key
+            metric = self._metrics[name]
+            values = totals.setdefault(name, {})
+            values[labels] = metric.merge(values.get(labels), value)
+
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # Nothing writes to it any more
+                    for key, value in shard.items():
+                        self._retired[key] = self._metrics[key[0]].merge(self._retired.get(key), value)
+            self._shards = live
+            for key, value in self._retired.items():
+                add(key, value)
+            shards = [shard for _, shard in live]
+        for shard in shards:
+            # list() copies in one step, while the owning thread may be adding keys
+            for key, value in list(shard.items()):
+                add(key, value)
+        return totals
+
+    def render(self):
+        totals = self.snapshot()
+        lines = []
+        for name, metric in self._metrics.items():
+            values = totals.get(name, {})
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.samples(values))
+            if metric.kind == 'histogram' and metric.quantiles:
+                lines.append(f'# HELP {name}_quantile {metric.help}, estimated from the buckets')
+                lines.append(f'# TYPE {name}_quantile gauge')
+                lines.extend(metric.quantile_samples(values))
+        for collect in self._collectors:
+            for name, kind, help, values in collect():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in values.items():
+                    names = [label for label, _ in labels]
+                    lines.append(f'{name}{_labels(names, [v for _, v in labels])} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class HttpMetrics:
+    """Request count, latency and response bytes per route."""
+
+    def __init__(self, registry):
+        self.requests = registry.counter(
+            'http_requests_total', 'Requests handled', ('route', 'method', 'status'))
+        self.latency = registry.histogram(
+            'http_request_duration_seconds', 'Time to build the response', ('route',))
+        self.response_bytes = registry.counter(
+            'http_response_bytes_total', 'Response body bytes, where the length is known up front', ('route',))
+
+    def observe(self, route, method, status, seconds, size):
+        self.requests.inc((route, method, status))
+        self.latency.observe((route,), seconds)
+        if size:
+            self.response_bytes.inc((route,), size)
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+_SPACE = re.compile(r'\s+')
+_fingerprints = {}
+MAX_FINGERPRINTS = 2048
+
+
+def fingerprint(sql):
+    """``sql`` with literals and placeholder lists reduced to ``?``, on one line."""
+    text = _fingerprints.get(sql)
+    if text is None:
+        text = _SPACE.sub(' ', _LITERALS.sub('?', sql)).strip()
+        text = _PLACEHOLDER_LISTS.sub('?, ...', text)
+        if len(_fingerprints) < MAX_FINGERPRINTS:
+            _fingerprints[sql] = text
+    return text
+
+
+def instrument_db(registry, on_slow=None):
+    """Time the statements and pool waits of every pooled connection opened from now on.
+
+    A statement that takes ``on_slow.threshold`` seconds or longer is
+    passed on to ``on_slow(conn, sql, params, seconds, many)``.
+    """
+    statements = registry.histogram(
+        'db_statement_duration_seconds', 'Time spent in execute(), lock waits included', ('statement',),
+        buckets=DB_BUCKETS)
+    locked = registry.counter(
+        'db_locked_errors_total', 'Statements that gave up waiting for a database lock', ('statement',))
+    pool_wait = registry.histogram(
+        'db_pool_wait_seconds', 'Time waiting for a pooled connection', ('pool',), buckets=DB_BUCKETS)
+
+    def timed(conn, sql, run, *args, many=False):
+        key = (fingerprint(sql),)
+        start = time.perf_counter()
+        try:
+            result = run(*args)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                locked.inc(key)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            statements.observe(key, elapsed)
+        if on_slow is not None and elapsed >= on_slow.threshold:
+            on_slow(conn, sql, args[1] if len(args) > 1 else (), elapsed, many)
+        return result
+
+    class TimedCursor(sqlite3.Cursor):
+        def execute(self, sql, *args):
+            return timed(self.connection, sql, super().execute, sql, *args)
+
+        def executemany(self, sql, *args):
+            return timed(self.connection, sql, super().executemany, sql, *args, many=True)
+
+    class TimedConnection(sqlite3.Connection):
+        # Connection.execute() runs its cursor's statement in C, bypassing
+        # TimedCursor.execute, so it is timed here as well
+        def cursor(self, factory=TimedCursor):
+            return super().cursor(factory)
+
+        def execute(self, sql, *args):
+            return timed(self, sql, super().execute, sql, *args)
+
+        def executemany(self, sql, *args):
+            return timed(self, sql, super().executemany, sql, *args, many=True)
+
+        def commit(self):
+            return timed(self, 'COMMIT', super().commit)
+
+    def on_wait(pool, seconds):
+        pool_wait.observe(('read' if pool.readonly else 'write',), seconds)
+
+    db.set_connection_factory(TimedConnection)
+    db.add_wait_hook(on_wait)
+    return TimedConnection
@@ -0,0 +1,421 @@
+import sqlite3
+
+# Lower bounds of the price facet buckets as of migration 7; the last one is
+# open-ended. catalog.PRICE_BUCKETS must match what the latest migration built.
+PRICE_BUCKETS_V7 = (0, 25, 50, 100, 250, 500, 1000)
+
+
+def price_bucket_v7(row):
+    # SQL mapping row.price to its bucket's lower bound
+    whens = ' '.join(
+        f'WHEN {row}.price < {upper} THEN {lower}'
+        for lower, upper in zip(PRICE_BUCKETS_V7, PRICE_BUCKETS_V7[1:])
+    )
+    return f'CASE {whens} ELSE {PRICE_BUCKETS_V7[-1]} END'
+
+
+# Versioned schema changes for users.db. The applied version is stored in
+# PRAGMA user_version; every entry is (version, description, statements) and
+# runs in its own transaction. Append new migrations, never edit old ones.
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            firstname TEXT NOT NULL,
+            lastname TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            avatar_url TEXT DEFAULT 'assets/avatars/avatar1.png',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            category TEXT NOT NULL,
+            price REAL NOT NULL,
+            description TEXT NOT NULL,
+            image_url TEXT NOT NULL,
+            status TEXT DEFAULT 'available',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trade_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_read BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (sender_id) REFERENCES users (id),
+            FOREIGN KEY (receiver_id) REFERENCES users (id),
+            FOREIGN KEY (trade_id) REFERENCES trades (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS trades (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item1_id INTEGER NOT NULL,
+            item2_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (item1_id) REFERENCES items (id),
+            FOREIGN KEY (item2_id) REFERENCES items (id),
+            FOREIGN KEY (sender_id) REFERENCES users (id),
+            FOREIGN KEY (receiver_id) REFERENCES users (id)
+        )
+        ''',
+    ]),
+    (2, 'indexes for the item feed, chat history and trade lookups', [
+        # /api/items, /api/items/others: status = 'available' ORDER BY created_at
+        'CREATE INDEX IF NOT EXISTS idx_items_status_created ON items (status, created_at)',
+        # /api/user/items, /api/items/user/<id>
+        'CREATE INDEX IF NOT EXISTS idx_items_user_status_created ON items (user_id, status, created_at)',
+        # /api/chat/messages/<trade_id>
+        'CREATE INDEX IF NOT EXISTS idx_chat_messages_trade_timestamp ON chat_messages (trade_id, timestamp)',
+        # /api/trades/sent, /api/trades/received and the OR in /api/trade/check
+        'CREATE INDEX IF NOT EXISTS idx_trades_sender_created ON trades (sender_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_trades_receiver_created ON trades (receiver_id, created_at)',
+    ]),
+    (3, 'index for keyset pagination of a user\'s listings', [
+        # /api/items/user/<id> pages over every status by (created_at, id)
+        'CREATE INDEX IF NOT EXISTS idx_items_user_created ON items (user_id, created_at)',
+    ]),
+    (4, 'index for incremental chat sync', [
+        # /api/chat/messages/<trade_id>?after_id= ranges over (trade_id, rowid)
+        'CREATE INDEX IF NOT EXISTS idx_chat_messages_trade ON chat_messages (trade_id)',
+    ]),
+    (5, 'per-table change counters for conditional GETs', [
+        # Bumped by triggers on every write, so any process can derive a
+        # cheap ETag / Last-Modified for a list without running its query.
+        '''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "INSERT OR IGNORE INTO table_versions (name) VALUES ('users'), ('items'), ('trades')",
+        *[
+            f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{op.lower()} AFTER {op} ON {table}
+            BEGIN
+                UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE name = '{table}';
+            END
+            '''
+            for table in ('users', 'items', 'trades')
+            for op in ('INSERT', 'UPDATE', 'DELETE')
+        ],
+    ]),
+    (6, 'full-text index over available items', [
+        # External-content FTS5 table: it stores only the index, the text
+        # stays in items. Only available items are indexed, so traded ones
+        # drop out of /api/items/search as soon as their status changes.
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5 (
+            title, description, category,
+            content = 'items', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+        ''',
+        # Default ranking: a title hit outweighs a category hit, which
+        # outweighs a description hit
+        "INSERT INTO items_fts (items_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 4.0)')",
+        '''
+        INSERT INTO items_fts (rowid, title, description, category)
+        SELECT id, title, description, category FROM items WHERE status = 'available'
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_fts_insert AFTER INSERT ON items
+        WHEN new.status = 'available'
+        BEGIN
+            INSERT INTO items_fts (rowid, title, description, category)
+            VALUES (new.id, new.title, new.description, new.category);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_fts_delete AFTER DELETE ON items
+        WHEN old.status = 'available'
+        BEGIN
+            INSERT INTO items_fts (items_fts, rowid, title, description, category)
+            VALUES ('delete', old.id, old.title, old.description, old.category);
+        END
+        ''',
+        # One trigger so the old entry is always removed before the new one
+        # is added; 'delete' must be given exactly the indexed values.
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_items_fts_update
+        AFTER UPDATE OF title, description, category, status ON items
+        BEGIN
+            INSERT INTO items_fts (items_fts, rowid, title, description, category)
+            SELECT 'delete', old.id, old.title, old.description, old.category
+            WHERE old.status = 'available';
+            INSERT INTO items_fts (rowid, title, description, category)
+            SELECT new.id, new.title, new.description, new.category
+            WHERE new.status = 'available';
+        END
+        ''',
+    ]),
+    (7, 'catalog filter indexes and facet counts', [
+        # /api/items?category=&min_price=&max_price=&sort=
+        'CREATE INDEX IF NOT EXISTS idx_items_status_category_created ON items (status, category, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_items_status_price ON items (status, price)',
+        'CREATE INDEX IF NOT EXISTS idx_items_status_category_price ON items (status, category, price)',
+        # Available items per (category, price bucket), so facet counts never
+        # touch items. Changing the buckets needs a new migration that
+        # rebuilds this table and its triggers.
+        '''
+        CREATE TABLE IF NOT EXISTS item_facet_counts (
+            category TEXT NOT NULL,
+            price_bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (category, price_bucket)
+        )
+        ''',
+        f'''
+        INSERT INTO item_facet_counts (category, price_bucket, count)
+        SELECT category, {price_bucket_v7('items')}, COUNT(*)
+        FROM items WHERE status = 'available'
+        GROUP BY 1, 2
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_item_facets_insert AFTER INSERT ON items
+        WHEN new.status = 'available'
+        BEGIN
+            INSERT INTO item_facet_counts (category, price_bucket, count)
+            VALUES (new.category, {price_bucket_v7('new')}, 1)
+            ON CONFLICT (category, price_bucket) DO UPDATE SET count = count + 1;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_item_facets_delete AFTER DELETE ON items
+        WHEN old.status = 'available'
+        BEGIN
+            UPDATE item_facet_counts SET count = count - 1
+            WHERE category = old.category AND price_bucket = {price_bucket_v7('old')};
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_item_facets_update
+        AFTER UPDATE OF category, price, status ON items
+        BEGIN
+            UPDATE item_facet_counts SET count = count - 1
+            WHERE old.status = 'available'
+              AND category = old.category AND price_bucket = {price_bucket_v7('old')};
+            INSERT INTO item_facet_counts (category, price_bucket, count)
+            SELECT new.category, {price_bucket_v7('new')}, 1
+            WHERE new.status = 'available'
+            ON CONFLICT (category, price_bucket) DO UPDATE SET count = count + 1;
+        END
+        ''',
+    ]),
+    (8, 'resized image variants', [
+        # One row per generated file; image_url is the original exactly as
+        # /api/upload returned it, which is what items.image_url holds
+        '''
+        CREATE TABLE IF NOT EXISTS image_variants (
+            image_url TEXT NOT NULL,
+            name TEXT NOT NULL,
+            format TEXT NOT NULL,
+            url TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (image_url, name, format)
+        )
+        ''',
+        # Item responses link to variants, so their validators track this too
+        "INSERT OR IGNORE INTO table_versions (name) VALUES ('image_variants')",
+        *[
+            f'''
+            CREATE TRIGGER IF NOT EXISTS trg_image_variants_version_{op.lower()} AFTER {op} ON image_variants
+            BEGIN
+                UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE name = 'image_variants';
+            END
+            '''
+            for op in ('INSERT', 'UPDATE', 'DELETE')
+        ],
+    ]),
+    (9, 'reference counts for content-addressed uploads', [
+        '''
+        CREATE TABLE IF NOT EXISTS image_blobs (
+            image_url TEXT PRIMARY KEY,
+            bytes INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Uploads from before this migration have no row and are never collected
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_image_blobs_item_insert AFTER INSERT ON items
+        BEGIN
+            UPDATE image_blobs SET refcount = refcount + 1 WHERE image_url = new.image_url;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_image_blobs_item_delete AFTER DELETE ON items
+        BEGIN
+            UPDATE image_blobs SET refcount = refcount - 1 WHERE image_url = old.image_url;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_image_blobs_item_update AFTER UPDATE OF image_url ON items
+        WHEN old.image_url IS NOT new.image_url
+        BEGIN
+            UPDATE image_blobs SET refcount = refcount - 1 WHERE image_url = old.image_url;
+            UPDATE image_blobs SET refcount = refcount + 1 WHERE image_url = new.image_url;
+        END
+        ''',
+    ]),
+    (10, 'resumable upload sessions', [
+        # Times are Unix seconds; busy_until is the lease of the PATCH writing to it
+        '''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            length INTEGER NOT NULL,
+            extension TEXT,
+            busy_until REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions(updated_at)',
+    ]),
+    (11, 'avatar catalog', [
+        # Rows outlive their files so an avatar that comes back keeps its id
+        '''
+        CREATE TABLE IF NOT EXISTS avatars (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            bytes INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            width INTEGER,
+            height INTEGER
+        )
+        ''',
+    ]),
+    (12, 'login sessions', [
+        # Times are Unix seconds; app_secrets holds the signing key when SECRET_KEY is not set
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)',
+        '''
+        CREATE TABLE IF NOT EXISTS app_secrets (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        ''',
+    ]),
+    (13, 'indexes and change counter for the unified trade list', [
+        # /api/trades?status= pages over one role's trades in one status
+        'CREATE INDEX IF NOT EXISTS idx_trades_sender_status_created ON trades (sender_id, status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_trades_receiver_status_created ON trades (receiver_id, status, created_at)',
+        # /api/trades?unread=1 counts a trade's unread messages for one reader;
+        # only unread rows are indexed, so read history costs nothing here
+        'CREATE INDEX IF NOT EXISTS idx_chat_messages_unread ON chat_messages (trade_id, receiver_id) WHERE is_read = 0',
+        # The unread counts make /api/trades depend on chat_messages
+        "INSERT OR IGNORE INTO table_versions (name) VALUES ('chat_messages')",
+        *[
+            f'''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_messages_version_{op.lower()} AFTER {op} ON chat_messages
+            BEGIN
+                UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE name = 'chat_messages';
+            END
+            '''
+            for op in ('INSERT', 'UPDATE', 'DELETE')
+        ],
+    ]),
+    (14, 'grace period for unreferenced uploads', [
+        # Unix seconds of the latest upload of the blob's bytes; older blobs
+        # count as uploaded long ago
+        'ALTER TABLE image_blobs ADD COLUMN uploaded_at REAL NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_image_blobs_unreferenced ON image_blobs(uploaded_at) WHERE refcount <= 0',
+    ]),
+    (15, 'avatars count as references to uploads', [
+        # /update-avatar takes any URL, an upload included; as migration 9 for items
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_image_blobs_user_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE image_blobs SET refcount = refcount + 1 WHERE image_url = new.avatar_url;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_image_blobs_user_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE image_blobs SET refcount = refcount - 1 WHERE image_url = old.avatar_url;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_image_blobs_user_update AFTER UPDATE OF avatar_url ON users
+        WHEN old.avatar_url IS NOT new.avatar_url
+        BEGIN
+            UPDATE image_blobs SET refcount = refcount - 1 WHERE image_url = old.avatar_url;
+            UPDATE image_blobs SET refcount = refcount + 1 WHERE image_url = new.avatar_url;
+        END
+        ''',
+        # Avatars set before this migration were not counted
+        '''
+        UPDATE image_blobs SET refcount =
+            (SELECT count(*) FROM items WHERE items.image_url = image_blobs.image_url)
+            + (SELECT count(*) FROM users WHERE users.avatar_url = image_blobs.image_url)
+        ''',
+    ]),
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(database, target=None):
+    """Bring ``database`` up to ``target`` (default: latest) and return the version.
+
+    Each step takes the write lock with BEGIN IMMEDIATE and re-reads the
+    version, so several workers starting at once apply every migration once.
+    """
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        for version, description, statements in MIGRATIONS:
+            if target is not None and version > target:
+                break
+            if schema_version(conn) >= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if schema_version(conn) >= version:
+                    conn.execute('ROLLBACK')
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except sqlite3.Error as e:
+                conn.execute('ROLLBACK')
+                raise sqlite3.OperationalError(
+                    f'Migration {version} ({description}) failed: {e}'
+                ) from e
+        return schema_version(conn)
+    finally:
+        conn.close()
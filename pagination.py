@@ -0,0 +1,55 @@
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidPageRequest(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    """Pack the sort key of the last row on a page into an opaque token."""
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidPageRequest('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidPageRequest('Invalid cursor')
+    return values
+
+
+def page_args(args, key_size=2, default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+    """Read ``limit`` and ``cursor`` from the query string.
+
+    Returns ``(limit, after)`` where ``after`` is the decoded sort key to
+    continue from, or None for the first page.
+    """
+    try:
+        limit = int(args.get('limit', default_limit))
+    except (TypeError, ValueError):
+        raise InvalidPageRequest('limit must be an integer')
+    if limit < 1:
+        raise InvalidPageRequest('limit must be positive')
+    limit = min(limit, max_limit)
+
+    token = args.get('cursor')
+    after = decode_cursor(token, key_size) if token else None
+    return limit, after
+
+
+def page(rows, limit, key, name='items'):
+    """Build the paginated response body from up to ``limit + 1`` rows."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        name: rows,
+        'next_cursor': encode_cursor(key(rows[-1])) if has_more and rows else None,
+    }
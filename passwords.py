@@ -0,0 +1,156 @@
+"""Password hashing.
+
+Passwords are stored as PHC strings, ``$scrypt$ln=14,r=8,p=1$<salt>$<hash>``,
+using hashlib's scrypt (OpenSSL), so there is no extra dependency. The
+parameters are part of the string. When they are raised, login rehashes
+each password whose parameters are out of date. It does the same for
+plaintext passwords stored before hashing existed, in the same step as
+the check.
+
+A hash costs tens of milliseconds of CPU on purpose. PasswordPool runs
+hashes on a few dedicated threads; hashlib releases the GIL while
+hashing. At most ``workers`` cores hash at once, and the rest stay with
+the other routes. At most ``queue_size`` more calls wait. Past that,
+PoolBusy is raised at once and the route answers 503, so a burst of
+logins cannot build an unbounded backlog.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PREFIX = '$scrypt$'
+
+
+class PoolBusy(RuntimeError):
+    pass
+
+
+def is_hashed(stored):
+    return stored.startswith(PREFIX)
+
+
+def _encode(raw):
+    return base64.b64encode(raw).decode().rstrip('=')
+
+
+def _decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+class ScryptHasher:
+    """scrypt with cost ``2 ** log_n``, block size ``r`` and parallelism ``p``.
+
+    Each hash needs ``128 * 2 ** log_n * r * p`` bytes of memory, 16 MiB
+    with the defaults.
+    """
+
+    def __init__(self, log_n=14, r=8, p=1, salt_bytes=16, hash_bytes=32):
+        self.log_n = log_n
+        self.r = r
+        self.p = p
+        self.salt_bytes = salt_bytes
+        self.hash_bytes = hash_bytes
+
+    @property
+    def params(self):
+        return f'ln={self.log_n},r={self.r},p={self.p}'
+
+    def hash(self, password):
+        salt = os.urandom(self.salt_bytes)
+        digest = self._derive(password, salt, self.log_n, self.r, self.p, self.hash_bytes)
+        return f'{PREFIX}{self.params}${_encode(salt)}${_encode(digest)}'
+
+    def verify(self, stored, password):
+        if not is_hashed(stored):
+            # A plaintext password from before hashing
+            return hmac.compare_digest(stored.encode(), password.encode())
+        try:
+            params, salt, digest = stored[len(PREFIX):].split('$')
+            settings = dict(item.split('=') for item in params.split(','))
+            log_n, r, p = int(settings['ln']), int(settings['r']), int(settings['p'])
+            salt, digest = _decode(salt), _decode(digest)
+        except (KeyError, ValueError):
+            return False
+        return hmac.compare_digest(self._derive(password, salt, log_n, r, p, len(digest)), digest)
+
+    def needs_rehash(self, stored):
+        return not stored.startswith(f'{PREFIX}{self.params}$')
+
+    def check(self, stored, password):
+        """Return ``(valid, replacement)``.
+
+        ``replacement`` is a new hash of ``password`` when it is valid but
+        ``stored`` is plaintext or uses other parameters, and None otherwise.
+        """
+        if not self.verify(stored, password):
+            return False, None
+        return True, self.hash(password) if self.needs_rehash(stored) else None
+
+    @staticmethod
+    def _derive(password, salt, log_n, r, p, length):
+        n = 1 << log_n
+        return hashlib.scrypt(
+            password.encode(), salt=salt, n=n, r=r, p=p, dklen=length,
+            maxmem=128 * n * r * p + 1024 * 1024,
+        )
+
+
+class PasswordPool:
+    """Runs ``hasher`` on ``workers`` threads, with room for ``queue_size`` waiting calls.
+
+    With no workers, hashes run on the calling thread, unbounded.
+    """
+
+    def __init__(self, hasher, workers=1, queue_size=16):
+        self.hasher = hasher
+        self.workers = workers
+        self.queue_size = queue_size
+        self._slots = threading.BoundedSemaphore(workers + queue_size) if workers > 0 else None
+        self._executor = None
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+        self._dummy = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def hash(self, password):
+        return self._run(self.hasher.hash, password)
+
+    def check(self, stored, password):
+        """ScryptHasher.check() on the pool.
+
+        ``stored`` may be None, for an unknown account. The check then
+        costs the same as a real one, so response times do not reveal
+        which emails are registered.
+        """
+        if stored is None:
+            self._run(self._check_unknown, password)
+            return False, None
+        return self._run(self.hasher.check, stored, password)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+    def _check_unknown(self, password):
+        if self._dummy is None or self.hasher.needs_rehash(self._dummy):
+            self._dummy = self.hasher.hash(os.urandom(16).hex())
+        self.hasher.verify(self._dummy, password)
+
+    def _run(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PoolBusy('Too many password checks in progress')
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
@@ -0,0 +1,216 @@
+"""Slow-query log and per-request sampling profiler.
+
+SlowQueryLog is handed to metrics.instrument_db() as its ``on_slow``
+callback. A statement slower than the threshold is logged as a warning
+with its fingerprint, duration and EXPLAIN QUERY PLAN. The plan is run
+once per fingerprint every ``plan_ttl`` seconds, so a burst of one slow
+query does not double the load. The last ``keep`` slow queries are kept
+for /debug/profile.
+
+SamplingProfiler records the stacks of the threads serving profiled
+requests. A single sampler thread runs only while at least one request
+is being profiled. Every ``interval`` seconds it reads
+sys._current_frames() and counts each profiled thread's stack. When a
+request ends, its stacks are written to ``directory`` in the folded
+format that flamegraph.pl, speedscope and inferno read ("a;b;c 12"), and
+added to a per-endpoint total. The sampler needs the GIL, so CPU-bound
+Python code is sampled at most every sys.getswitchinterval() (5 ms by
+default), whatever the interval.
+"""
+import hmac
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from metrics import fingerprint
+
+# Statements EXPLAIN QUERY PLAN can describe
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class SlowQueryLog:
+    """Logs statements taking ``threshold`` seconds or more; the threshold can be changed at any time."""
+
+    def __init__(self, threshold, logger='marketplace.slow_queries', keep=100, plan_ttl=300.0):
+        self.threshold = threshold
+        self.log = logging.getLogger(logger)
+        self.plan_ttl = plan_ttl
+        self.recent = deque(maxlen=keep)
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, sql, params, seconds, many=False):
+        statement = fingerprint(sql)
+        plan = self.plan(conn, statement, sql, None if many else params)
+        entry = {'statement': statement, 'ms': round(seconds * 1000, 2), 'plan': plan, 'at': time.time()}
+        with self._lock:
+            self.recent.append(entry)
+        self.log.warning('Slow query', extra={'fields': {k: entry[k] for k in ('statement', 'ms', 'plan')}})
+
+    def plan(self, conn, statement, sql, params):
+        """The statement's query plan as ``'SCAN items; SEARCH users USING ...'``, or None."""
+        if params is None or not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        now = time.monotonic()
+        cached = self._plans.get(statement)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        try:
+            # Straight to sqlite3, so the EXPLAIN itself is neither timed nor logged
+            rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            plan = '; '.join(row[-1] for row in rows)
+        except Exception as e:
+            plan = f'(no plan: {e})'
+        self._plans[statement] = (now + self.plan_ttl, plan)
+        return plan
+
+    def stats(self):
+        with self._lock:
+            return list(self.recent)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def folded_stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Profile:
+    """The samples of one request."""
+
+    __slots__ = ('label', 'thread_id', 'started', 'stacks')
+
+    def __init__(self, label, thread_id):
+        self.label = label
+        self.thread_id = thread_id
+        self.started = time.time()
+        self.stacks = Counter()
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads between start() and stop().
+
+    Per endpoint, at most ``max_stacks`` distinct stacks are kept in the
+    running total; the rest are counted under ``(other)``. Only the last
+    ``keep_files`` dumps stay on disk.
+    """
+
+    def __init__(self, directory='profiles', interval=0.005, keep_files=200, max_stacks=5000):
+        self.directory = directory
+        self.interval = interval
+        self.keep_files = keep_files
+        self.max_stacks = max_stacks
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+        self._files = deque()
+        self.totals = {}
+        self.requests = Counter()
+
+    def start(self, label):
+        profile = Profile(label, threading.get_ident())
+        with self._lock:
+            self._active[profile.thread_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+                self._thread.start()
+            self._wake.notify()
+        return profile
+
+    def stop(self, profile):
+        """Stop sampling, add to the totals and dump; returns the file written, or None."""
+        with self._lock:
+            self._active.pop(profile.thread_id, None)
+            total = self.totals.setdefault(profile.label, Counter())
+            for stack, count in profile.stacks.items():
+                if stack in total or len(total) < self.max_stacks:
+                    total[stack] += count
+                else:
+                    total['(other)'] += count
+            self.requests[profile.label] += 1
+        if not profile.stacks:
+            return None
+        return self._dump(profile)
+
+    def _dump(self, profile):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(profile.started))
+        path = os.path.join(self.directory, f'{stamp}-{profile.label}-{os.urandom(4).hex()}.folded')
+        with open(path, 'w') as f:
+            f.write(folded_text(profile.stacks))
+        with self._lock:
+            self._files.append(path)
+            stale = [self._files.popleft() for _ in range(len(self._files) - self.keep_files)]
+        for old in stale:
+            try:
+                os.unlink(old)
+            except FileNotFoundError:
+                pass
+        return path
+
+    def _sample(self):
+        while True:
+            # Under the lock, so stop() never reads a profile mid-update
+            with self._lock:
+                while not self._active:
+                    self._wake.wait()
+                frames = sys._current_frames()
+                for thread_id, profile in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.stacks[folded_stack(frame)] += 1
+                frames = frame = None
+            time.sleep(self.interval)
+
+    def summary(self, top=20):
+        """Per endpoint: profiled requests, samples, and the frames with the most samples."""
+        with self._lock:
+            totals = {label: Counter(stacks) for label, stacks in self.totals.items()}
+            requests = dict(self.requests)
+            files = list(self._files)
+        endpoints = {}
+        for label, stacks in totals.items():
+            inclusive, own = Counter(), Counter()
+            for stack, count in stacks.items():
+                frames = stack.split(';')
+                own[frames[-1]] += count
+                for frame in set(frames):
+                    inclusive[frame] += count
+            endpoints[label] = {
+                'requests': requests.get(label, 0),
+                'samples': sum(stacks.values()),
+                'self': own.most_common(top),
+                'inclusive': inclusive.most_common(top),
+            }
+        return {'interval': self.interval, 'endpoints': endpoints, 'files': files[-top:]}
+
+    def folded(self, label=None):
+        with self._lock:
+            merged = Counter()
+            for name, stacks in self.totals.items():
+                if label is None or name == label:
+                    merged.update(stacks)
+        return folded_text(merged)
+
+
+def folded_text(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+def token_matches(expected, given):
+    """Whether a profiling request is allowed: an exact match, never when no token is set."""
+    if not expected or not given:
+        return False
+    return hmac.compare_digest(expected.encode(), given.encode())
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import queue
+import threading
+
+
+class Subscription:
+    """A subscriber's view of one topic; events queue up until read."""
+
+    __slots__ = ('hub', 'topic', '_queue', 'dropped')
+
+    def __init__(self, hub, topic, maxsize):
+        self.hub = hub
+        self.topic = topic
+        self._queue = queue.SimpleQueue() if maxsize <= 0 else queue.Queue(maxsize)
+        self.dropped = 0
+
+    def deliver(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # A stalled reader must not block publishers. The event is lost
+            # to this subscriber, so its reader must notice ``dropped`` and
+            # have the client catch up from the database.
+            self.dropped += 1
+            self.hub.count_drop()
+
+    def get(self, timeout=None):
+        """Return the next event, or None if nothing arrives within ``timeout``."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncSubscription:
+    """Subscription read from an asyncio event loop instead of a thread.
+
+    Publishers run on other threads, so delivery hops onto the loop with
+    call_soon_threadsafe; an idle subscriber costs no thread at all.
+    """
+
+    __slots__ = ('hub', 'topic', '_loop', '_queue', 'dropped')
+
+    def __init__(self, hub, topic, maxsize, loop):
+        self.hub = hub
+        self.topic = topic
+        self._loop = loop
+        self._queue = asyncio.Queue(max(maxsize, 0))
+        self.dropped = 0
+
+    def deliver(self, event):
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # Loop already closed; the subscriber is going away
+            pass
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # As in Subscription.deliver
+            self.dropped += 1
+            self.hub.count_drop()
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class InMemoryBackend:
+    """Delivers straight to this process's subscribers. One worker only."""
+
+    def start(self, deliver):
+        self._deliver = deliver
+
+    def publish(self, topic, event):
+        self._deliver(topic, event)
+
+    def close(self):
+        pass
+
+
+class LoopbackBrokerBackend:
+    """Local stand-in for an external broker such as Redis pub/sub.
+
+    Events are serialized to JSON and handed to a dispatcher thread, the same
+    round trip a network broker imposes: publishers never run subscriber
+    code, payloads must be JSON-safe, and delivery is asynchronous. A real
+    multi-process backend implements the same start/publish/close methods
+    and calls ``deliver`` from its listener thread.
+    """
+
+    def __init__(self):
+        self._wire = queue.SimpleQueue()
+        self._thread = None
+
+    def start(self, deliver):
+        self._deliver = deliver
+        self._thread = threading.Thread(target=self._listen, name='pubsub-loopback', daemon=True)
+        self._thread.start()
+
+    def publish(self, topic, event):
+        self._wire.put(json.dumps({'topic': topic, 'event': event}))
+
+    def close(self):
+        self._wire.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def _listen(self):
+        while True:
+            raw = self._wire.get()
+            if raw is None:
+                return
+            message = json.loads(raw)
+            self._deliver(message['topic'], message['event'])
+
+
+BACKENDS = {
+    'memory': InMemoryBackend,
+    'loopback': LoopbackBrokerBackend,
+}
+
+
+class Hub:
+    """Publish/subscribe keyed by topic, e.g. 'trade:42'.
+
+    Subscribers always live in this process; ``backend`` decides how a
+    published event reaches the hubs of every process.
+    """
+
+    def __init__(self, backend=None, queue_size=100):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._topics = {}
+        # Events lost to full subscriber queues, across all subscribers
+        self.dropped = 0
+        self.backend = backend or InMemoryBackend()
+        self.backend.start(self._fanout)
+
+    def subscribe(self, topic, loop=None):
+        """Subscribe to ``topic``; pass an event loop to get an AsyncSubscription."""
+        if loop is not None:
+            sub = AsyncSubscription(self, topic, self.queue_size, loop)
+        else:
+            sub = Subscription(self, topic, self.queue_size)
+        with self._lock:
+            self._topics.setdefault(topic, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._topics.get(sub.topic)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._topics[sub.topic]
+
+    def publish(self, topic, event):
+        self.backend.publish(topic, event)
+
+    def count_drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def subscriber_count(self, topic=None):
+        with self._lock:
+            if topic is not None:
+                return len(self._topics.get(topic, ()))
+            return sum(len(subs) for subs in self._topics.values())
+
+    def close(self):
+        self.backend.close()
+
+    def _fanout(self, topic, event):
+        with self._lock:
+            subs = list(self._topics.get(topic, ()))
+        for sub in subs:
+            sub.deliver(event)
+
+
+def create_hub(backend='memory', queue_size=100):
+    try:
+        backend_cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f'Unknown pub/sub backend: {backend!r}')
+    return Hub(backend_cls(), queue_size=queue_size)
+
+
+def trade_topic(trade_id):
+    return f'trade:{int(trade_id)}'
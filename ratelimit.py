@@ -0,0 +1,225 @@
+"""Token-bucket rate limiting.
+
+Every (route, client) pair has a bucket of ``burst`` tokens that refills
+at ``limit / period`` tokens per second; a request takes one token or is
+turned away with the time until the next one. A check is one dict lookup
+and a little arithmetic under a lock, or one UPSERT against the shared
+store. Where the buckets live is decided by the store:
+
+  memory   an LRU dict in this process; each worker counts on its own, so
+           N workers let a client through N times as often
+  sqlite   a table in a separate database file (RATE_LIMIT_DATABASE),
+           shared by every worker on the host. It never touches users.db,
+           so throttling a noisy client does not add writes to the file
+           it was saturating.
+
+Rules are written as ``'<count>/<period>'``, e.g. ``'10/minute'``, with an
+optional burst: ``'10/minute burst 20'``.
+"""
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class Rule:
+    """``limit`` requests per ``period`` seconds, up to ``burst`` at once."""
+
+    __slots__ = ('limit', 'period', 'burst', 'rate')
+
+    def __init__(self, limit, period=1.0, burst=None):
+        if limit <= 0 or period <= 0:
+            raise ValueError('A rate limit needs a positive count and period')
+        self.limit = limit
+        self.period = period
+        self.burst = burst or limit
+        self.rate = limit / period
+
+    def __repr__(self):
+        return f'Rule({self.limit}, {self.period}, burst={self.burst})'
+
+
+def parse_rule(spec):
+    """A Rule from ``'10/minute'`` or ``'10/minute burst 20'``; None and Rules pass through."""
+    if spec is None or isinstance(spec, Rule):
+        return spec
+    try:
+        rate, *rest = spec.split()
+        count, _, unit = rate.partition('/')
+        period = PERIODS[unit.rstrip('s')] if unit else 1
+        burst = None
+        if rest:
+            keyword, value = rest
+            if keyword != 'burst':
+                raise ValueError(keyword)
+            burst = int(value)
+        return Rule(int(count), period, burst)
+    except (KeyError, ValueError):
+        raise ValueError(f'Bad rate limit: {spec!r}') from None
+
+
+class Decision:
+    __slots__ = ('allowed', 'limit', 'remaining', 'retry_after')
+
+    def __init__(self, allowed, limit, remaining, retry_after):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.retry_after = retry_after
+
+    def headers(self):
+        headers = {'X-RateLimit-Limit': str(self.limit), 'X-RateLimit-Remaining': str(self.remaining)}
+        if not self.allowed:
+            # Whole seconds, rounded up so a client that waits exactly this long gets in
+            headers['Retry-After'] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class MemoryStore:
+    """Buckets in this process, at most ``max_keys`` of them.
+
+    The least recently seen bucket is dropped first. That only resets it
+    to full, which is what an idle client's bucket would have refilled to.
+    """
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        """Take a token from ``key``'s bucket; return ``(allowed, tokens_left, retry_after)``."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(burst), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True, bucket[0], 0.0
+            return False, bucket[0], (1 - bucket[0]) / rate
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteStore:
+    """Buckets in a SQLite file that every worker on the host opens.
+
+    Each thread keeps its own autocommit connection. A check is a single
+    UPSERT, so it is atomic across processes without an explicit
+    transaction. The file holds nothing worth keeping, hence
+    ``synchronous=OFF``. Times are Unix seconds, which all processes share.
+    """
+
+    def __init__(self, database='ratelimits.db', timeout=5.0, idle_ttl=86400):
+        self.database = database
+        self.timeout = timeout
+        self.idle_ttl = idle_ttl
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            # Buckets idle this long are full again whatever their rule; dropping them keeps the file small
+            conn.execute('DELETE FROM buckets WHERE updated < ?', (time.time() - self.idle_ttl,))
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute('''
+            INSERT INTO buckets (key, tokens, updated) VALUES (:key, :burst - 1, :now)
+            ON CONFLICT (key) DO UPDATE
+                SET tokens = MIN(:burst, tokens + MAX(0, :now - updated) * :rate) - 1, updated = :now
+                WHERE MIN(:burst, tokens + MAX(0, :now - updated) * :rate) >= 1
+            RETURNING tokens
+        ''', {'key': key, 'burst': float(burst), 'rate': rate, 'now': now}).fetchone()
+        if row is not None:
+            return True, row[0], 0.0
+        # Refused: the row was left alone, so work out how long until a token is back
+        row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+        tokens = min(burst, row[0] + max(0.0, now - row[1]) * rate) if row else 0.0
+        return False, tokens, (1 - tokens) / rate
+
+    def clear(self):
+        self._connect().execute('DELETE FROM buckets')
+
+
+STORES = {
+    'memory': MemoryStore,
+    'sqlite': SQLiteStore,
+}
+
+
+def create_store(name, database=None):
+    try:
+        store_cls = STORES[name]
+    except KeyError:
+        raise ValueError(f'Unknown rate limit store: {name!r}')
+    if store_cls is SQLiteStore and database:
+        return SQLiteStore(database)
+    return store_cls()
+
+
+class RateLimiter:
+    """Applies per-route rules to clients.
+
+    ``rules`` maps a route's endpoint name to a rule spec; None exempts it.
+    Routes without an entry get ``default``, which may be None as well.
+    """
+
+    def __init__(self, store, rules=None, default=None, enabled=True):
+        self.store = store
+        self.enabled = enabled
+        self.default = parse_rule(default)
+        self.rules = {endpoint: parse_rule(spec) for endpoint, spec in (rules or {}).items()}
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def rule_for(self, endpoint):
+        return self.rules.get(endpoint, self.default)
+
+    def applies(self, endpoint):
+        """Whether hit() would count a request to ``endpoint``."""
+        return self.enabled and self.rule_for(endpoint) is not None
+
+    def hit(self, endpoint, client):
+        """Count a request by ``client`` to ``endpoint``; None if no rule applies."""
+        if not self.enabled:
+            return None
+        rule = self.rules.get(endpoint, self.default)
+        if rule is None:
+            return None
+        allowed, tokens, retry_after = self.store.take(f'{endpoint}|{client}', rule.rate, rule.burst)
+        if not allowed:
+            with self._lock:
+                self.limited += 1
+        return Decision(allowed, rule.limit, int(tokens), retry_after)
+
+
+def client_key(user_id, remote_addr):
+    """Who a bucket belongs to: the logged-in user, or else the address."""
+    return f'user:{user_id}' if user_id is not None else f'ip:{remote_addr}'
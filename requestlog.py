@@ -0,0 +1,186 @@
+"""Structured logging that stays off the request thread.
+
+configure() puts a QueueHandler on the root logger. A request thread only
+builds a LogRecord and drops it into a bounded queue. A listener thread
+formats each record as one JSON line and writes it out. When the queue is
+full, records are dropped and counted; a request never waits for stdout.
+
+No payload is logged in full, whoever logs it. Every message and field is
+cut to MAX_FIELD_CHARS before it is queued. Containers and bytes are
+reduced to their type and length, so a stray ``log.info('%s', items)``
+writes a short placeholder and not the catalog.
+
+RequestLog writes one access record per request: method, path without
+the query string, endpoint, status, duration, size, user id and address.
+It never records headers or bodies. Each route can have its own minimum
+level, and routine INFO records can be sampled.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+MAX_FIELD_CHARS = 200
+
+
+_SCALARS = {type(None), bool, int, float}
+
+
+def safe_value(value):
+    """``value`` if it is a short scalar, else a truncated or summarised stand-in."""
+    kind = type(value)
+    if kind in _SCALARS:
+        return value
+    if kind is str:
+        return value if len(value) <= MAX_FIELD_CHARS else value[:MAX_FIELD_CHARS] + '...'
+    if isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        return safe_value(str(value))
+    try:
+        return f'<{type(value).__name__} len={len(value)}>'
+    except TypeError:
+        return safe_value(str(value))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg and the record's ``fields``."""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': safe_value(record.getMessage()),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update((key, safe_value(value)) for key, value in fields.items())
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, separators=(',', ':'))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler over a bounded queue that drops records instead of blocking."""
+
+    def __init__(self, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self._drop_lock = threading.Lock()
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve and cut the message here, so the queue never holds a large
+        # argument and later changes to it cannot show up in the log. Only
+        # the exception's type and message are kept; the traceback would
+        # keep every frame alive until the listener got to it.
+        record.msg = safe_value(record.getMessage())
+        record.args = None
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.fields = {key: safe_value(value) for key, value in fields.items()}
+        if record.exc_info:
+            exc = record.exc_info[1]
+            record.exc_text = safe_value(f'{type(exc).__name__}: {exc}')
+            record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._drop_lock:
+                self.dropped += 1
+
+
+_listener = None
+_handler = None
+
+
+def configure(stream=None, level='INFO', queue_size=10000):
+    """Send the root logger's records through a background writer; returns the queue handler.
+
+    Calling it again changes the level and, if given, the output stream.
+    """
+    global _listener, _handler
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _handler is not None:
+        if stream is not None:
+            _listener.handlers[0].setStream(stream)
+        return _handler
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _handler = DroppingQueueHandler(queue_size)
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    root.addHandler(_handler)
+    atexit.register(shutdown)
+    return _handler
+
+
+def shutdown():
+    """Write out what is queued and stop the writer thread."""
+    global _listener, _handler
+    if _listener is not None:
+        _listener.stop()
+        logging.getLogger().removeHandler(_handler)
+        _listener = _handler = None
+
+
+def status_level(status):
+    if status >= 500:
+        return logging.ERROR
+    if status >= 400:
+        return logging.WARNING
+    return logging.INFO
+
+
+class RequestLog:
+    """Access records for ``logger``.
+
+    ``route_levels`` maps an endpoint name to the lowest level logged for
+    it, e.g. ``{'health_check': 'WARNING'}`` to skip successful probes.
+    Other endpoints use the logger's level. Of the records below WARNING
+    that pass, ``sample_rate`` is the fraction kept.
+    """
+
+    def __init__(self, logger='requests', sample_rate=1.0, route_levels=None, enabled=True):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.sample_rate = sample_rate
+        self.route_levels = {
+            endpoint: logging.getLevelName(level) if isinstance(level, str) else level
+            for endpoint, level in (route_levels or {}).items()
+        }
+        self.enabled = enabled
+
+    def wants(self, endpoint, level):
+        if not self.enabled:
+            return False
+        minimum = self.route_levels.get(endpoint)
+        if minimum is not None and level < minimum:
+            return False
+        if not self.logger.isEnabledFor(level):
+            return False
+        return level >= logging.WARNING or self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def emit(self, level, fields):
+        """Log a request that wants() let through; ``fields`` should hold scalars, and is cut down anyway."""
+        # makeRecord() skips the caller lookup Logger.log() would do
+        record = self.logger.makeRecord(
+            self.logger.name, level, '(request)', 0, 'request', None, None, extra={'fields': fields}
+        )
+        self.logger.handle(record)
+
+    def record(self, endpoint, status, fields):
+        level = status_level(status)
+        if not self.wants(endpoint, level):
+            return False
+        self.emit(level, fields)
+        return True
@@ -0,0 +1,27 @@
+import re
+
+MAX_TERMS = 16
+
+# A word, optionally followed by * for a prefix query
+_TERM = re.compile(r'(\w+)(\*?)')
+
+
+class InvalidSearch(ValueError):
+    pass
+
+
+def match_expression(text):
+    """Turn free text from ``?q=`` into a safe FTS5 MATCH expression.
+
+    Every word is quoted, so FTS5 operators and punctuation in user input
+    are taken literally instead of raising syntax errors. A trailing ``*``
+    (``lap*``) makes that word a prefix query. All words must match.
+    """
+    terms = _TERM.findall(text or '')[:MAX_TERMS]
+    if not terms:
+        raise InvalidSearch('q must contain at least one word')
+    return ' '.join(f'"{word}"{star}' for word, star in terms)
+
+
+def rank_sort_key(item):
+    return item['rank'], item['id']
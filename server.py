@@ -1,111 +1,507 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 import sqlite3
 import os
 import uuid
-from datetime import datetime
+import hashlib
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+from werkzeug.exceptions import NotFound
 from werkzeug.utils import secure_filename
 
+import avatars
+import blobstore
+import cache
+import catalog
+import db
+import health
+import images
+import mailer
+import metrics
+import migrations
+import pagination
+import passwords
+import profiling
+import pubsub
+import ratelimit
+import requestlog
+import search
+import sessions
+import staticfiles
+import streaming
+import trades
+import uploads
+from db import get_db, get_read_db
+
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
-curr_user = {}
 
 # Configuration
 app.config['UPLOAD_FOLDER'] = 'assets/images'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+app.config['DATABASE'] = 'users.db'
+app.config['DB_POOL_SIZE'] = 8  # 0 opens a new connection per request
+app.config['DB_READ_POOL_SIZE'] = 8  # read-only connections for GET routes
+app.config['DB_STORAGE_PROFILE'] = 'tuned'  # see db.STORAGE_PROFILES
+app.config['LEGACY_ITEM_LISTS'] = False  # True restores the unpaginated item arrays
+app.config['STREAM_LARGE_LISTS'] = True  # stream unbounded list responses instead of buffering them
+app.config['CHAT_LONG_POLL_TIMEOUT'] = 25  # max seconds a ?wait= poll is held open
+app.config['CHAT_MAX_BATCH'] = 200  # cap on ?limit= for chat history
+app.config['CHAT_PUBSUB_BACKEND'] = 'memory'  # see pubsub.BACKENDS
+app.config['CHAT_STREAM_HEARTBEAT'] = 15  # seconds between SSE keep-alive comments
+app.config['FEED_CACHE_ENABLED'] = True
+app.config['FEED_CACHE_SIZE'] = 512  # entries (feed pages + single items)
+app.config['FEED_CACHE_TTL'] = 30  # seconds; writes invalidate immediately
+app.config['CONTENT_ADDRESSED_UPLOADS'] = True  # name uploads by their SHA-256; off = uuid names
+app.config['STREAMING_UPLOADS'] = True  # parse /api/upload bodies in chunks; needs CONTENT_ADDRESSED_UPLOADS
+app.config['UPLOAD_SESSION_TTL'] = 24 * 3600  # seconds an idle resumable upload is kept
+app.config['UPLOAD_GRACE'] = 24 * 3600  # seconds a finished upload no item uses yet is kept
+app.config['IMMUTABLE_MAX_AGE'] = 365 * 24 * 3600  # seconds, for content-addressed files
+app.config['AVATAR_FOLDER'] = 'assets/avatars/png'
+app.config['AVATAR_WATCH_INTERVAL'] = 5.0  # seconds between rescans; None scans once
+app.config['STATIC_MAX_AGE'] = 3600  # seconds, for other images and avatars
+app.config['STATIC_OFFLOAD'] = None  # 'x-accel-redirect' (nginx) or 'x-sendfile' behind a proxy
+app.config['STATIC_ACCEL_PREFIX'] = '/internal'  # nginx internal location for X-Accel-Redirect
+app.config['IMAGE_PIPELINE_ENABLED'] = True  # resized variants of uploads; needs Pillow
+app.config['IMAGE_WORKERS'] = os.cpu_count() or 2
+app.config['IMAGE_VARIANT_WIDTHS'] = images.DEFAULT_WIDTHS
+app.config['IMAGE_FORMATS'] = images.DEFAULT_FORMATS
+app.config['IMAGE_QUALITY'] = 80
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')  # None: generated once and kept in the database
+app.config['SESSION_STORE'] = 'sqlite'  # see sessions.STORES; 'memory' only works with one worker
+app.config['SESSION_MAX_AGE'] = 30 * 24 * 3600  # seconds a login lasts
+app.config['AUTH_COOKIE_NAME'] = 'auth_token'
+app.config['USER_CACHE_SIZE'] = 1024  # user records kept per worker
+app.config['USER_CACHE_TTL'] = 30  # seconds; other workers see profile changes after this
+app.config['PASSWORD_RESET_MAX_AGE'] = 15 * 60  # seconds a forgot-password token is valid
+app.config['PASSWORD_RESET_TOKEN_IN_RESPONSE'] = False  # development only: also return the token to whoever asks
+app.config['PASSWORD_RESET_URL'] = os.environ.get('PASSWORD_RESET_URL')  # link mailed, with {token}; None mails the token
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER')  # SMTP host; None logs instead of sending
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
+app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
+app.config['MAIL_FROM'] = os.environ.get('MAIL_FROM', 'no-reply@localhost')
+app.config['PASSWORD_SCRYPT_LOG_N'] = 14  # scrypt cost 2**14: 16 MiB and ~35ms per hash; raising it rehashes on login
+app.config['PASSWORD_SCRYPT_R'] = 8
+app.config['PASSWORD_SCRYPT_P'] = 1
+app.config['PASSWORD_HASH_WORKERS'] = max(1, (os.cpu_count() or 2) // 2)  # cores hashing at once; 0 hashes inline
+app.config['PASSWORD_HASH_QUEUE'] = 16  # hashes that may wait for a worker before logins get 503
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMIT_STORE'] = 'memory'  # see ratelimit.STORES; 'sqlite' shares buckets between workers
+app.config['RATE_LIMIT_DATABASE'] = 'ratelimits.db'  # for the 'sqlite' store; kept apart from DATABASE
+app.config['RATE_LIMIT_DEFAULT'] = '20/second burst 40'  # per client, for endpoints not in RATE_LIMITS
+app.config['RATE_LIMITS'] = {  # endpoint name -> rule per client (user, else address); None exempts it
+    'login': '10/minute',
+    'register': '5/minute',
+    'forgot_password': '5/minute',
+    'change_pwd': '10/minute',
+    'get_messages': '2/second burst 10',
+    'stream_messages': '30/minute',
+    'send_message': '1/second burst 10',
+    'get_items': '5/second burst 20',
+    'search_items': '5/second burst 20',
+    'upload_image': '30/minute',
+    'create_upload': '30/minute',
+    'append_upload': None,  # counted per upload by create_upload
+    'serve_image': None,
+    'serve_avatar': None,
+    'static': None,
+    'health_check': None,
+    'liveness_check': None,
+}
+app.config['LOG_LEVEL'] = 'INFO'
+app.config['LOG_QUEUE_SIZE'] = 10000  # records waiting for the writer thread; more are dropped and counted
+app.config['LOG_SAMPLE_RATE'] = 1.0  # fraction of successful requests logged; 4xx/5xx are always kept
+app.config['LOG_ROUTE_LEVELS'] = {  # endpoint name -> lowest level logged for it
+    'serve_image': 'WARNING',
+    'serve_avatar': 'WARNING',
+    'static': 'WARNING',
+    'health_check': 'WARNING',
+    'liveness_check': 'WARNING',
+    'metrics_endpoint': 'WARNING',
+    'debug_profile': 'WARNING',
+}
+app.config['METRICS_ENABLED'] = True  # /metrics, and timing of every route and SQL statement
+app.config['SLOW_QUERY_MS'] = 250  # log statements at least this slow, with their query plan; None disables
+app.config['PROFILE_ENABLED'] = False  # opt-in: the request profiler and /debug/profile
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')  # X-Profile and /debug/profile need it; unset refuses both
+app.config['PROFILE_SAMPLE_RATE'] = 0.0  # fraction of requests profiled without an X-Profile header
+app.config['PROFILE_INTERVAL'] = 0.005  # seconds between stack samples
+app.config['PROFILE_DIR'] = 'profiles'  # folded stacks, one file per profiled request
+app.config['MAX_IN_FLIGHT'] = 128  # requests in progress past which new ones get 503 at once; None disables
+app.config['READY_MAX_IN_FLIGHT'] = 96  # readiness fails from this many requests in progress
+app.config['HEALTH_DB_TIMEOUT'] = 0.25  # seconds the readiness probe waits for the write lock
+app.config['HEALTH_DB_MAX_LATENCY_MS'] = 250
+app.config['HEALTH_MIN_FREE_DISK_MB'] = 200  # for the upload folder and the database's folder
+app.config['HEALTH_CACHE_TTL'] = 1.0  # seconds a readiness result is reused
+
+db.init_app(app)
+
+metrics_registry = metrics.Registry()
+http_metrics = metrics.HttpMetrics(metrics_registry) if app.config['METRICS_ENABLED'] else None
+slow_query_log = None
+if app.config['SLOW_QUERY_MS'] is not None:
+    slow_query_log = profiling.SlowQueryLog(app.config['SLOW_QUERY_MS'] / 1000)
+if app.config['METRICS_ENABLED'] or slow_query_log is not None:
+    metrics.instrument_db(metrics_registry, on_slow=slow_query_log)
+request_profiler = profiling.SamplingProfiler(
+    app.config['PROFILE_DIR'], interval=app.config['PROFILE_INTERVAL'],
+) if app.config['PROFILE_ENABLED'] else None
+
+log_handler = requestlog.configure(level=app.config['LOG_LEVEL'], queue_size=app.config['LOG_QUEUE_SIZE'])
+log = logging.getLogger('marketplace')
+request_log = requestlog.RequestLog(
+    'marketplace.requests',
+    sample_rate=app.config['LOG_SAMPLE_RATE'],
+    route_levels=app.config['LOG_ROUTE_LEVELS'],
+)
+
+# Read-through cache of serialized /api/items pages and /api/items/<id> bodies.
+# Keys carry the table_versions counters, so writes from other workers or
+# straight to the database miss here too; anything in this process that
+# changes an item or the owner fields joined into it still calls
+# invalidate_feed_cache() after committing, to drop the dead entries.
+feed_cache = cache.TTLCache(
+    maxsize=app.config['FEED_CACHE_SIZE'],
+    ttl=app.config['FEED_CACHE_TTL'],
+    enabled=app.config['FEED_CACHE_ENABLED'],
+)
+
+def invalidate_feed_cache():
+    feed_cache.invalidate()
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+content_store = blobstore.ContentStore(
+    app.config['UPLOAD_FOLDER'], '/assets/images/', grace=app.config['UPLOAD_GRACE'],
+)
+# Resumable uploads always go to the content store
+resumable_uploads = uploads.ResumableUploads(
+    content_store,
+    app.config['ALLOWED_EXTENSIONS'],
+    app.config['MAX_CONTENT_LENGTH'],
+    connect=get_db,
+    release=db.release_db,
+    ttl=app.config['UPLOAD_SESSION_TTL'],
+)
+
+def static_files(folder, url_prefix):
+    return staticfiles.StaticFiles(
+        folder,
+        url_prefix,
+        max_age=app.config['STATIC_MAX_AGE'],
+        immutable_max_age=app.config['IMMUTABLE_MAX_AGE'],
+        offload=app.config['STATIC_OFFLOAD'],
+        accel_prefix=app.config['STATIC_ACCEL_PREFIX'],
+        response_class=app.response_class,
+    )
+
+image_files = static_files(app.config['UPLOAD_FOLDER'], '/assets/images/')
+avatar_files = static_files(app.config['AVATAR_FOLDER'], '/assets/avatars/png/')
+
+@contextmanager
+def app_db():
+    # A pooled connection outside of (or alongside) a request
+    with app.app_context():
+        yield get_db()
+
+# Listed when the avatar folder is missing
+DEFAULT_AVATARS = [
+    {'id': i, 'name': f'3d_{i}.png', 'path': f'assets/avatars/png/3d_{i}.png'}
+    for i in range(1, 6)
+]
+
+avatar_registry = avatars.AvatarRegistry(
+    app.config['AVATAR_FOLDER'],
+    'assets/avatars/png/',
+    app_db,
+    fallback=DEFAULT_AVATARS,
+    watch_interval=app.config['AVATAR_WATCH_INTERVAL'],
+    dumps=app.json.dumps,
+)
+
+def record_image_variants(image_url, variants):
+    # Called on an image worker thread once an upload's variants are written
+    with app.app_context():
+        conn = get_db()
+        conn.executemany('''
+            INSERT OR REPLACE INTO image_variants (image_url, name, format, url, width, height, bytes)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (image_url, v['name'], v['format'], f"/assets/images/{v['filename']}", v['width'], v['height'], v['bytes'])
+            for v in variants
+        ])
+        conn.commit()
+    invalidate_feed_cache()
+
+image_pipeline = images.ImagePipeline(
+    app.config['UPLOAD_FOLDER'],
+    record_image_variants,
+    widths=app.config['IMAGE_VARIANT_WIDTHS'],
+    formats=app.config['IMAGE_FORMATS'],
+    quality=app.config['IMAGE_QUALITY'],
+    workers=app.config['IMAGE_WORKERS'] if app.config['IMAGE_PIPELINE_ENABLED'] else 0,
+)
+
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            firstname TEXT NOT NULL,
-            lastname TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            avatar_url TEXT DEFAULT 'assets/avatars/avatar1.png',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Items table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            category TEXT NOT NULL,
-            price REAL NOT NULL,
-            description TEXT NOT NULL,
-            image_url TEXT NOT NULL,
-            status TEXT DEFAULT 'available',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            trade_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            message TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            is_read BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (sender_id) REFERENCES users (id),
-            FOREIGN KEY (receiver_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Trades table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS trades (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            item1_id INTEGER NOT NULL,
-            item2_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            status TEXT DEFAULT 'pending',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (item1_id) REFERENCES items (id),
-            FOREIGN KEY (item2_id) REFERENCES items (id),
-            FOREIGN KEY (sender_id) REFERENCES users (id),
-            FOREIGN KEY (receiver_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    db.configure_database(app)
+    migrations.migrate(app.config['DATABASE'])
 
 BASE_URL = "https://zhmbn1l9-5000.inc1.devtunnels.ms/"  
 
 @app.before_request
 def log_request_info():
-    print(f"Request from: {request.remote_addr}")
-    print(f"Method: {request.method}")
-    print(f"Path: {request.path}")
+    g.request_started = time.perf_counter()
+
+# Probes must answer on a saturated node. Chat streams and long polls sit
+# idle for minutes; under WSGI each still holds a thread, but counting them
+# would let idle chat clients fail readiness and shed everything else.
+# They show up as chat_subscribers instead.
+UNCOUNTED_ENDPOINTS = {'health_check', 'liveness_check', 'metrics_endpoint', 'stream_messages'}
+
+in_flight = health.InFlight(app.config['MAX_IN_FLIGHT'])
+
+@app.before_request
+def admit_request():
+    if request.endpoint in UNCOUNTED_ENDPOINTS:
+        return None
+    if request.endpoint == 'get_messages' and request.args.get('wait', 0, type=float) > 0:
+        # A long poll, parked like a stream until a message arrives
+        return None
+    if not in_flight.enter():
+        response = jsonify({'message': 'Server busy, try again shortly'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    g.in_flight = True
+    return None
+
+@app.teardown_request
+def release_request(exc=None):
+    # Teardown runs even when a view or hook raised, so the count cannot leak
+    if g.pop('in_flight', False):
+        in_flight.leave()
+
+@app.after_request
+def log_request(response):
+    # Streamed bodies are still being sent; their duration is time to first byte
+    started = g.get('request_started')
+    level = requestlog.status_level(response.status_code)
+    if started is not None and request_log.wants(request.endpoint, level):
+        user = g.get('_current_user')
+        request_log.emit(level, {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'ms': round((time.perf_counter() - started) * 1000, 2),
+            'bytes': response.content_length,
+            'user_id': user['id'] if user else None,
+            'ip': request.remote_addr,
+        })
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if http_metrics is not None and started is not None:
+        http_metrics.observe(
+            request.endpoint or 'unmatched', request.method, response.status_code,
+            time.perf_counter() - started, response.content_length,
+        )
+    return response
+
+rate_limiter = ratelimit.RateLimiter(
+    ratelimit.create_store(app.config['RATE_LIMIT_STORE'], app.config['RATE_LIMIT_DATABASE']),
+    app.config['RATE_LIMITS'],
+    default=app.config['RATE_LIMIT_DEFAULT'],
+    enabled=app.config['RATE_LIMIT_ENABLED'],
+)
+
+RATE_LIMIT_MESSAGE = 'Too many requests, slow down'
+
+def rate_limited(decision):
+    response = jsonify({'message': RATE_LIMIT_MESSAGE})
+    response.headers.update(decision.headers())
+    return response, 429
+
+@app.before_request
+def enforce_rate_limit():
+    # Unknown URLs, CORS preflights and exempt routes are free: no rule, no
+    # user lookup. The lookup opens a read connection, which the route reuses.
+    if request.endpoint is None or request.method == 'OPTIONS' or not rate_limiter.applies(request.endpoint):
+        return None
+    user = current_user()
+    decision = rate_limiter.hit(
+        request.endpoint, ratelimit.client_key(user['id'] if user else None, request.remote_addr)
+    )
+    if decision is not None and not decision.allowed:
+        return rate_limited(decision)
+    return None
+
+@app.before_request
+def start_request_profile():
+    # X-Profile asks for this request to be profiled; others are by PROFILE_SAMPLE_RATE
+    if request_profiler is None or request.endpoint in (None, 'debug_profile', 'metrics_endpoint', 'health_check', 'liveness_check'):
+        return None
+    asked = request.headers.get('X-Profile')
+    if asked is not None:
+        if not profiling.token_matches(app.config['PROFILE_TOKEN'], asked):
+            return None
+    elif random.random() >= app.config['PROFILE_SAMPLE_RATE']:
+        return None
+    g.profile = request_profiler.start(request.endpoint)
+    return None
+
+@app.teardown_request
+def finish_request_profile(exc=None):
+    # Teardown runs after a streamed body is sent, so streams are profiled whole
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.stop(profile)
 
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+def wants_legacy_list():
+    # Old clients can still ask for the full array with ?legacy=1
+    return app.config['LEGACY_ITEM_LISTS'] or request.args.get('legacy') == '1'
+
+def item_page_args():
+    if wants_legacy_list():
+        return None, None
+    return pagination.page_args(request.args)
+
+def item_sort_key(item):
+    return item['created_at'], item['id']
+
+# What item bodies are built from; their ETags and cache keys track these
+ITEM_TABLES = ('items', 'users', 'image_variants')
+
+def cached_json(key, loader, tables):
+    # loader returns (payload, status); the serialized body is what gets cached,
+    # under the versions of ``tables`` the request's ETag is built from. The
+    # body is loaded after those versions were read, so it is never older.
+    versions = tuple(row[:2] for row in table_versions(tables))
+    def load():
+        payload, status = loader()
+        return app.json.dumps(payload) + '\n', status
+    body, status = feed_cache.get_or_load(key + (versions,), load)
+    return app.response_class(body, status=status, mimetype=app.json.mimetype)
+
+def streamed_json(rows, key=None):
+    """Respond with ``rows`` encoded incrementally as a JSON array.
+
+    The query must already have been executed so SQL errors still become a
+    500; the generator keeps the request context (and its pooled connection)
+    alive until the last row is sent. With STREAM_LARGE_LISTS off the rows
+    are collected and sent with jsonify, as before.
+    """
+    if not app.config['STREAM_LARGE_LISTS']:
+        rows = list(rows)
+        return jsonify({key: rows} if key is not None else rows)
+    # Same output as jsonify outside debug mode, with one encoder per response
+    encoder = json.JSONEncoder(
+        default=app.json.default,
+        ensure_ascii=app.json.ensure_ascii,
+        sort_keys=app.json.sort_keys,
+        separators=(',', ':'),
+    )
+    body = streaming.json_array(rows, encoder.encode, key)
+    return app.response_class(stream_with_context(body), mimetype=app.json.mimetype)
+
+def feed_item_to_dict(item):
+    # item is an items row followed by the owner's firstname, lastname,
+    # avatar_url and the thumbnail variant's url (None until it is generated)
+    return {
+        'id': item[0],
+        'user_id': item[1],
+        'title': item[2],
+        'category': item[3],
+        'price': item[4],
+        'description': item[5],
+        'image_url': item[6],
+        'status': item[7],
+        'created_at': item[8],
+        'user_firstname': item[9],
+        'user_lastname': item[10],
+        'user_avatar_url': item[11],
+        'thumbnail_url': item[12] or item[6]
+    }
+
+def table_versions(tables):
+    # (name, version, updated_at) for ``tables`` from the trigger-maintained
+    # counters (migration 5). Read once per request, so a route's ETag and
+    # its feed cache key come from the same snapshot.
+    tables = tuple(sorted(tables))
+    seen = g.setdefault('table_versions', {})
+    rows = seen.get(tables)
+    if rows is None:
+        placeholders = ','.join('?' * len(tables))
+        cursor = get_read_db().cursor()
+        cursor.execute(
+            f'SELECT name, version, updated_at FROM table_versions WHERE name IN ({placeholders}) ORDER BY name',
+            tables,
+        )
+        rows = seen[tables] = tuple(cursor.fetchall())
+    return rows
+
+def table_validators(tables, scope=None):
+    # ETag and Last-Modified for a response built from ``tables``
+    rows = table_versions(tables)
+    token = repr((request.full_path, app.config['LEGACY_ITEM_LISTS'], scope, [row[:2] for row in rows]))
+    etag = hashlib.sha1(token.encode()).hexdigest()[:24]
+    last_modified = max((row[2] for row in rows if row[2]), default=None)
+    if last_modified:
+        last_modified = datetime.strptime(last_modified, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return etag, last_modified
+
+def conditional(*tables, per_user=False):
+    """Serve a GET list route with ETag/Last-Modified validators.
+
+    A request whose If-None-Match still matches gets a 304 before the view
+    (and its query) runs. The ETag is checked before the view reads, so a
+    write landing in between only makes the next revalidation miss. A view
+    answering from the feed cache looks it up by the same version read.
+    ``per_user`` may also be a predicate, for routes only some of whose
+    requests depend on who is asking.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            scoped = per_user() if callable(per_user) else per_user
+            user = current_user() if scoped else None
+            if scoped and not user:
+                return view(*args, **kwargs)
+            etag, last_modified = table_validators(tables, user['id'] if scoped else None)
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'private, no-cache' if scoped else 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
 # Database helper functions
 def get_user_by_email(email):
-    conn = sqlite3.connect('users.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
     user = cursor.fetchone()
-    conn.close()
     
     if user:
         return {
@@ -120,11 +516,12 @@ def get_user_by_email(email):
     return None
 
 def get_user_by_id(user_id):
-    conn = sqlite3.connect('users.db')
+    # Runs for every authenticated request (through the user cache), so it
+    # reads from the read pool and leaves write slots to writers
+    conn = get_read_db()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
     user = cursor.fetchone()
-    conn.close()
     
     if user:
         return {
@@ -138,15 +535,100 @@ def get_user_by_id(user_id):
         }
     return None
 
+def load_session_user(user_id):
+    # The record current_user() returns, cached; the password stays out of it
+    user = get_user_by_id(user_id)
+    if user:
+        del user['password']
+    return user
+
+def stored_password(user_id):
+    user = get_user_by_id(user_id)
+    return user['password'] if user else None
+
+def session_secret():
+    # Every worker has to sign with the same key
+    if app.config['SECRET_KEY']:
+        return app.config['SECRET_KEY']
+    with app_db() as conn:
+        return sessions.stored_secret(conn)
+
+auth_sessions = sessions.SessionManager(
+    session_secret,
+    sessions.create_store(app.config['SESSION_STORE'], get_db, get_read_db),
+    load_session_user,
+    max_age=app.config['SESSION_MAX_AGE'],
+    cookie_name=app.config['AUTH_COOKIE_NAME'],
+    reset_max_age=app.config['PASSWORD_RESET_MAX_AGE'],
+    user_cache_size=app.config['USER_CACHE_SIZE'],
+    user_cache_ttl=app.config['USER_CACHE_TTL'],
+)
+
+PASSWORD_RESET_COOKIE = 'password_reset'
+PASSWORD_RESET_MESSAGE = 'If the email exists, a reset link will be sent'
+
+outgoing_mail = mailer.create_mailer(
+    app.config['MAIL_SERVER'],
+    port=app.config['MAIL_PORT'],
+    sender=app.config['MAIL_FROM'],
+    username=app.config['MAIL_USERNAME'],
+    password=app.config['MAIL_PASSWORD'],
+)
+
+def send_password_reset(user, token):
+    minutes = auth_sessions.reset_max_age // 60
+    link = app.config['PASSWORD_RESET_URL']
+    action = f'open {link.format(token=token)}' if link else f'enter this code: {token}'
+    outgoing_mail.send(user['email'], 'Reset your password', (
+        f"Hi {user['firstname']},\n\n"
+        f'To choose a new password, {action}\n\n'
+        f'This works once, within {minutes} minutes. If you did not ask for it, ignore this message.\n'
+    ))
+
+password_pool = passwords.PasswordPool(
+    passwords.ScryptHasher(
+        log_n=app.config['PASSWORD_SCRYPT_LOG_N'],
+        r=app.config['PASSWORD_SCRYPT_R'],
+        p=app.config['PASSWORD_SCRYPT_P'],
+    ),
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    queue_size=app.config['PASSWORD_HASH_QUEUE'],
+)
+
+def password_pool_busy():
+    response = jsonify({'message': 'Too many sign-ins at the moment, try again shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def request_token():
+    return auth_sessions.token_from(request.headers.get('Authorization'), request.cookies)
+
+def current_user():
+    """The logged-in user making this request, or None.
+
+    The record is shared with other requests through the user cache and
+    must not be modified.
+    """
+    if '_current_user' not in g:
+        g._current_user = auth_sessions.user(request_token())
+    return g._current_user
+
+def set_auth_cookie(response, token):
+    # For clients that keep cookies; the others send the token as a Bearer header
+    response.set_cookie(
+        auth_sessions.cookie_name, token, max_age=auth_sessions.max_age,
+        httponly=True, samesite='Lax', secure=request.is_secure,
+    )
+
 @app.route('/api/get-user', methods=['GET'])
 def get_current_user():
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'User not logged in'}), 401
 
     try:
         # Get the complete user data from database
-        conn = sqlite3.connect('users.db')
+        conn = get_read_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -155,7 +637,6 @@ def get_current_user():
         ''', (curr_user['id'],))
         
         user = cursor.fetchone()
-        conn.close()
         
         if user:
             user_data = {
@@ -194,24 +675,27 @@ def register():
         if get_user_by_email(email):
             return jsonify({'message': 'User already exists'}), 409
         
+        # Hashing takes a while; don't hold a pooled connection meanwhile
+        db.release_db()
+        password_hash = password_pool.hash(password)
         
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO users (firstname, lastname, email, password)
             VALUES (?, ?, ?, ?)
-        ''', (firstname, lastname, email, password))
+        ''', (firstname, lastname, email, password_hash))
         conn.commit()
-        conn.close()
         
         return jsonify({'message': 'User created successfully'}), 200
         
+    except passwords.PoolBusy:
+        return password_pool_busy()
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
 @app.route('/api/login', methods=['POST'])
 def login():
-    global curr_user
     try:
         data = request.get_json()
         
@@ -224,16 +708,26 @@ def login():
         # Get user from database
         user = get_user_by_email(email)
         
-        if not user:
-            return jsonify({'message': 'Invalid credentials'}), 401
-        
-        # Verify password
-        if user['password'] != password:
+        # Verify password, on the hashing pool and without holding a pooled
+        # connection. Unknown emails cost the same, so timing reveals nothing.
+        db.release_db()
+        valid, rehashed = password_pool.check(user['password'] if user else None, password)
+        if not valid:
             return jsonify({'message': 'Invalid credentials'}), 401
         
-        curr_user = user
-        return jsonify({
+        if rehashed:
+            # Plaintext or outdated parameters; skipped if the password changed meanwhile
+            conn = get_db()
+            conn.execute(
+                'UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                (rehashed, user['id'], user['password'])
+            )
+            conn.commit()
+        
+        token = auth_sessions.issue(user['id'])
+        response = jsonify({
             'message': 'Login successful',
+            'token': token,
             'user': {
                 'id': user['id'],
                 'firstname': user['firstname'],
@@ -241,107 +735,157 @@ def login():
                 'email': user['email'],
                 'avatar_url': user['avatar_url']
             }
-        }), 200
+        })
+        set_auth_cookie(response, token)
+        return response, 200
+        
+    except passwords.PoolBusy:
+        return password_pool_busy()
+    except Exception as e:
+        return jsonify({'message': str(e)}), 500
+
+@app.route('/api/logout', methods=['POST'])
+def logout():
+    try:
+        auth_sessions.revoke(request_token())
+        response = jsonify({'message': 'Logged out'})
+        response.delete_cookie(auth_sessions.cookie_name)
+        return response, 200
         
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
 @app.route('/api/forgot-password', methods=['POST'])
 def forgot_password():
-    global curr_user
     data = request.get_json()
     email = data.get('email')
     
     if not email:
         return jsonify({'message': 'Email is required'}), 400
     
+    # The same answer whether or not the email is registered; the token only
+    # goes to the mailbox, so knowing an address is not enough to reset it
     user = get_user_by_email(email)
-    curr_user = user
     if not user:
-        return jsonify({'message': 'If the email exists, a reset link will be sent'}), 200
-    
-    return jsonify({'message': 'If the email exists, a reset link will be sent'}), 200
+        return jsonify({'message': PASSWORD_RESET_MESSAGE}), 200
+    token = auth_sessions.reset_token(user['id'], user['password'])
+    send_password_reset(user, token)
+    if not app.config['PASSWORD_RESET_TOKEN_IN_RESPONSE']:
+        return jsonify({'message': PASSWORD_RESET_MESSAGE}), 200
+
+    # Development only: the client also gets the token, and a cookie scoped
+    # to change-password
+    response = jsonify({'message': PASSWORD_RESET_MESSAGE, 'resetToken': token})
+    response.set_cookie(
+        PASSWORD_RESET_COOKIE, token, max_age=auth_sessions.reset_max_age, path='/api/change-password',
+        httponly=True, samesite='Strict', secure=request.is_secure,
+    )
+    return response, 200
 
 @app.route('/api/change-password', methods=['POST'])
 def change_pwd():
     try:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        global curr_user
-
         data = request.get_json()
         password = data.get('password')
 
         if not password or len(password) < 6:
             return jsonify({'message': 'Password must be at least 6 characters'}), 400
 
-        email = curr_user.get('email')
-        print(email)
+        # Either a forgot-password token or a logged-in user changing their own
+        reset_token = data.get('token') or request.cookies.get(PASSWORD_RESET_COOKIE)
+        if reset_token:
+            user_id = auth_sessions.check_reset_token(reset_token, stored_password)
+            if user_id is None:
+                return jsonify({'message': 'Invalid or expired reset token'}), 400
+        else:
+            curr_user = current_user()
+            if not curr_user:
+                return jsonify({'message': 'Unauthorized'}), 401
+            user_id = curr_user['id']
+
+        db.release_db()
+        password_hash = password_pool.hash(password)
+        conn = get_db()
+        cursor = conn.cursor()
         cursor.execute(
-            'UPDATE users SET password = ? WHERE email = ?',
-            (password, email)
+            'UPDATE users SET password = ? WHERE id = ?',
+            (password_hash, user_id)
         )
 
         conn.commit()
-        return jsonify({'message': 'Password updated successfully'}), 200
-
+        # Log out every other session of this user
+        auth_sessions.revoke_user(user_id, keep_token=request_token())
+        response = jsonify({'message': 'Password updated successfully'})
+        response.delete_cookie(PASSWORD_RESET_COOKIE, path='/api/change-password')
+        return response, 200
+
+    except passwords.PoolBusy:
+        return password_pool_busy()
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
-    finally:
-        conn.close()
-
-# Add these imports at the top if not already present
-import json
-from datetime import datetime
 
-# Chat messages table creation (add to init_db function)
-def init_db():
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    # ... existing tables ...
-    
-    # Chat messages table
+# Chat endpoints
+chat_hub = pubsub.create_hub(app.config['CHAT_PUBSUB_BACKEND'])
+
+def message_to_dict(msg):
+    # msg is a chat_messages row followed by the sender's firstname, lastname, avatar_url
+    return {
+        'id': msg[0],
+        'trade_id': msg[1],
+        'sender_id': msg[2],
+        'receiver_id': msg[3],
+        'message': msg[4],
+        'timestamp': msg[5],
+        'is_read': bool(msg[6]),
+        'sender_name': f"{msg[7]} {msg[8]}",
+        'sender_avatar': f"{BASE_URL}/{msg[9]}" if msg[9].startswith('assets/') else msg[9]
+    }
+
+def trade_access_error(cursor, trade_id, user, message):
+    # Returns an (error body, status) pair unless user is a party to the trade
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            trade_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            message TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            is_read BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (sender_id) REFERENCES users (id),
-            FOREIGN KEY (receiver_id) REFERENCES users (id),
-            FOREIGN KEY (trade_id) REFERENCES trades (id)
-        )
-    ''')
+        SELECT sender_id, receiver_id FROM trades WHERE id = ?
+    ''', (trade_id,))
     
-    # Trades table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS trades (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            item1_id INTEGER NOT NULL,
-            item2_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            status TEXT DEFAULT 'pending',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (item1_id) REFERENCES items (id),
-            FOREIGN KEY (item2_id) REFERENCES items (id),
-            FOREIGN KEY (sender_id) REFERENCES users (id),
-            FOREIGN KEY (receiver_id) REFERENCES users (id)
-        )
-    ''')
+    trade = cursor.fetchone()
+    
+    if not trade:
+        return {'error': 'Trade not found'}, 404
     
-    conn.commit()
-    conn.close()
+    if user['id'] not in trade:
+        return {'error': message}, 403
+    return None
+
+def query_messages(cursor, trade_id, after_id=None, limit=None):
+    # Runs the query and returns a lazy iterator of message dicts
+    if after_id is None and limit is None:
+        # Full history, in the order the app has always shown it
+        cursor.execute('''
+            SELECT cm.*, u.firstname, u.lastname, u.avatar_url
+            FROM chat_messages cm
+            JOIN users u ON cm.sender_id = u.id
+            WHERE cm.trade_id = ?
+            ORDER BY cm.timestamp ASC
+        ''', (trade_id,))
+    else:
+        # Incremental sync: ids only grow, so "newer than after_id" is a range scan
+        cursor.execute('''
+            SELECT cm.*, u.firstname, u.lastname, u.avatar_url
+            FROM chat_messages cm
+            JOIN users u ON cm.sender_id = u.id
+            WHERE cm.trade_id = ? AND cm.id > ?
+            ORDER BY cm.id ASC
+            LIMIT ?
+        ''', (trade_id, after_id or 0, limit or -1))
+    return map(message_to_dict, cursor)
+
+def fetch_messages(cursor, trade_id, after_id=None, limit=None):
+    return list(query_messages(cursor, trade_id, after_id, limit))
 
-# Chat endpoints
 @app.route('/api/chat/send', methods=['POST'])
 def send_message():
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
         
@@ -354,7 +898,7 @@ def send_message():
             return jsonify({'error': 'Missing required fields: trade_id, receiver_id, message'}), 400
         
         # Validate that the trade exists and user is part of it
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -364,19 +908,15 @@ def send_message():
         trade = cursor.fetchone()
         
         if not trade:
-            conn.close()
             return jsonify({'error': 'Trade not found'}), 404
         
         sender_id, trade_receiver_id = trade
         
         # Check if current user is part of this trade
         if curr_user['id'] not in [sender_id, trade_receiver_id]:
-            conn.close()
             return jsonify({'error': 'Not authorized to send messages in this trade'}), 403
-        print(trade_receiver_id)
         # Check if receiver_id is valid for this trade
         if int(receiver_id) not in [sender_id, trade_receiver_id]:
-            conn.close()
             return jsonify({'error': 'Invalid receiver for this trade'}), 400
         
         # Insert message into database
@@ -396,20 +936,11 @@ def send_message():
         ''', (cursor.lastrowid,))
         
         message_data = cursor.fetchone()
-        conn.close()
         
         if message_data:
-            response_data = {
-                'id': message_data[0],
-                'trade_id': message_data[1],
-                'sender_id': message_data[2],
-                'receiver_id': message_data[3],
-                'message': message_data[4],
-                'timestamp': message_data[5],
-                'is_read': bool(message_data[6]),
-                'sender_name': f"{message_data[7]} {message_data[8]}",
-                'sender_avatar': f"{BASE_URL}/{message_data[9]}" if message_data[9].startswith('assets/') else message_data[9]
-            }
+            response_data = message_to_dict(message_data)
+            # Wake any long-polling readers of this conversation
+            chat_hub.publish(pubsub.trade_topic(trade_id), {'type': 'message', 'data': response_data})
             
             return jsonify({'success': True, 'message': 'Message sent', 'data': response_data}), 200
         else:
@@ -422,74 +953,143 @@ def send_message():
 
 @app.route('/api/chat/messages/<int:trade_id>', methods=['GET'])
 def get_messages(trade_id):
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
         
     try:
         # Validate that the user is part of this trade
-        conn = sqlite3.connect('users.db')
+        conn = get_read_db()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT sender_id, receiver_id FROM trades WHERE id = ?
-        ''', (trade_id,))
-        
-        trade = cursor.fetchone()
-        
-        if not trade:
-            conn.close()
-            return jsonify({'error': 'Trade not found'}), 404
-        
-        sender_id, receiver_id = trade
-        
-        if curr_user['id'] not in [sender_id, receiver_id]:
-            conn.close()
-            return jsonify({'error': 'Not authorized to view messages for this trade'}), 403
-        
-        # Get all messages for this trade
-        cursor.execute('''
-            SELECT cm.*, u.firstname, u.lastname, u.avatar_url
-            FROM chat_messages cm
-            JOIN users u ON cm.sender_id = u.id
-            WHERE cm.trade_id = ?
-            ORDER BY cm.timestamp ASC
-        ''', (trade_id,))
-        
-        messages = cursor.fetchall()
-        conn.close()
-        
-        messages_list = []
-        for msg in messages:
-            messages_list.append({
-                'id': msg[0],
-                'trade_id': msg[1],
-                'sender_id': msg[2],
-                'receiver_id': msg[3],
-                'message': msg[4],
-                'timestamp': msg[5],
-                'is_read': bool(msg[6]),
-                'sender_name': f"{msg[7]} {msg[8]}",
-                'sender_avatar': f"{BASE_URL}/{msg[9]}" if msg[9].startswith('assets/') else msg[9]
-            })
+        error = trade_access_error(cursor, trade_id, curr_user, 'Not authorized to view messages for this trade')
+        if error:
+            return jsonify(error[0]), error[1]
+        
+        # ?after_id=<last seen id>&limit=N returns only newer messages;
+        # adding &wait=<seconds> holds the request until one is sent.
+        after_id = request.args.get('after_id', type=int)
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, app.config['CHAT_MAX_BATCH']))
+        wait = request.args.get('wait', 0, type=float)
+        wait = max(0.0, min(wait, app.config['CHAT_LONG_POLL_TIMEOUT']))
+        
+        if not wait and limit is None:
+            # Unbounded history: send it as it is read
+            return streamed_json(query_messages(cursor, trade_id, after_id)), 200
+        
+        # Subscribe before querying so a message sent in between still wakes us
+        subscription = chat_hub.subscribe(pubsub.trade_topic(trade_id)) if wait else None
+        try:
+            messages_list = fetch_messages(cursor, trade_id, after_id, limit)
+            if not messages_list and subscription:
+                # Don't hold a pooled connection while parked
+                db.release_db()
+                if subscription.get(timeout=wait) is not None:
+                    cursor = get_read_db().cursor()
+                    messages_list = fetch_messages(cursor, trade_id, after_id, limit)
+        finally:
+            if subscription:
+                subscription.close()
         
         return jsonify(messages_list), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def sse_event(event):
+    lines = []
+    if event['type'] == 'message':
+        # Lets EventSource resume with Last-Event-ID after a reconnect
+        lines.append(f"id: {event['data']['id']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event['data'])}")
+    return '\n'.join(lines) + '\n\n'
+
+def resync_event(last_id):
+    # Sent just before closing a stream that fell behind. Messages are
+    # replayed on reconnect; anything else, like a trade status change,
+    # the client should refetch.
+    return {'type': 'resync', 'data': {'after_id': last_id}}
+
+@app.route('/api/chat/stream/<int:trade_id>', methods=['GET'])
+def stream_messages(trade_id):
+    curr_user = current_user()
+    if not curr_user:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        conn = get_read_db()
+        cursor = conn.cursor()
+        error = trade_access_error(cursor, trade_id, curr_user, 'Not authorized to view messages for this trade')
+        if error:
+            return jsonify(error[0]), error[1]
+
+        # Subscribe first, then replay whatever the client missed since its
+        # last event, so nothing falls in the gap between the two.
+        subscription = chat_hub.subscribe(pubsub.trade_topic(trade_id))
+        after_id = request.headers.get('Last-Event-ID', type=int)
+        if after_id is None:
+            after_id = request.args.get('after_id', type=int)
+        try:
+            missed = fetch_messages(cursor, trade_id, after_id) if after_id is not None else []
+        except Exception:
+            subscription.close()
+            raise
+        db.release_db()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    heartbeat = app.config['CHAT_STREAM_HEARTBEAT']
+
+    def generate():
+        try:
+            # Flushes the headers right away and sets the client's reconnect delay
+            yield 'retry: 3000\n\n'
+            last_id = after_id or 0
+            for msg in missed:
+                last_id = msg['id']
+                yield sse_event({'type': 'message', 'data': msg})
+            while True:
+                event = subscription.get(timeout=heartbeat)
+                if subscription.dropped:
+                    # The queue overflowed and events were lost. Close the
+                    # stream; EventSource reconnects with Last-Event-ID and
+                    # the replay above fills the gap from the database.
+                    yield sse_event(resync_event(last_id))
+                    return
+                if event is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                if event['type'] == 'message':
+                    # Already sent during the replay
+                    if event['data']['id'] <= last_id:
+                        continue
+                    last_id = event['data']['id']
+                yield sse_event(event)
+        finally:
+            subscription.close()
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    # Covers clients that disconnect before the generator ever starts
+    response.call_on_close(subscription.close)
+    return response
+
 def get_item_by_id(item_id):
-    conn = sqlite3.connect("users.db")
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cur = conn.cursor()
+    cur.row_factory = sqlite3.Row
     cur.execute("SELECT * FROM items WHERE id = ?", (item_id,))
     row = cur.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 @app.route('/api/trade/check', methods=['POST'])
 def check_existing_trade():
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
 
@@ -497,11 +1097,9 @@ def check_existing_trade():
         data = request.get_json()
         requested_item_id = data.get('requested_item_id')
         receiver_id = data.get('receiver_id')
-        print(receiver_id,requested_item_id)
         if not requested_item_id or not receiver_id:
             return jsonify({'error': 'Missing required fields'}), 400
-        print(curr_user)
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         cursor = conn.cursor()
                 # ✅ Check if a trade exists between these two users involving this requested item
         cursor.execute('''
@@ -513,8 +1111,6 @@ def check_existing_trade():
         ''', (curr_user['id'], curr_user['id'], requested_item_id, requested_item_id))
 
         trade = cursor.fetchone()
-        conn.close()
-        print(trade)
         if trade:
             offered_item = get_item_by_id(trade[1])  # trade[1] = item1_id
             requested_item = get_item_by_id(trade[2])  # trade[2] = item2_id (optional)
@@ -532,13 +1128,13 @@ def check_existing_trade():
             return jsonify({'exists': False}), 200
 
     except Exception as e:
-        print(str(e))
+        log.exception('Trade check failed')
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/trade/create', methods=['POST'])
 def create_trade():
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
         
@@ -547,12 +1143,11 @@ def create_trade():
         offered_item_id = data.get('offered_item_id')
         requested_item_id = data.get('requested_item_id')
         receiver_id = data.get('receiver_id')
-        print(offered_item_id,requested_item_id)
         
         if not all([offered_item_id, requested_item_id, receiver_id]):
             return jsonify({'error': 'Missing required fields: offered_item_id, requested_item_id, receiver_id'}), 400
         
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Verify items exist and are available
@@ -560,7 +1155,6 @@ def create_trade():
                       (offered_item_id, requested_item_id))
         items = cursor.fetchall()
         if len(items) != 2:
-            conn.close()
             return jsonify({'error': 'One or more items not found'}), 404
         
         offered_item = next((item for item in items if item[1] == curr_user['id']), None)
@@ -568,20 +1162,16 @@ def create_trade():
 
         # Validate both items
         if not offered_item or not requested_item:
-            conn.close()
             return jsonify({'error': 'Invalid trade items or ownership mismatch'}), 400
 
         
         # Check if requested item belongs to the receiver
        
         if requested_item[1] != int(receiver_id):
-            conn.close()
             return jsonify({'error': 'Requested item does not belong to the specified receiver'}), 400
         
         # Check if items are available
-        print(offered_item,requested_item)
         if offered_item[2] != 'available' or requested_item[2] != 'available':
-            conn.close()
             return jsonify({'error': 'One or both items are not available for trade'}), 400
         
         # Create new trade
@@ -593,7 +1183,6 @@ def create_trade():
         trade_id = cursor.lastrowid
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True, 
@@ -608,7 +1197,7 @@ def create_trade():
 
 @app.route('/api/trade/<int:trade_id>/status', methods=['POST'])
 def update_trade_status(trade_id):
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
         
@@ -620,7 +1209,7 @@ def update_trade_status(trade_id):
         if status not in valid_statuses:
             return jsonify({'error': f'Invalid status. Must be one of: {", ".join(valid_statuses)}'}), 400
         
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if trade exists and user has permission to update it
@@ -628,23 +1217,19 @@ def update_trade_status(trade_id):
         trade = cursor.fetchone()
         
         if not trade:
-            conn.close()
             return jsonify({'error': 'Trade not found'}), 404
         
         sender_id, receiver_id, current_status = trade
         
         # Check if current user is part of this trade
         if curr_user['id'] not in [sender_id, receiver_id]:
-            conn.close()
             return jsonify({'error': 'Not authorized to update this trade'}), 403
         
         # Only receiver can accept/decline, sender can cancel
         if status in ['accepted', 'declined'] and curr_user['id'] != receiver_id:
-            conn.close()
             return jsonify({'error': 'Only the receiver can accept or decline a trade'}), 403
         
         if status == 'cancelled' and curr_user['id'] != sender_id:
-            conn.close()
             return jsonify({'error': 'Only the sender can cancel a trade'}), 403
         
         # Update trade status
@@ -660,7 +1245,13 @@ def update_trade_status(trade_id):
                               (trade_items[0], trade_items[1]))
         
         conn.commit()
-        conn.close()
+        if status == 'accepted':
+            # Both items just left the marketplace
+            invalidate_feed_cache()
+        chat_hub.publish(pubsub.trade_topic(trade_id), {
+            'type': 'trade_status',
+            'data': {'trade_id': trade_id, 'status': status, 'previous_status': current_status}
+        })
         
         return jsonify({
             'success': True, 
@@ -675,12 +1266,12 @@ def update_trade_status(trade_id):
 
 @app.route('/api/trade/<int:trade_id>', methods=['GET'])
 def get_trade_details(trade_id):
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
         
     try:
-        conn = sqlite3.connect('users.db')
+        conn = get_read_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -698,7 +1289,6 @@ def get_trade_details(trade_id):
         ''', (trade_id,))
         
         trade = cursor.fetchone()
-        conn.close()
         
         if not trade:
             return jsonify({'error': 'Trade not found'}), 404
@@ -748,128 +1338,82 @@ def get_trade_details(trade_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/trades/sent', methods=['GET'])
-def get_sent_trades():
-    global curr_user
+def trade_to_dict(tr, user_id):
+    # tr is a trades.trade_query() row
+    trade = {
+        'id': tr[0],
+        'status': tr[1],
+        'created_at': tr[2],
+        'role': 'sent' if tr[11] == user_id else 'received',
+        'offered_item': {
+            'id': tr[3],
+            'title': tr[4],
+            'image_url': f"{BASE_URL}/{tr[5]}",
+            'description': tr[6],
+        },
+        'requested_item': {
+            'id': tr[7],
+            'title': tr[8],
+            'image_url': f"{BASE_URL}/{tr[9]}",
+            'description': tr[10],
+        },
+        'sender': {
+            'id': tr[11],
+            'name': f"{tr[12]} {tr[13]}",
+            'avatar_url': f"{BASE_URL}/{tr[14]}",
+        },
+        'receiver': {
+            'id': tr[15],
+            'name': f"{tr[16]} {tr[17]}",
+            'avatar_url': f"{BASE_URL}/{tr[18]}",
+        }
+    }
+    if len(tr) > 19:
+        trade['unread_count'] = tr[19]
+    return trade
+
+def role_trades(role):
+    # The whole list for one role, as /api/trades/sent and /received have always returned it
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
 
     try:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT t.id, t.status, t.created_at,
-                   i1.id, i1.title, i1.image_url, i1.description,
-                   i2.id, i2.title, i2.image_url, i2.description,
-                   u1.id, u1.firstname, u1.lastname, u1.avatar_url,
-                   u2.id, u2.firstname, u2.lastname, u2.avatar_url
-            FROM trades t
-            JOIN items i1 ON t.item1_id = i1.id
-            JOIN items i2 ON t.item2_id = i2.id
-            JOIN users u1 ON t.sender_id = u1.id
-            JOIN users u2 ON t.receiver_id = u2.id
-            WHERE t.sender_id = ?
-            ORDER BY t.created_at DESC
-        ''', (curr_user['id'],))
-
-        trades = cursor.fetchall()
-        conn.close()
-
-        result = []
-        for tr in trades:
-            result.append({
-                'id': tr[0],
-                'status': tr[1],
-                'created_at': tr[2],
-                'offered_item': {
-                    'id': tr[3],
-                    'title': tr[4],
-                    'image_url': f"{BASE_URL}/{tr[5]}",
-                    'description': tr[6],
-                },
-                'requested_item': {
-                    'id': tr[7],
-                    'title': tr[8],
-                    'image_url': f"{BASE_URL}/{tr[9]}",
-                    'description': tr[10],
-                },
-                'sender': {
-                    'id': tr[11],
-                    'name': f"{tr[12]} {tr[13]}",
-                    'avatar_url': f"{BASE_URL}/{tr[14]}",
-                },
-                'receiver': {
-                    'id': tr[15],
-                    'name': f"{tr[16]} {tr[17]}",
-                    'avatar_url': f"{BASE_URL}/{tr[18]}",
-                }
-            })
-
-        return jsonify(result), 200
+        cursor = get_read_db().cursor()
+        cursor.execute(*trades.trade_query(curr_user['id'], trades.Filters(role, None, False)))
+        return jsonify([trade_to_dict(tr, curr_user['id']) for tr in cursor.fetchall()]), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/trades/sent', methods=['GET'])
+@conditional('trades', 'items', 'users', per_user=True)
+def get_sent_trades():
+    return role_trades('sent')
 
 @app.route('/api/trades/received', methods=['GET'])
+@conditional('trades', 'items', 'users', per_user=True)
 def get_received_trades():
-    global curr_user
+    return role_trades('received')
+
+@app.route('/api/trades', methods=['GET'])
+# Unread counts come from chat_messages, so a new message changes the ETag too
+@conditional('trades', 'items', 'users', 'chat_messages', per_user=True)
+def list_trades():
+    # ?role=all|sent|received&status=&unread=1, paginated with limit and cursor
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
-
     try:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT t.id, t.status, t.created_at,
-                   i1.id, i1.title, i1.image_url, i1.description,
-                   i2.id, i2.title, i2.image_url, i2.description,
-                   u1.id, u1.firstname, u1.lastname, u1.avatar_url,
-                   u2.id, u2.firstname, u2.lastname, u2.avatar_url
-            FROM trades t
-            JOIN items i1 ON t.item1_id = i1.id
-            JOIN items i2 ON t.item2_id = i2.id
-            JOIN users u1 ON t.sender_id = u1.id
-            JOIN users u2 ON t.receiver_id = u2.id
-            WHERE t.receiver_id = ?
-            ORDER BY t.created_at DESC
-        ''', (curr_user['id'],))
-
-        trades = cursor.fetchall()
-        conn.close()
-
-        result = []
-        for tr in trades:
-            result.append({
-                'id': tr[0],
-                'status': tr[1],
-                'created_at': tr[2],
-                'offered_item': {
-                    'id': tr[3],
-                    'title': tr[4],
-                    'image_url': f"{BASE_URL}/{tr[5]}",
-                    'description': tr[6],
-                },
-                'requested_item': {
-                    'id': tr[7],
-                    'title': tr[8],
-                    'image_url': f"{BASE_URL}/{tr[9]}",
-                    'description': tr[10],
-                },
-                'sender': {
-                    'id': tr[11],
-                    'name': f"{tr[12]} {tr[13]}",
-                    'avatar_url': f"{BASE_URL}/{tr[14]}",
-                },
-                'receiver': {
-                    'id': tr[15],
-                    'name': f"{tr[16]} {tr[17]}",
-                    'avatar_url': f"{BASE_URL}/{tr[18]}",
-                }
-            })
+        filters = trades.parse_filters(request.args)
+        limit, after = pagination.page_args(request.args)
+    except (trades.InvalidFilter, pagination.InvalidPageRequest) as e:
+        return jsonify({'error': str(e)}), 400
 
-        return jsonify(result), 200
+    try:
+        cursor = get_read_db().cursor()
+        cursor.execute(*trades.trade_query(curr_user['id'], filters, limit, after))
+        trades_list = [trade_to_dict(tr, curr_user['id']) for tr in cursor.fetchall()]
+        return jsonify(pagination.page(trades_list, limit, trades.sort_key, name='trades')), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -877,13 +1421,14 @@ def get_received_trades():
 
 # Get user's items for trading
 @app.route('/api/user/items', methods=['GET'])
+@conditional('items', per_user=True)
 def get_user_items_for_trade():
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
         
     try:
-        conn = sqlite3.connect('users.db')
+        conn = get_read_db()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT * FROM items 
@@ -897,7 +1442,6 @@ def get_user_items_for_trade():
         #     WHERE reciever_id =?
         # ''',(curr_user["id"],))
         # requested_ids = cursor.fetchall()
-        conn.close()
         # print(requested_ids)
         items_list = []
         for item in items:
@@ -923,102 +1467,44 @@ def get_user_items_for_trade():
 @app.route('/assets/avatars/png/<filename>')
 def serve_avatar(filename):
     try:
-        return send_from_directory('assets/avatars/png', filename)
-    except FileNotFoundError:
+        return avatar_files.serve(request.environ, filename)
+    except NotFound:
         # Return a default avatar if the requested one doesn't exist
-        return send_from_directory('assets/avatars/png', 'default_avatar.png')
+        return avatar_files.serve(request.environ, 'default_avatar.png')
     
 # Add this new route to your server.py
 @app.route('/api/items/others', methods=['GET'])
+@conditional(*ITEM_TABLES, per_user=True)
 def get_others_items():
-    global curr_user
+    # Same as /api/items?exclude_self=1
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
-        
-    try:
-        user_id = curr_user['id']
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT items.*, users.firstname, users.lastname, users.avatar_url 
-            FROM items 
-            JOIN users ON items.user_id = users.id 
-            WHERE items.status = 'available' AND items.user_id != ?
-            ORDER BY items.created_at DESC
-        ''', (user_id,))
-        items = cursor.fetchall()
-        conn.close()
-        
-        items_list = []
-        for item in items:
-            items_list.append({
-                'id': item[0],
-                'user_id': item[1],
-                'title': item[2],
-                'category': item[3],
-                'price': item[4],
-                'description': item[5],
-                'image_url': item[6],
-                'status': item[7],
-                'created_at': item[8],
-                'user_firstname': item[9],
-                'user_lastname': item[10],
-                'user_avatar_url': item[11]
-            })
-        print(items_list)
-        return jsonify(items_list), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return catalog_response(exclude_self=True)
     
 # --- Get Available Avatars ---
 @app.route('/avatars', methods=['GET'])
 def get_avatars():
-    folder = 'assets/avatars/png/'
     try:
-        # Check if folder exists
-        if not os.path.exists(folder):
-            # Return default avatars if folder doesn't exist
-            default_avatars = [
-                {'id': 1, 'name': '3d_1.png', 'path': 'assets/avatars/png/3d_1.png'},
-                {'id': 2, 'name': '3d_2.png', 'path': 'assets/avatars/png/3d_2.png'},
-                {'id': 3, 'name': '3d_3.png', 'path': 'assets/avatars/png/3d_3.png'},
-                {'id': 4, 'name': '3d_4.png', 'path': 'assets/avatars/png/3d_4.png'},
-                {'id': 5, 'name': '3d_5.png', 'path': 'assets/avatars/png/3d_5.png'},
-            ]
-            return jsonify({
-                'success': True,
-                'avatars': default_avatars,
-                'message': 'Using default avatars (folder not found)'
-            })
-        
-        files = os.listdir(folder)
-        png_files = [f for f in files if f.lower().endswith('.png')]
-        
-        avatars = [
-            {
-                'id': idx + 1,
-                'name': filename,
-                'path': os.path.join(folder, filename).replace('\\', '/')
-            }
-            for idx, filename in enumerate(png_files)
-            if os.path.isfile(os.path.join(folder, filename))
-        ]
-        
-        return jsonify({
-            'success': True,
-            'avatars': avatars
-        })
-        
+        avatar_catalog = avatar_registry.catalog()
     except Exception as e:
         return jsonify({
             'success': False,
             'error': f'Failed to load avatars: {str(e)}'
         }), 500
 
+    if request.if_none_match.contains(avatar_catalog.etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(avatar_catalog.body, mimetype=app.json.mimetype)
+    response.set_etag(avatar_catalog.etag)
+    response.cache_control.no_cache = True
+    return response
+
 # --- Update Avatar Only ---
 @app.route('/update-avatar', methods=['POST'])
 def update_avatar():
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
     
@@ -1032,7 +1518,7 @@ def update_avatar():
                 'error': 'Avatar URL is required'
             }), 400
         
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         cursor.execute(
@@ -1040,11 +1526,12 @@ def update_avatar():
             (avatar_url, curr_user.get('email'))
         )
         conn.commit()
-        conn.close()
+        # Item responses embed the owner's avatar
+        invalidate_feed_cache()
 
         
-        # Update current_user_info
-        curr_user['avatar_url'] = avatar_url
+        # The cached user record still has the old avatar
+        auth_sessions.forget_user(curr_user['id'])
         
         return jsonify({
             'success': True,
@@ -1061,29 +1548,32 @@ def update_avatar():
 @app.route('/api/users', methods=['GET'])
 def get_users():
     try:
-        conn = sqlite3.connect('users.db')
+        conn = get_read_db()
         cursor = conn.cursor()
         cursor.execute('SELECT id, firstname, lastname, email, created_at FROM users')
-        users = cursor.fetchall()
-        conn.close()
-        
-        users_list = []
-        for user in users:
-            users_list.append({
-                'id': user[0],
-                'firstname': user[1],
-                'lastname': user[2],
-                'email': user[3],
-                'created_at': user[4]
-            })
+        users = ({
+            'id': user[0],
+            'firstname': user[1],
+            'lastname': user[2],
+            'email': user[3],
+            'created_at': user[4]
+        } for user in cursor)
         
-        return jsonify({'users': users_list}), 200
+        return streamed_json(users, 'users'), 200
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
 # --- Item Management Routes ---
 @app.route('/api/upload', methods=['POST'])
 def upload_image():
+    # Look up who is asking now, while connections are at hand, then give
+    # them back to the pools while the body arrives, which can take minutes
+    # on a slow link. Storing the file takes a new one.
+    current_user()
+    db.release_db()
+    if app.config['STREAMING_UPLOADS'] and app.config['CONTENT_ADDRESSED_UPLOADS']:
+        return upload_image_streaming()
+
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
     
@@ -1092,20 +1582,115 @@ def upload_image():
         return jsonify({'error': 'No image selected'}), 400
     
     if file and allowed_file(file.filename):
-        # Generate unique filename
-        filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        
-        # Return the image URL
-        image_url = f"/assets/images/{filename}"
-        return jsonify({'imageUrl': image_url}), 200
+        if app.config['CONTENT_ADDRESSED_UPLOADS']:
+            # Identical bytes map to the same file, which is stored once. The
+            # extension comes from the bytes too, as in upload_image_streaming,
+            # so the same photo sent as .jpg and as .jpeg is still one file.
+            try:
+                extension = uploads.check_type(file.stream.read(uploads.SNIFF_BYTES), app.config['ALLOWED_EXTENSIONS'])
+            except uploads.InvalidUpload as e:
+                return upload_error(e)
+            file.stream.seek(0)
+            filename, created = content_store.save(get_db(), file.stream, extension)
+        else:
+            # Generate unique filename
+            filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            file.save(file_path)
+            created = True
+        
+        return jsonify({'imageUrl': uploaded_image_url(filename, created)}), 200
     
     return jsonify({'error': 'Invalid file type'}), 400
 
+def uploaded_image_url(filename, created):
+    # Resized variants are generated in the background
+    image_url = f"/assets/images/{filename}"
+    if created:
+        image_pipeline.submit(filename, image_url)
+    return image_url
+
+def upload_error(e):
+    body = {'error': str(e)}
+    if isinstance(e, uploads.UploadConflict) and e.offset is not None:
+        body['offset'] = e.offset
+    return jsonify(body), e.status
+
+def upload_image_streaming():
+    # Reads the body itself, chunk by chunk, straight into the store;
+    # request.files would spool the whole file first
+    writer = uploads.SniffingWriter(content_store.writer(), app.config['ALLOWED_EXTENSIONS'])
+    try:
+        if request.mimetype == 'multipart/form-data':
+            boundary = request.mimetype_params.get('boundary', '').encode()
+            if not boundary or not uploads.receive_file(request.stream, boundary, 'image', writer.write):
+                writer.abort()
+                return jsonify({'error': 'No image provided'}), 400
+        else:
+            # A bare image body, e.g. Content-Type: image/jpeg
+            while chunk := request.stream.read(uploads.CHUNK_SIZE):
+                writer.write(chunk)
+        filename, created = writer.commit(get_db())
+    except uploads.InvalidUpload as e:
+        writer.abort()
+        return upload_error(e)
+    except BaseException:
+        writer.abort()
+        raise
+    return jsonify({'imageUrl': uploaded_image_url(filename, created)}), 200
+
+def upload_status(offset, length, **extra):
+    response = jsonify({'offset': offset, 'length': length, **extra})
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    # Resumable upload: POST {"length": n}, then PATCH the bytes with Upload-Offset
+    length = (request.get_json(silent=True) or {}).get('length')
+    try:
+        upload_id = resumable_uploads.create(length)
+    except uploads.InvalidUpload as e:
+        return upload_error(e)
+    response = upload_status(0, length, uploadId=upload_id)
+    response.headers['Location'] = f'/api/uploads/{upload_id}'
+    return response, 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    try:
+        offset, length = resumable_uploads.status(upload_id)
+    except uploads.UnknownUpload:
+        return jsonify({'error': 'Upload not found'}), 404
+    return upload_status(offset, length), 200
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def append_upload(upload_id):
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    try:
+        offset, length, stored = resumable_uploads.append(upload_id, offset, request.stream)
+    except uploads.UnknownUpload:
+        return jsonify({'error': 'Upload not found'}), 404
+    except uploads.InvalidUpload as e:
+        return upload_error(e)
+    if stored is None:
+        return upload_status(offset, length), 200
+    return upload_status(offset, length, imageUrl=uploaded_image_url(*stored)), 200
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    try:
+        resumable_uploads.cancel(upload_id)
+    except uploads.UnknownUpload:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'message': 'Upload cancelled'}), 200
+
 @app.route('/api/items', methods=['POST'])
 def create_item():
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
         
@@ -1119,7 +1704,7 @@ def create_item():
                 return jsonify({'error': f'Missing field: {field}'}), 400
         
         # Create new item
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO items (user_id, title, category, price, description, image_url)
@@ -1133,12 +1718,12 @@ def create_item():
             data['imageUrl']
         ))
         conn.commit()
+        invalidate_feed_cache()
         
         # Get the inserted item
         item_id = cursor.lastrowid
         cursor.execute('SELECT * FROM items WHERE id = ?', (item_id,))
         item = cursor.fetchone()
-        conn.close()
         
         if item:
             item_data = {
@@ -1159,52 +1744,115 @@ def create_item():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def wants_exclude_self():
+    return request.args.get('exclude_self') == '1'
+
+def catalog_response(exclude_self):
+    # ?category=&min_price=&max_price=&sort=&facets=1 on top of the item page
+    try:
+        filters = catalog.parse_filters(request.args)
+        limit, after = item_page_args()
+    except (catalog.InvalidFilter, pagination.InvalidPageRequest) as e:
+        return jsonify({'error': str(e)}), 400
+    user = current_user() if exclude_self else None
+    if exclude_self and not user:
+        return jsonify({'error': 'Unauthorized'}), 401
+    exclude_user_id = user['id'] if exclude_self else None
+    with_facets = request.args.get('facets') == '1'
+
+    def execute():
+        conn = get_read_db()
+        cursor = conn.cursor()
+        walk = limit is not None and catalog.wide_price_range(cursor, filters)
+        cursor.execute(*catalog.item_query(filters, limit, after, exclude_user_id, walk))
+        return cursor
+
+    def load_page():
+        items_list = [feed_item_to_dict(item) for item in execute().fetchall()]
+        body = pagination.page(items_list, limit, catalog.sort_key(filters))
+        if with_facets:
+            body['facets'] = catalog.facet_counts(get_read_db().cursor(), filters, exclude_user_id)
+        return body, 200
+
+    try:
+        if limit is None:
+            # The whole catalog: streamed, and too big to be worth caching
+            return streamed_json(map(feed_item_to_dict, execute())), 200
+        key = ('items', filters, exclude_user_id, with_facets, limit, tuple(after) if after else None)
+        return cached_json(key, load_page, ITEM_TABLES)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/items', methods=['GET'])
+@conditional(*ITEM_TABLES, per_user=wants_exclude_self)
 def get_items():
+    return catalog_response(exclude_self=wants_exclude_self())
+
+@app.route('/api/items/search', methods=['GET'])
+@conditional('items', 'users', 'image_variants')
+def search_items():
+    # ?q=words, prefix* queries; best matches first, paginated like /api/items
+    try:
+        match = search.match_expression(request.args.get('q'))
+        limit, after = pagination.page_args(request.args)
+    except (search.InvalidSearch, pagination.InvalidPageRequest) as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
-        conn = sqlite3.connect('users.db')
+        conn = get_read_db()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT items.*, users.firstname, users.lastname, users.avatar_url 
-            FROM items 
-            JOIN users ON items.user_id = users.id 
-            WHERE items.status = 'available'
-            ORDER BY items.created_at DESC
-        ''')
-        items = cursor.fetchall()
-        conn.close()
-        
+        # Rank inside the index first and join only the page: scoring every
+        # match is unavoidable, looking up every matching row is not. Only
+        # available items are indexed (migration 6).
+        hits = 'SELECT rowid, rank FROM items_fts WHERE items_fts MATCH ?'
+        params = [match]
+        if after:
+            # bm25 ranks are negative, lower is better. A write between
+            # pages can shift scores slightly; the cursor stays valid.
+            hits += ' AND (rank, rowid) > (?, ?)'
+            params.extend(after)
+        hits += ' ORDER BY rank, rowid LIMIT ?'
+        params.append(limit + 1)
+        cursor.execute(f'''
+            SELECT items.*, users.firstname, users.lastname, users.avatar_url, thumb.url, hits.rank
+            FROM ({hits}) AS hits
+            JOIN items ON items.id = hits.rowid
+            JOIN users ON items.user_id = users.id
+            LEFT JOIN image_variants thumb
+                ON thumb.image_url = items.image_url AND thumb.name = ? AND thumb.format = ?
+            ORDER BY hits.rank, hits.rowid
+        ''', params + list(images.THUMBNAIL))
+
         items_list = []
-        for item in items:
-            items_list.append({
-                'id': item[0],
-                'user_id': item[1],
-                'title': item[2],
-                'category': item[3],
-                'price': item[4],
-                'description': item[5],
-                'image_url': item[6],
-                'status': item[7],
-                'created_at': item[8],
-                'user_firstname': item[9],
-                'user_lastname': item[10],
-                'user_avatar_url': item[11]
-            })
-        
-        return jsonify(items_list), 200
+        for row in cursor.fetchall():
+            item = feed_item_to_dict(row)
+            item['rank'] = row[13]
+            items_list.append(item)
+        return jsonify(pagination.page(items_list, limit, search.rank_sort_key)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/items/user/<user_id>', methods=['GET'])
 def get_user_items(user_id):
     try:
-        conn = sqlite3.connect('users.db')
+        limit, after = item_page_args()
+    except pagination.InvalidPageRequest as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        conn = get_read_db()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM items WHERE user_id = ? ORDER BY created_at DESC
-        ''', (user_id,))
+        query = 'SELECT * FROM items WHERE user_id = ?'
+        params = [user_id]
+        if after:
+            query += ' AND (created_at, id) < (?, ?)'
+            params.extend(after)
+        query += ' ORDER BY created_at DESC, id DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit + 1)
+        cursor.execute(query, params)
         items = cursor.fetchall()
-        conn.close()
         
         items_list = []
         for item in items:
@@ -1220,14 +1868,16 @@ def get_user_items(user_id):
                 'created_at': item[8]
             })
         
-        return jsonify(items_list), 200
+        if limit is None:
+            return jsonify(items_list), 200
+        return jsonify(pagination.page(items_list, limit, item_sort_key)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/items/<item_id>', methods=['GET'])
 def get_item(item_id):
-    try:
-        conn = sqlite3.connect('users.db')
+    def load():
+        conn = get_read_db()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT items.*, users.firstname, users.lastname, users.avatar_url 
@@ -1236,9 +1886,18 @@ def get_item(item_id):
             WHERE items.id = ?
         ''', (item_id,))
         item = cursor.fetchone()
-        conn.close()
         
         if item:
+            cursor.execute('''
+                SELECT name, format, url, width, height, bytes FROM image_variants
+                WHERE image_url = ?
+                ORDER BY width, format
+            ''', (item[6],))
+            variants = [
+                dict(zip(('name', 'format', 'url', 'width', 'height', 'bytes'), row))
+                for row in cursor.fetchall()
+            ]
+            thumbnail = next((v['url'] for v in variants if (v['name'], v['format']) == images.THUMBNAIL), None)
             item_data = {
                 'id': item[0],
                 'user_id': item[1],
@@ -1251,26 +1910,35 @@ def get_item(item_id):
                 'created_at': item[8],
                 'user_firstname': item[9],
                 'user_lastname': item[10],
-                'user_avatar_url': item[11]
+                'user_avatar_url': item[11],
+                'thumbnail_url': thumbnail or item[6],
+                'image_variants': variants
             }
-            return jsonify(item_data), 200
+            return item_data, 200
         else:
-            return jsonify({'error': 'Item not found'}), 404
+            return {'error': 'Item not found'}, 404
+
+    try:
+        return cached_json(('item', str(item_id)), load, ITEM_TABLES)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'feed': feed_cache.stats(), 'users': auth_sessions.users.stats()}), 200
+
 @app.route('/api/items/<item_id>', methods=['DELETE'])
 def delete_item(item_id):
-    global curr_user
+    curr_user = current_user()
     if not curr_user:
         return jsonify({'error': 'Unauthorized'}), 401
         
     try:
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if item belongs to current user
-        cursor.execute('SELECT user_id FROM items WHERE id = ?', (item_id,))
+        cursor.execute('SELECT user_id, image_url FROM items WHERE id = ?', (item_id,))
         item = cursor.fetchone()
         
         if not item:
@@ -1282,7 +1950,11 @@ def delete_item(item_id):
         # Delete the item
         cursor.execute('DELETE FROM items WHERE id = ?', (item_id,))
         conn.commit()
-        conn.close()
+        invalidate_feed_cache()
+        # Remove its image if this was the last item using it and it was
+        # not just uploaded again, then any uploads left unused
+        content_store.collect(conn, item[1])
+        content_store.collect_stale(conn)
         
         return jsonify({'message': 'Item deleted successfully'}), 200
     except Exception as e:
@@ -1290,11 +1962,79 @@ def delete_item(item_id):
 
 @app.route('/assets/images/<filename>')
 def serve_image(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return image_files.serve(request.environ, filename)
+
+@metrics_registry.add_collector
+def component_metrics():
+    # Counters the caches, pools and limiter keep themselves, read at scrape time
+    caches = {'feed': feed_cache.stats(), 'users': auth_sessions.users.stats()}
+    return [
+        ('cache_hits_total', 'counter', 'Cache lookups answered from memory',
+         {(('cache', name),): stats['hits'] for name, stats in caches.items()}),
+        ('cache_misses_total', 'counter', 'Cache lookups that had to load',
+         {(('cache', name),): stats['misses'] for name, stats in caches.items()}),
+        ('rate_limited_total', 'counter', 'Requests refused with 429', {(): rate_limiter.limited}),
+        ('password_hash_rejected_total', 'counter', 'Sign-ins refused because the hashing pool was full',
+         {(): password_pool.rejected}),
+        ('log_records_dropped_total', 'counter', 'Log records dropped with the log queue full',
+         {(): log_handler.dropped}),
+        ('chat_subscribers', 'gauge', 'Open chat streams and long polls', {(): chat_hub.subscriber_count()}),
+        ('chat_events_dropped_total', 'counter', 'Chat events lost to a full subscriber queue',
+         {(): chat_hub.dropped}),
+        ('http_requests_in_flight', 'gauge', 'Requests in progress', {(): in_flight.count}),
+        ('http_requests_shed_total', 'counter', 'Requests refused with 503 over MAX_IN_FLIGHT',
+         {(): in_flight.shed}),
+    ]
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return app.response_class(metrics_registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    # ?format=folded returns the merged stacks (of ?endpoint= only, if given) for a flamegraph
+    if request_profiler is None:
+        return jsonify({'error': 'Profiling is disabled'}), 404
+    if not profiling.token_matches(app.config['PROFILE_TOKEN'], request.headers.get('X-Profile')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    if request.args.get('format') == 'folded':
+        return app.response_class(request_profiler.folded(request.args.get('endpoint')), mimetype='text/plain')
+    return jsonify({
+        'profiles': request_profiler.summary(),
+        'slow_queries': slow_query_log.stats() if slow_query_log else [],
+    }), 200
+
+readiness = health.Readiness({
+    'database': lambda: health.check_database(
+        app.config['DATABASE'],
+        timeout=app.config['HEALTH_DB_TIMEOUT'],
+        max_latency=app.config['HEALTH_DB_MAX_LATENCY_MS'] / 1000,
+    ),
+    'uploads': lambda: health.check_storage(
+        app.config['UPLOAD_FOLDER'], app.config['HEALTH_MIN_FREE_DISK_MB'] * 1024 * 1024,
+    ),
+    'database_disk': lambda: health.check_storage(
+        health.database_folder(app.config['DATABASE']), app.config['HEALTH_MIN_FREE_DISK_MB'] * 1024 * 1024,
+    ),
+}, ttl=app.config['HEALTH_CACHE_TTL'])
 
 @app.route('/api/health')
+@app.route('/api/health/ready')
 def health_check():
-    return jsonify({'status': 'healthy'}), 200
+    # Readiness: 503 tells the load balancer to send traffic elsewhere
+    checks = dict(readiness.results())
+    checks['in_flight'] = health.in_flight_check(in_flight, app.config['READY_MAX_IN_FLIGHT'])
+    ready = all(check['ok'] for check in checks.values())
+    response = jsonify({'status': 'healthy' if ready else 'unavailable', 'checks': checks})
+    if not ready:
+        response.headers['Retry-After'] = '5'
+    response.headers['Cache-Control'] = 'no-store'
+    return response, 200 if ready else 503
+
+@app.route('/api/health/live')
+def liveness_check():
+    # Only that the process answers; restarting for a busy database would not help
+    return jsonify({'status': 'alive', 'in_flight': in_flight.count}), 200
 
 if __name__ == '__main__':
     init_db()
@@ -0,0 +1,228 @@
+"""Login sessions: which user a request comes from.
+
+login() issues a token, a random session id signed with the secret key,
+which the client sends back as ``Authorization: Bearer <token>`` or in the
+auth cookie. A forged or mangled token fails the signature check before
+the store is asked. The store maps live session ids to user ids, which is
+what makes logout and revocation possible:
+
+  memory   a dict in this process; one worker only
+  sqlite   the sessions table (migration 12), shared by every worker
+           using the same database
+
+User records are read through an LRU cache in front of ``load_user``, so
+an authenticated request costs an HMAC check and a primary-key lookup, and
+no query against users. Routes that change a user call forget_user(); other
+workers pick the change up when their cached copy expires.
+"""
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+from itsdangerous import BadSignature, TimestampSigner, URLSafeTimedSerializer
+
+import cache
+
+
+class MemoryStore:
+    """Sessions in this process. Every worker has its own, so one worker only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def create(self, session_id, user_id, expires_at):
+        now = time.time()
+        with self._lock:
+            for expired in [sid for sid, (_, until) in self._sessions.items() if until <= now]:
+                del self._sessions[expired]
+            self._sessions[session_id] = (user_id, expires_at)
+
+    def get(self, session_id):
+        entry = self._sessions.get(session_id)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def delete_user(self, user_id, keep=None):
+        with self._lock:
+            for sid in [sid for sid, (uid, _) in self._sessions.items() if uid == user_id and sid != keep]:
+                del self._sessions[sid]
+
+
+class SQLiteStore:
+    """Sessions in the sessions table, visible to every worker on the database.
+
+    ``connect()`` returns the request's read/write connection and
+    ``connect_read()`` the connection lookups use, e.g. get_read_db.
+    """
+
+    def __init__(self, connect, connect_read=None):
+        self.connect = connect
+        self.connect_read = connect_read or connect
+
+    def create(self, session_id, user_id, expires_at):
+        now = time.time()
+        conn = self.connect()
+        conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+        conn.execute(
+            'INSERT INTO sessions (id, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)',
+            (session_id, user_id, now, expires_at),
+        )
+        conn.commit()
+
+    def get(self, session_id):
+        row = self.connect_read().execute(
+            'SELECT user_id FROM sessions WHERE id = ? AND expires_at > ?', (session_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def delete(self, session_id):
+        conn = self.connect()
+        conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+        conn.commit()
+
+    def delete_user(self, user_id, keep=None):
+        conn = self.connect()
+        conn.execute('DELETE FROM sessions WHERE user_id = ? AND id IS NOT ?', (user_id, keep))
+        conn.commit()
+
+
+STORES = {
+    'memory': MemoryStore,
+    'sqlite': SQLiteStore,
+}
+
+
+def create_store(name, connect, connect_read=None):
+    try:
+        store_cls = STORES[name]
+    except KeyError:
+        raise ValueError(f'Unknown session store: {name!r}')
+    if store_cls is SQLiteStore:
+        return SQLiteStore(connect, connect_read)
+    return store_cls()
+
+
+def stored_secret(conn, name='session'):
+    """A random key kept in app_secrets, created by whichever worker asks first."""
+    conn.execute(
+        'INSERT INTO app_secrets (name, value) VALUES (?, ?) ON CONFLICT (name) DO NOTHING',
+        (name, secrets.token_hex(32)),
+    )
+    conn.commit()
+    return conn.execute('SELECT value FROM app_secrets WHERE name = ?', (name,)).fetchone()[0]
+
+
+def bearer_token(authorization):
+    if authorization:
+        scheme, _, token = authorization.partition(' ')
+        if scheme.lower() == 'bearer' and token:
+            return token.strip()
+    return None
+
+
+class SessionManager:
+    """Issues and checks session tokens and resolves them to user records.
+
+    ``secret_key`` is the signing key, or a callable returning it that is
+    called on first use. ``load_user(user_id)`` reads a user record, or
+    returns None; its results are cached for ``user_cache_ttl`` seconds.
+    """
+
+    def __init__(self, secret_key, store, load_user, max_age=30 * 24 * 3600, cookie_name='auth_token',
+                 reset_max_age=15 * 60, user_cache_size=1024, user_cache_ttl=30.0):
+        self.secret_key = secret_key
+        self.store = store
+        self.load_user = load_user
+        self.max_age = max_age
+        self.cookie_name = cookie_name
+        self.reset_max_age = reset_max_age
+        self.users = cache.TTLCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+        self._signer = None
+        self._reset_serializer = None
+        self._reset_key = None
+        self._lock = threading.Lock()
+
+    def _signers(self):
+        if self._signer is None:
+            with self._lock:
+                if self._signer is None:
+                    key = self.secret_key() if callable(self.secret_key) else self.secret_key
+                    raw = key if isinstance(key, bytes) else key.encode()
+                    self._reset_key = hashlib.sha256(b'password-reset' + raw).digest()
+                    self._reset_serializer = URLSafeTimedSerializer(key, salt='password-reset')
+                    self._signer = TimestampSigner(key, salt='session')
+        return self._signer, self._reset_serializer
+
+    def token_from(self, authorization, cookies):
+        """The token in an Authorization header value or, failing that, the cookies mapping."""
+        return bearer_token(authorization) or cookies.get(self.cookie_name)
+
+    def issue(self, user_id):
+        """Start a session for ``user_id`` and return its token."""
+        signer, _ = self._signers()
+        session_id = secrets.token_urlsafe(24)
+        self.store.create(session_id, user_id, time.time() + self.max_age)
+        return signer.sign(session_id).decode()
+
+    def session_id(self, token):
+        if not token:
+            return None
+        signer, _ = self._signers()
+        try:
+            return signer.unsign(token, max_age=self.max_age).decode()
+        except BadSignature:
+            return None
+
+    def user_id(self, token):
+        session_id = self.session_id(token)
+        return self.store.get(session_id) if session_id else None
+
+    def user(self, token):
+        """The user record for ``token``, or None if it is not a live session."""
+        user_id = self.user_id(token)
+        if user_id is None:
+            return None
+        return self.users.get_or_load(user_id, lambda: self.load_user(user_id))
+
+    def revoke(self, token):
+        session_id = self.session_id(token)
+        if session_id:
+            self.store.delete(session_id)
+
+    def revoke_user(self, user_id, keep_token=None):
+        """End every session of ``user_id`` except the one ``keep_token`` belongs to."""
+        self.store.delete_user(user_id, keep=self.session_id(keep_token))
+        self.forget_user(user_id)
+
+    def forget_user(self, user_id):
+        self.users.discard(user_id)
+
+    def reset_token(self, user_id, password):
+        """A token for changing ``user_id``'s password, valid until the password changes."""
+        _, serializer = self._signers()
+        return serializer.dumps([user_id, self._fingerprint(password)])
+
+    def check_reset_token(self, token, current_password):
+        """The user id in a reset token, or None. ``current_password(user_id)`` reads the stored password."""
+        _, serializer = self._signers()
+        try:
+            user_id, fingerprint = serializer.loads(token, max_age=self.reset_max_age)
+        except (BadSignature, TypeError, ValueError):
+            return None
+        password = current_password(user_id)
+        if password is None or not hmac.compare_digest(fingerprint, self._fingerprint(password)):
+            return None
+        return user_id
+
+    def _fingerprint(self, password):
+        # Binds a reset token to the password it replaces, so it works once.
+        # Keyed, since the token's payload is readable.
+        return hmac.new(self._reset_key, password.encode(), hashlib.sha256).hexdigest()[:32]
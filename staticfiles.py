@@ -0,0 +1,112 @@
+"""Serving of uploaded images and avatars.
+
+send_from_directory derives its ETag from the path and mtime, which changes
+on every deploy or copy, and sends no Cache-Control. StaticFiles adds
+
+  * strong ETags from the content: the name itself for content-addressed
+    files (see blobstore), otherwise a SHA-256 of the bytes, cached by
+    path, mtime and size;
+  * ``public, max-age=<1 year>, immutable`` for content-addressed names and
+    a short max-age for everything else;
+  * conditional GET/HEAD, and Range/If-Range through werkzeug;
+  * a body that is the open file, handed to the server's wsgi.file_wrapper
+    (gunicorn and uWSGI send it with sendfile(2), without copying it
+    through Python);
+  * an offload mode for a front proxy: the response carries only headers
+    plus X-Accel-Redirect (nginx) or X-Sendfile (Apache, lighttpd), and the
+    proxy sends the bytes.
+
+Images are already compressed, so there are no precompressed variants.
+"""
+import hashlib
+import mimetypes
+import os
+import stat
+from urllib.parse import quote
+
+from werkzeug.exceptions import NotFound
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+import blobstore
+import cache
+
+OFFLOAD_MODES = (None, 'x-accel-redirect', 'x-sendfile')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+class StaticFiles:
+    """Serves the files in ``folder``, which the app exposes under ``url_prefix``.
+
+    With ``offload='x-accel-redirect'`` the proxy must map
+    ``accel_prefix + url_prefix`` to ``folder`` as an internal location.
+    """
+
+    def __init__(self, folder, url_prefix, max_age=3600, immutable_max_age=365 * 24 * 3600,
+                 offload=None, accel_prefix='/internal', response_class=Response, digest_cache_size=4096):
+        if offload not in OFFLOAD_MODES:
+            raise ValueError(f'offload must be one of {OFFLOAD_MODES}')
+        self.folder = folder
+        self.url_prefix = url_prefix
+        self.max_age = max_age
+        self.immutable_max_age = immutable_max_age
+        self.offload = offload
+        self.accel_prefix = accel_prefix
+        self.response_class = response_class
+        self.digests = cache.TTLCache(maxsize=digest_cache_size, ttl=float('inf'))
+
+    def etag(self, path, filename, st):
+        if blobstore.is_content_addressed(filename):
+            return filename.rsplit('.', 1)[0]
+        return self.digests.get_or_load((path, st.st_mtime_ns, st.st_size), lambda: _file_digest(path))
+
+    def serve(self, environ, filename):
+        """Return a response for ``filename``; raises NotFound if it is not a file."""
+        path = safe_join(self.folder, filename)
+        if path is None:
+            raise NotFound()
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise NotFound()
+        if not stat.S_ISREG(st.st_mode):
+            raise NotFound()
+
+        response = self.response_class(
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        )
+        etag = self.etag(path, filename, st)
+        response.set_etag(etag)
+        response.last_modified = int(st.st_mtime)
+        response.cache_control.public = True
+        if blobstore.is_content_addressed(filename):
+            response.cache_control.max_age = self.immutable_max_age
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.max_age = self.max_age
+
+        if not is_resource_modified(environ, etag=etag, last_modified=response.last_modified):
+            response.status_code = 304
+            return response
+
+        if self.offload == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = quote(self.accel_prefix + self.url_prefix + filename)
+            return response
+        if self.offload == 'x-sendfile':
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+            return response
+
+        response.response = wrap_file(environ, open(path, 'rb'))
+        response.direct_passthrough = True
+        response.content_length = st.st_size
+        return response.make_conditional(environ, accept_ranges=True, complete_length=st.st_size)
@@ -0,0 +1,25 @@
+import itertools
+
+# Rows encoded per yielded chunk: large enough to keep per-write overhead
+# low, small enough that a chunk stays a few hundred KB.
+CHUNK_ROWS = 500
+
+
+def json_array(rows, dumps, key=None, chunk_rows=CHUNK_ROWS):
+    """Yield ``rows`` as the text of a JSON array, a chunk of elements at a time.
+
+    ``rows`` can be any iterable (typically a generator over a live cursor);
+    only one chunk is held in memory at a time. ``dumps`` is called once per
+    chunk with a list, which keeps the work inside the C encoder. With
+    ``key`` the array is wrapped as ``{key: [...]}``.
+    """
+    yield '{%s:[' % dumps(key) if key is not None else '['
+    rows = iter(rows)
+    separator = ''
+    while True:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if not chunk:
+            break
+        yield separator + dumps(chunk)[1:-1]
+        separator = ','
+    yield ']}\n' if key is not None else ']\n'
@@ -0,0 +1,108 @@
+"""The query behind /api/trades: one user's trades, newest first.
+
+The page is chosen from the trades table alone, then joined to both items
+and both users. A user's trades in either role are the merge of two range
+scans, one over (sender_id, created_at) and one over (receiver_id,
+created_at), each stopping after one page. An OR of the two columns would
+instead collect and sort every trade the user was ever part of. With a
+status filter, the (sender_id, status, created_at) and (receiver_id,
+status, created_at) indexes from migration 13 serve the same scans.
+
+The unread count is a subquery per trade on the page, over the partial
+index of unread messages. The page still takes one statement.
+"""
+from collections import namedtuple
+
+ROLES = ('all', 'sent', 'received')
+DEFAULT_ROLE = 'all'
+# As accepted by /api/trade/<id>/status
+STATUSES = ('pending', 'accepted', 'declined', 'completed', 'cancelled')
+
+# Hashable, like catalog.Filters
+Filters = namedtuple('Filters', ['role', 'status', 'unread'])
+
+# Column order expected by server.trade_to_dict; the unread count, when
+# asked for, comes last
+_COLUMNS = '''
+    t.id, t.status, t.created_at,
+    i1.id, i1.title, i1.image_url, i1.description,
+    i2.id, i2.title, i2.image_url, i2.description,
+    u1.id, u1.firstname, u1.lastname, u1.avatar_url,
+    u2.id, u2.firstname, u2.lastname, u2.avatar_url'''
+
+_UNREAD = '''(
+        SELECT count(*) FROM chat_messages cm
+        WHERE cm.trade_id = t.id AND cm.receiver_id = ? AND cm.is_read = 0
+    )'''
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def parse_filters(args):
+    """Read ``role`` (all, sent or received), ``status`` and ``unread=1``."""
+    role = args.get('role', DEFAULT_ROLE)
+    if role not in ROLES:
+        raise InvalidFilter(f'role must be one of: {", ".join(ROLES)}')
+    status = args.get('status') or None
+    if status is not None and status not in STATUSES:
+        raise InvalidFilter(f'status must be one of: {", ".join(STATUSES)}')
+    return Filters(role, status, args.get('unread') == '1')
+
+
+def sort_key(trade):
+    return trade['created_at'], trade['id']
+
+
+def _range(column, user_id, filters, limit, after):
+    # ids of the user's trades in one role, in page order
+    sql = f'SELECT id, created_at FROM trades WHERE {column} = ?'
+    params = [user_id]
+    if filters.status is not None:
+        sql += ' AND status = ?'
+        params.append(filters.status)
+    if after:
+        sql += ' AND (created_at, id) < (?, ?)'
+        params.extend(after)
+    sql += ' ORDER BY created_at DESC, id DESC'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit + 1)
+    return sql, params
+
+
+def trade_query(user_id, filters, limit=None, after=None):
+    """``(sql, params)`` for a page of ``user_id``'s trades.
+
+    Fetches ``limit + 1`` rows so pagination.page() can tell whether there
+    is a next page; ``limit=None`` returns every matching trade.
+    """
+    if filters.role == 'all':
+        sent, sent_params = _range('sender_id', user_id, filters, limit, after)
+        received, received_params = _range('receiver_id', user_id, filters, limit, after)
+        # UNION, not UNION ALL, so a trade with oneself is listed once
+        ids = f'SELECT * FROM ({sent}) UNION SELECT * FROM ({received}) ORDER BY created_at DESC, id DESC'
+        id_params = sent_params + received_params
+        if limit is not None:
+            ids += ' LIMIT ?'
+            id_params.append(limit + 1)
+    else:
+        column = 'sender_id' if filters.role == 'sent' else 'receiver_id'
+        ids, id_params = _range(column, user_id, filters, limit, after)
+
+    columns, params = _COLUMNS, []
+    if filters.unread:
+        columns += ',\n    ' + _UNREAD
+        params.append(user_id)
+    sql = f'''
+        SELECT {columns}
+        FROM ({ids}) AS page
+        JOIN trades t ON t.id = page.id
+        JOIN items i1 ON t.item1_id = i1.id
+        JOIN items i2 ON t.item2_id = i2.id
+        JOIN users u1 ON t.sender_id = u1.id
+        JOIN users u2 ON t.receiver_id = u2.id
+        ORDER BY page.created_at DESC, page.id DESC
+    '''
+    return sql, params + id_params
@@ -0,0 +1,271 @@
+"""Streaming and resumable image uploads.
+
+Both write straight into the content store's incoming folder in bounded
+chunks, without a spooled copy, and identify the file from its first bytes.
+An upload that is not a PNG, JPEG, GIF or WebP image fails as soon as those
+bytes arrive, before the rest of the body is read.
+
+Resumable uploads follow the tus model. POST creates a session for a known
+length, then each PATCH appends the bytes from ``Upload-Offset`` on. After
+a dropped connection, GET returns the offset to continue from. A session is a
+row in upload_sessions (migration 10) plus a partial file whose size is the
+offset.
+"""
+import os
+import secrets
+import time
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes -> extension the file is stored under. WebP is RIFF....WEBP.
+SIGNATURES = [
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+]
+SNIFF_BYTES = 12
+
+# Cap on the multipart decoder's buffer. It holds one read plus a possible
+# partial boundary, unless a part's headers never end.
+MAX_BUFFER_BYTES = 4 * CHUNK_SIZE
+
+
+class InvalidUpload(ValueError):
+    status = 400
+
+
+class UnsupportedType(InvalidUpload):
+    status = 415
+
+
+class UploadTooLarge(InvalidUpload):
+    status = 413
+
+
+class UploadConflict(InvalidUpload):
+    status = 409
+
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+class UnknownUpload(LookupError):
+    pass
+
+
+def sniff(head):
+    """The extension for an image starting with ``head``, or None."""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    for magic, extension in SIGNATURES:
+        if head.startswith(magic):
+            return extension
+    return None
+
+
+def check_type(head, allowed):
+    extension = sniff(head)
+    # ALLOWED_EXTENSIONS lists both jpg and jpeg
+    if extension is None or extension[1:] not in allowed:
+        raise UnsupportedType('Not a PNG, JPEG, GIF or WebP image')
+    return extension
+
+
+class SniffingWriter:
+    """Passes data to a BlobWriter once its first bytes identify an allowed image."""
+
+    def __init__(self, writer, allowed):
+        self.writer = writer
+        self.allowed = allowed
+        self.extension = None
+        self._head = b''
+
+    def write(self, data):
+        if self.extension is None:
+            self._head += data
+            if len(self._head) < SNIFF_BYTES:
+                return
+            self.extension = check_type(self._head, self.allowed)
+            data, self._head = self._head, b''
+        self.writer.write(data)
+
+    def commit(self, conn):
+        if self.extension is None:
+            # Shorter than SNIFF_BYTES
+            self.extension = check_type(self._head, self.allowed)
+            self.writer.write(self._head)
+        return self.writer.commit(conn, self.extension)
+
+    def abort(self):
+        self.writer.abort()
+
+
+def receive_file(stream, boundary, field, write):
+    """Pass the data of the ``field`` file part of a multipart body to ``write``.
+
+    Reads ``stream`` in CHUNK_SIZE pieces, skips every other part, and stops
+    at the end of the body. Returns False if there was no such part.
+    """
+    decoder = MultipartDecoder(boundary, max_form_memory_size=MAX_BUFFER_BYTES)
+    found = complete = receiving = False
+    while True:
+        data = stream.read(CHUNK_SIZE)
+        decoder.receive_data(data or None)
+        event = decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, (Field, File)):
+                receiving = isinstance(event, File) and event.name == field and not found
+                found = found or receiving
+            elif isinstance(event, Data) and receiving:
+                write(event.data)
+                if not event.more_data:
+                    complete, receiving = True, False
+            event = decoder.next_event()
+        if not data or isinstance(event, Epilogue):
+            break
+    if found and not complete:
+        raise InvalidUpload('Upload ended before the end of the file')
+    return found
+
+
+class ResumableUploads:
+    """Sessions for uploads sent over several requests into ``store``.
+
+    ``connect()`` returns the request's database connection and
+    ``release()`` hands it back. A PATCH releases it while the body streams
+    in, so slow clients do not tie up the pool.
+    """
+
+    def __init__(self, store, allowed, max_bytes, connect, release, ttl=24 * 3600, lease=300):
+        self.store = store
+        self.allowed = allowed
+        self.max_bytes = max_bytes
+        self.connect = connect
+        self.release = release
+        self.ttl = ttl  # sessions untouched for this long are discarded
+        self.lease = lease  # a PATCH holds its session at most this long
+
+    def path(self, upload_id):
+        return os.path.join(self.store.incoming, f'{upload_id}.upload')
+
+    def create(self, length):
+        """Start a session for ``length`` bytes and return its id."""
+        if not isinstance(length, int) or isinstance(length, bool) or length <= 0:
+            raise InvalidUpload('length must be a positive integer')
+        if self.max_bytes is not None and length > self.max_bytes:
+            raise UploadTooLarge(f'Uploads are limited to {self.max_bytes} bytes')
+        self.expire()
+        upload_id = secrets.token_hex(16)
+        os.makedirs(self.store.incoming, exist_ok=True)
+        open(self.path(upload_id), 'xb').close()
+        now = time.time()
+        conn = self.connect()
+        conn.execute(
+            'INSERT INTO upload_sessions (id, length, created_at, updated_at) VALUES (?, ?, ?, ?)',
+            (upload_id, length, now, now),
+        )
+        conn.commit()
+        return upload_id
+
+    def status(self, upload_id):
+        """Return ``(offset, length)``."""
+        row = self.connect().execute('SELECT length FROM upload_sessions WHERE id = ?', (upload_id,)).fetchone()
+        if row is None:
+            raise UnknownUpload(upload_id)
+        try:
+            return os.path.getsize(self.path(upload_id)), row[0]
+        except FileNotFoundError:
+            raise UnknownUpload(upload_id)
+
+    def append(self, upload_id, offset, stream):
+        """Append ``stream`` at ``offset``.
+
+        Returns ``(offset, length, stored)``. ``stored`` is the
+        ``(filename, created)`` from the content store once the last byte
+        has arrived, and None before that.
+        """
+        conn = self.connect()
+        row = conn.execute('SELECT length, extension FROM upload_sessions WHERE id = ?', (upload_id,)).fetchone()
+        if row is None:
+            raise UnknownUpload(upload_id)
+        length, extension = row
+        now = time.time()
+        claimed = conn.execute(
+            'UPDATE upload_sessions SET busy_until = ?, updated_at = ? WHERE id = ? AND busy_until < ?',
+            (now + self.lease, now, upload_id, now),
+        ).rowcount
+        conn.commit()
+        if not claimed:
+            raise UploadConflict('Another request is writing to this upload')
+        self.release()
+
+        path = self.path(upload_id)
+        try:
+            size = os.path.getsize(path)
+            if offset != size:
+                raise UploadConflict(f'Upload-Offset must be {size}', offset=size)
+            with open(path, 'ab') as f:
+                while size < length and (chunk := stream.read(min(CHUNK_SIZE, length - size))):
+                    if extension is None and (size + len(chunk) >= SNIFF_BYTES or size + len(chunk) == length):
+                        f.flush()
+                        with open(path, 'rb') as head:
+                            extension = check_type(head.read(size) + chunk, self.allowed)
+                        conn = self.connect()
+                        conn.execute('UPDATE upload_sessions SET extension = ? WHERE id = ?', (extension, upload_id))
+                        conn.commit()
+                        self.release()
+                    f.write(chunk)
+                    size += len(chunk)
+                if size == length and stream.read(1):
+                    raise UploadTooLarge(f'Upload is {length} bytes')
+            if size < length:
+                self._unlock(upload_id)
+                return size, length, None
+            stored = self.store.adopt(self.connect(), path, extension)
+        except UnsupportedType:
+            # Can never become a valid image
+            self.cancel(upload_id)
+            raise
+        except BaseException:
+            self._unlock(upload_id)
+            raise
+        conn = self.connect()
+        conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+        conn.commit()
+        return size, length, stored
+
+    def cancel(self, upload_id):
+        conn = self.connect()
+        if conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,)).rowcount == 0:
+            conn.rollback()
+            raise UnknownUpload(upload_id)
+        conn.commit()
+        self._remove(upload_id)
+
+    def expire(self):
+        conn = self.connect()
+        now = time.time()
+        expired = [row[0] for row in conn.execute(
+            'SELECT id FROM upload_sessions WHERE updated_at < ? AND busy_until < ?', (now - self.ttl, now)
+        )]
+        if expired:
+            conn.executemany('DELETE FROM upload_sessions WHERE id = ?', [(upload_id,) for upload_id in expired])
+            conn.commit()
+            for upload_id in expired:
+                self._remove(upload_id)
+
+    def _unlock(self, upload_id):
+        conn = self.connect()
+        conn.rollback()
+        conn.execute('UPDATE upload_sessions SET busy_until = 0 WHERE id = ?', (upload_id,))
+        conn.commit()
+
+    def _remove(self, upload_id):
+        try:
+            os.unlink(self.path(upload_id))
+        except FileNotFoundError:
+            pass